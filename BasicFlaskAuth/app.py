@@ -1,8 +1,9 @@
 from flask import Flask, request, abort
-import json
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from jwks import JWKSError, JWKSKeyStore
+from token_cache import VerifiedTokenCache
 
 
 app = Flask(__name__)
@@ -11,6 +12,11 @@ AUTH0_DOMAIN = @TODO_REPLACE_WITH_YOUR_DOMAIN
 ALGORITHMS = ['RS256']
 API_AUDIENCE = @TODO_REPLACE_WITH_YOUR_API_AUDIENCE
 
+# signing keys of AUTH0_DOMAIN, fetched once and refreshed in the background
+jwks = JWKSKeyStore(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# payloads of the tokens verified lately
+token_cache = VerifiedTokenCache()
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -52,8 +58,6 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -62,15 +66,21 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        key = jwks.get(unverified_header['kid'])
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key.get('use', 'sig'),
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -109,10 +119,18 @@ def requires_auth(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         token = get_token_auth_header()
-        try:
-            payload = verify_decode_jwt(token)
-        except:
-            abort(401)
+        cached = token_cache.get(token)
+        if cached is None:
+            try:
+                payload = verify_decode_jwt(token)
+            except AuthError as e:
+                # 503 while the keys can't be read, 401 for any bad token
+                abort(503 if e.status_code == 503 else 401)
+            except Exception:
+                abort(401)
+            cached = token_cache.put(token, payload)
+        # no permission checks here, only the payload is passed on
+        payload = cached[0]
         return f(payload, *args, **kwargs)
 
     return wrapper
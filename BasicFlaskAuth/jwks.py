@@ -0,0 +1,158 @@
+import json
+import logging
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+logger = logging.getLogger('jwks')
+
+## JWKS key store
+'''
+JWKSKeyStore
+    the signing keys of an issuer, read from its jwks.json and kept in
+    memory by key id, so verifying a token needs no network round trip.
+    The key set is kept for the max-age of the issuer's Cache-Control and
+    a background thread fetches it again before that runs out. A kid that
+    is not in the set triggers one refetch, shared by every request that
+    asks meanwhile and at most once per min_refetch_interval. When the
+    issuer can't be reached the last key set that could be read stays in
+    use.
+
+    EXAMPLE
+        jwks = JWKSKeyStore('https://example.auth0.com/.well-known/jwks.json')
+        key = jwks.get(unverified_header['kid'])
+'''
+DEFAULT_MAX_AGE = 600
+MIN_REFETCH_INTERVAL = 30
+FETCH_TIMEOUT = 5
+# share of max-age after which the background thread fetches again
+REFRESH_AFTER = 0.9
+
+MAX_AGE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+
+'''
+JWKSError Exception
+raised when no key set could be read from the issuer yet
+'''
+class JWKSError(Exception):
+    pass
+
+class JWKSKeyStore(object):
+    def __init__(self, url, default_max_age=DEFAULT_MAX_AGE, min_refetch_interval=MIN_REFETCH_INTERVAL,
+                 timeout=FETCH_TIMEOUT, background=True):
+        self.url = url
+        self.default_max_age = default_max_age
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.background = background
+        self.keys = {}
+        self.expires = 0
+        self.refresh_at = 0
+        self.fetched = 0
+        self.fetches = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.in_flight = None
+        self.refresher = None
+        self.stopped = threading.Event()
+
+    '''
+    get(kid)
+        the JWK of kid, None when the issuer doesn't have it
+        raises JWKSError while no key set was read yet
+    '''
+    def get(self, kid):
+        key = self.keys.get(kid)
+        now = time.time()
+        if key is not None and now < self.expires:
+            return key
+        # unknown kid or expired key set
+        self.refresh(self.min_refetch_interval)
+        key = self.keys.get(kid)
+        if not self.keys:
+            raise JWKSError('no keys from {}: {}'.format(self.url, self.error))
+        return key
+
+    '''
+    refresh(min_interval=0)
+        fetches the key set unless the last fetch started less than
+        min_interval seconds ago, or waits for the fetch already in flight
+        returns True when a key set, new or last good, is loaded afterwards
+    '''
+    def refresh(self, min_interval=0):
+        with self.lock:
+            done = self.in_flight
+            if done is None:
+                if time.time() - self.fetched < min_interval:
+                    return bool(self.keys)
+                self.fetched = time.time()
+                done = self.in_flight = threading.Event()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            done.wait(self.timeout + 1)
+            return bool(self.keys)
+
+        try:
+            loaded = self.fetch()
+        finally:
+            with self.lock:
+                self.in_flight = None
+            done.set()
+        if loaded and self.background:
+            self.start()
+        return bool(self.keys)
+
+    def fetch(self):
+        self.fetches += 1
+        try:
+            with urlopen(self.url, timeout=self.timeout) as response:
+                jwks = json.loads(response.read().decode('utf-8'))
+                match = MAX_AGE.search(response.headers.get('Cache-Control') or '')
+            keys = {key['kid']: key for key in jwks['keys'] if 'kid' in key}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # URLError and timeouts are OSErrors, the rest a malformed body
+            self.error = e
+            logger.warning('fetching %s failed, keeping %d keys: %s', self.url, len(self.keys), e)
+            return False
+
+        self.load(keys, int(match.group(1)) if match else None)
+        return True
+
+    '''
+    load(keys, max_age=None)
+        replaces the key set with keys, a dict of JWKs by kid, kept for
+        max_age seconds or default_max_age
+    '''
+    def load(self, keys, max_age=None):
+        if max_age is None:
+            max_age = self.default_max_age
+        loaded = time.time()
+        # readers see either the old or the new dict, never a partial one
+        self.keys = dict(keys)
+        self.expires = loaded + max_age
+        self.refresh_at = loaded + max_age * REFRESH_AFTER
+        self.error = None
+
+    '''
+    start()
+        starts the background refresh thread, once
+    '''
+    def start(self):
+        with self.lock:
+            if self.refresher is not None or self.stopped.is_set():
+                return
+            self.refresher = threading.Thread(target=self.run, name='jwks-refresh', daemon=True)
+        self.refresher.start()
+
+    def run(self):
+        while not self.stopped.wait(max(self.refresh_at - time.time(), 0)):
+            self.refresh()
+            if self.refresh_at <= time.time():
+                # the fetch failed, or max-age is 0; the last keys stay in use
+                self.stopped.wait(self.min_refetch_interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,82 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+## Verified token cache
+'''
+VerifiedTokenCache
+    payloads of tokens whose signature and claims were verified, so a
+    bearer token that comes back is checked with a dict lookup instead of
+    an RS256 verification. Entries are keyed by the SHA-256 of the token,
+    hold the decoded payload and its permission set, and expire at the
+    token's exp or ttl seconds after they were stored, whichever comes
+    first. The least recently used entries go beyond max_entries.
+    permissions turns the payload's permissions array into the set that
+    is cached with it, frozenset by default.
+
+    EXAMPLE
+        cached = token_cache.get(token)
+        if cached is None:
+            cached = token_cache.put(token, verify_decode_jwt(token))
+        payload, permissions = cached
+'''
+TOKEN_CACHE_TTL = 300
+MAX_CACHED_TOKENS = 10000
+
+class VerifiedTokenCache(object):
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_entries=MAX_CACHED_TOKENS, permissions=frozenset):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.permissions = permissions
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    get(token)
+        (payload, permissions) of a verified token that has not expired,
+        None otherwise
+    '''
+    def get(self, token):
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+        return None
+
+    '''
+    put(token, payload)
+        stores the payload of a token that was just verified and returns
+        it with its permission set
+    '''
+    def put(self, token, payload):
+        permissions = self.permissions(payload.get('permissions') or ())
+        expires = time.time() + self.ttl
+        if 'exp' in payload:
+            expires = min(expires, payload['exp'])
+        if self.max_entries <= 0:
+            return payload, permissions
+
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        with self.lock:
+            self.entries[key] = (expires, payload, permissions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return payload, permissions
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
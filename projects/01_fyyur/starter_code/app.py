@@ -3,9 +3,7 @@
 #----------------------------------------------------------------------------#
 import os
 import json
-import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, abort, stream_with_context, jsonify
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 import logging
@@ -13,7 +11,13 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 from flask_migrate import Migrate
-from models import db_setup, Venue, Artist, Show
+from models import (db_setup, Venue, Artist, Show, venue_areas, search, show_detail,
+  SHOWS_PER_PAGE, shows_page, decode_cursor, iter_shows)
+from filters import format_datetime
+from scheduling import ScheduleError, parse_schedule, schedule_shows
+from cache import init_cache, cached, tag, invalidate, cache_stats
+from db_pool import pool_stats
+from sql_stats import SQLStats
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
@@ -21,20 +25,21 @@ from models import db_setup, Venue, Artist, Show
 app = Flask(__name__)
 moment = Moment(app)
 db = db_setup(app)
+init_cache(app)
+SQLStats(app)
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format)
-
 app.jinja_env.filters['datetime'] = format_datetime
 
+def stream_template(template_name, **context):
+  # like render_template, but yields the page in chunks as it renders
+  app.update_template_context(context)
+  stream = app.jinja_env.get_template(template_name).stream(context)
+  stream.enable_buffering(5)
+  return stream
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
@@ -48,59 +53,29 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@cached('venues')
 def venues():
-	areas = db.session.query(Venue.city, Venue.state).order_by('state').all()
-	data = []
-	for area in areas:
-		venues = Venue.query.filter_by(state=area.state).filter_by(city=area.city).order_by('name').all()
-		v_data = []
-		data.append({
-			"city": area.city,
-			"state": area.state,
-			"venues": v_data
-		})
-		for venue in venues:
-			shows = Show.query.filter_by(venue_id=venue.id).order_by('id').all()
-			v_data.append({
-				"id": venue.id,
-				"name": venue.name,
-				"num_upcoming_shows": len(shows)
-			})
-	return render_template('pages/venues.html', areas=data)
+	# one query for every area, venue and stored upcoming show count
+	areas = venue_areas()
+	return render_template('pages/venues.html', areas=areas)
 
 @app.route('/venues/search', methods=['POST'])
 def search_venues():
-  # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
-  # seach for Hop should return "The Musical Hop".
-  # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
+	# case-insensitive partial search on venue name, ranked and paginated
+	# seach for Hop should return "The Musical Hop".
+	# search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
 	search_term = request.form.get('search_term', '')
-	new_results = db.session.query(Venue).filter(Venue.name.ilike(f'%{search_term}%')).all()
-	data = []
-
-	for result in new_results:
-		data.append({
-			'id': result.id,
-			'name': result.name,
-			'num_upcoming_shows': len(db.session.query(Show).filter(Show.venue_id == result.id).filter(Show.start_time > str(datetime.now())).all()),
-		})
-
-	response={
-    "count": len(new_results),
-    "data": data
-  }
+	page = request.form.get('page', 1, type=int)
+	response = search(Venue, search_term, page)
 
-	return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
+	return render_template('pages/search_venues.html', results=response, search_term=search_term)
 
 @app.route('/venues/<int:venue_id>')
+@cached('venue:{venue_id}')
 def show_venue(venue_id):
-  # shows the venue page with the given venue_id
-  # TODO: replace with real venue data from the venues table, using venue_id
-	venue = Venue.query.filter_by(id=venue_id).first_or_404()
-	past_shows = db.session.query(Artist, Show).join(Show).join(Venue).filter(
-		Show.venue_id == venue_id,
-		Show.artist_id == artist_id,
-		Show.start_time > str(datetime.now()).all()
-	)
+	# shows the venue page with the given venue_id
+	venue, past_shows, upcoming_shows = show_detail(Venue, venue_id)
+	tag(*('artist:{}'.format(show['artist_id']) for show in past_shows + upcoming_shows))
 	data={
     "id": venue.id,
     "name": venue.name,
@@ -114,19 +89,8 @@ def show_venue(venue_id):
     "seeking_talent": venue.seeking_talent,
     "seeking_description": venue.seeking_description,
     "image_link": venue.image_link,
-    "shows": venue.shows,
-		"past_shows": [{
-      "artist_id": aritst.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": show.start_time
-    } for artist, show in past_shows],
-    "upcoming_shows": [{
-			"artist_id": aritst.id,
-      "artist_name": artist.name,
-      "artist_image_link": artist.image_link,
-      "start_time": show.start_time
-		} for artist, show in upcoming_shows],
+    "past_shows": past_shows,
+    "upcoming_shows": upcoming_shows,
     "past_shows_count": len(past_shows),
     "upcoming_shows_count": len(upcoming_shows),
   }
@@ -160,6 +124,7 @@ def create_venue_submission():
 		)
 		db.session.add(venue)
 		db.session.commit()
+		invalidate('venues')
 		flash('Venue ' + request.form['name'] + ' was successfully listed!') # on successful db insert, flash success
 	except ValueError as e:
 		print(e)
@@ -178,6 +143,8 @@ def delete_venue(venue_id):
 		venue = Venue.query.get(venue_id)
 		db.session.delete(venue)
 		db.session.commit()
+		# artist pages and /shows listing this venue carry its tag too
+		invalidate('venues', 'shows', 'venue:{}'.format(venue_id))
 		flash('Venue ' + venue.name + ' was deleted!')
 	except:
 		db.session.rollback()
@@ -192,6 +159,7 @@ def delete_venue(venue_id):
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@cached('artists')
 def artists():
   data = Artist.query.all()
   return render_template('pages/artists.html', artists=data)
@@ -200,54 +168,18 @@ def artists():
 def search_artists():
 
 	search_term = request.form.get('search_term', '')
-	new_results = db.session.query(Artist).filter(Artist.name.ilike(f'%{search_term}%')).all()
-	
-	data = []
-	for result in new_results:
-		data.append(result)
-
-	response={
-    "count": len(new_results),
-    "data": data
-  }
+	page = request.form.get('page', 1, type=int)
+	response = search(Artist, search_term, page)
 
 	return render_template('pages/search_artists.html', results=response, search_term=search_term)
 
 @app.route('/artists/<int:artist_id>')
+@cached('artist:{artist_id}')
 def show_artist(artist_id):
-	# gets the artist at specified id
-	artist = Artist.query.get(artist_id)
+	# gets the artist at specified id along with its shows and their venues
+	artist, past_shows, upcoming_shows = show_detail(Artist, artist_id)
+	tag(*('venue:{}'.format(show['venue_id']) for show in past_shows + upcoming_shows))
 
-	# gets shows of artist with artist_id
-	shows = Show.query.get(artist_id)
-
-	def upcoming_shows():
-		upcoming_shows = []
-
-		if shows is not None:
-			for show in shows:
-				if show.start_time > datetime.now():
-					upcoming_shows.append({
-						"venue_id": show.venue_id,
-						"venue_name": show.Venue.name,
-						"venue_image_link": show.Venue.image_link,
-						"start_time": format_datetime(str(show.start_time))
-					})
-		return upcoming_shows
-
-	def past_shows():
-		past_shows = []
-
-		if shows is not None:
-			for show in shows:
-				if show.start_time < datetime.now():
-					past_shows.append({
-						"venue_id": show.venue_id,
-						"venue_name": show.venue.name,
-						"venue_image_link": show.venue.image_link,
-						"start_time": format_datetime(str(show.start_time))
-					})
-		return past_shows
   # shows the artist page with the given artist_id
 	data={
     "id": artist.id,
@@ -261,10 +193,10 @@ def show_artist(artist_id):
     "seeking_venue": artist.seeking_venue,
     "seeking_description": artist.seeking_description,
     "image_link": artist.image_link,
-    "past_shows": past_shows(),
-    "upcoming_shows": upcoming_shows(),
-    "past_shows_count": len(past_shows()),
-    "upcoming_shows_count": len(upcoming_shows()),
+    "past_shows": past_shows,
+    "upcoming_shows": upcoming_shows,
+    "past_shows_count": len(past_shows),
+    "upcoming_shows_count": len(upcoming_shows),
   }
  
 	return render_template('pages/show_artist.html', artist=data)
@@ -300,17 +232,18 @@ def edit_artist_submission(artist_id):
 	try:
 		artist = Artist.query.get(artist_id)
 
-		artist.name = form.request.get('name')
-		aritst.city = form.request.get('city')
-		artist.state = form.request.get('state')
-		artist.phone = form.request.get('phone')
-		artist.genres = form.request.getlist('genres')
-		artist.facebook_link = form.request.get('facebook_link')
-		artist.website = form.request.get('website')
+		artist.name = request.form.get('name')
+		artist.city = request.form.get('city')
+		artist.state = request.form.get('state')
+		artist.phone = request.form.get('phone')
+		artist.genres = request.form.getlist('genres')
+		artist.facebook_link = request.form.get('facebook_link')
+		artist.website = request.form.get('website')
 		artist.seeking_venue = True if 'seeking_venue' in request.form else False
 		artist.seeking_description = request.form.get('seeking_description')
 
 		db.session.commit()
+		invalidate('artists', 'artist:{}'.format(artist_id))
 		flash('Artist ' + request.form['name'] + ' was successfully updated!')
 
 	except:
@@ -327,7 +260,7 @@ def edit_venue(venue_id):
 
 	venue = Venue.query.get(venue_id)
 
-	if artist is not None:
+	if venue is not None:
 		form.name.data = venue.name
 		form.genres.data = venue.genres
 		form.city.data = venue.city
@@ -347,17 +280,18 @@ def edit_venue_submission(venue_id):
 	try:
 		venue = Venue.query.get(venue_id)
 
-		venue.name = form.request.get('name')
-		venue.city = form.request.get('city')
-		venue.state = form.request.get('state')
-		venue.phone = form.request.get('phone')
-		venue.genres = form.request.getlist('genres')
-		venue.facebook_link = form.request.get('facebook_link')
-		venue.website = form.request.get('website')
+		venue.name = request.form.get('name')
+		venue.city = request.form.get('city')
+		venue.state = request.form.get('state')
+		venue.phone = request.form.get('phone')
+		venue.genres = request.form.getlist('genres')
+		venue.facebook_link = request.form.get('facebook_link')
+		venue.website = request.form.get('website')
 		venue.seeking_talent = True if 'seeking_talent' in request.form else False
 		venue.seeking_description = request.form.get('seeking_description')
 
 		db.session.commit()
+		invalidate('venues', 'venue:{}'.format(venue_id))
 		flash('Venue ' + request.form['name'] + ' was successfully updated!')
 
 	except:
@@ -395,6 +329,7 @@ def create_artist_submission():
 		)
 		db.session.add(artist)
 		db.session.commit()
+		invalidate('artists')
 		flash('Artist ' + request.form['name'] + ' was successfully listed!') # on successful db insert, flash success
 	except ValueError as e:
 		print(e)
@@ -410,55 +345,23 @@ def create_artist_submission():
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
+@cached('shows')
 def shows():
-  # displays list of shows at /shows
-	shows = db.session.query(Show).join(Artist).join(Venue).all()
-
-	data = []
-
-	for show in shows:
-		data.append({
-			"venue_id": show.venue_id,
-			"artist_id": show.artist_id,
-			"start_time": str(show.start_time)
-		})
-  # data=[{
-  #   "venue_id": 1,
-  #   "venue_name": "The Musical Hop",
-  #   "artist_id": 4,
-  #   "artist_name": "Guns N Petals",
-  #   "artist_image_link": "https://images.unsplash.com/photo-1549213783-8284d0336c4f?ixlib=rb-1.2.1&ixid=eyJhcHBfaWQiOjEyMDd9&auto=format&fit=crop&w=300&q=80",
-  #   "start_time": "2019-05-21T21:30:00.000Z"
-  # }, {
-  #   "venue_id": 3,
-  #   "venue_name": "Park Square Live Music & Coffee",
-  #   "artist_id": 5,
-  #   "artist_name": "Matt Quevedo",
-  #   "artist_image_link": "https://images.unsplash.com/photo-1495223153807-b916f75de8c5?ixlib=rb-1.2.1&ixid=eyJhcHBfaWQiOjEyMDd9&auto=format&fit=crop&w=334&q=80",
-  #   "start_time": "2019-06-15T23:00:00.000Z"
-  # }, {
-  #   "venue_id": 3,
-  #   "venue_name": "Park Square Live Music & Coffee",
-  #   "artist_id": 6,
-  #   "artist_name": "The Wild Sax Band",
-  #   "artist_image_link": "https://images.unsplash.com/photo-1558369981-f9ca78462e61?ixlib=rb-1.2.1&ixid=eyJhcHBfaWQiOjEyMDd9&auto=format&fit=crop&w=794&q=80",
-  #   "start_time": "2035-04-01T20:00:00.000Z"
-  # }, {
-  #   "venue_id": 3,
-  #   "venue_name": "Park Square Live Music & Coffee",
-  #   "artist_id": 6,
-  #   "artist_name": "The Wild Sax Band",
-  #   "artist_image_link": "https://images.unsplash.com/photo-1558369981-f9ca78462e61?ixlib=rb-1.2.1&ixid=eyJhcHBfaWQiOjEyMDd9&auto=format&fit=crop&w=794&q=80",
-  #   "start_time": "2035-04-08T20:00:00.000Z"
-  # }, {
-  #   "venue_id": 3,
-  #   "venue_name": "Park Square Live Music & Coffee",
-  #   "artist_id": 6,
-  #   "artist_name": "The Wild Sax Band",
-  #   "artist_image_link": "https://images.unsplash.com/photo-1558369981-f9ca78462e61?ixlib=rb-1.2.1&ixid=eyJhcHBfaWQiOjEyMDd9&auto=format&fit=crop&w=794&q=80",
-  #   "start_time": "2035-04-15T20:00:00.000Z"
-  # }]
-	return render_template('pages/shows.html', shows=data)
+  # displays one page of shows at /shows, ordered by start time
+	after = request.args.get('after')
+	try:
+		cursor = decode_cursor(after) if after else None
+	except ValueError:
+		abort(400)
+	data, next_cursor = shows_page(cursor, app.config.get('SHOWS_PER_PAGE', SHOWS_PER_PAGE))
+	tag(*('venue:{}'.format(show['venue_id']) for show in data))
+	tag(*('artist:{}'.format(show['artist_id']) for show in data))
+	return render_template('pages/shows.html', shows=data, next_cursor=next_cursor)
+
+@app.route('/shows/stream')
+def stream_shows():
+  # renders every show while rows are still coming off the cursor
+	return Response(stream_with_context(stream_template('pages/shows.html', shows=iter_shows())))
 
 @app.route('/shows/create')
 def create_shows():
@@ -480,6 +383,7 @@ def create_show_submission():
 			)
 			db.session.add(show)
 			db.session.commit()
+			invalidate('shows', 'venues', 'venue:{}'.format(show.venue_id), 'artist:{}'.format(show.artist_id))
 			
 		except Exception as e:
 			error = True
@@ -495,6 +399,43 @@ def create_show_submission():
 	
 	return render_template('pages/home.html')
 
+@app.route('/shows/bulk', methods=['POST'])
+def create_shows_bulk():
+	# schedules many shows at once from CSV, a JSON array or a recurrence rule
+	try:
+		rows = parse_schedule(request.get_data(), request.content_type or '')
+	except ScheduleError as e:
+		return jsonify({
+			"success": False,
+			"error": 400,
+			"message": str(e)
+		}), 400
+
+	report = schedule_shows(rows)
+	if report['created']:
+		# rejected rows only cost a needless invalidation
+		tags = set()
+		for row in rows:
+			if isinstance(row, dict):
+				tags.add('venue:{}'.format(row.get('venue_id')))
+				tags.add('artist:{}'.format(row.get('artist_id')))
+		invalidate('shows', 'venues', *tags)
+	return jsonify({
+		"success": not report['errors'],
+		"created": report['created'],
+		"errors": report['errors']
+	})
+
+@app.route('/metrics/cache')
+def cache_metrics():
+	# hit rate and memory use of this worker's response cache
+	return jsonify(cache_stats())
+
+@app.route('/metrics/pool')
+def pool_metrics():
+	# connection pool usage and checkout latency of this worker
+	return jsonify(pool_stats(db.engine))
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
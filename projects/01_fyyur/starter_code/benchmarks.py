@@ -0,0 +1,181 @@
+import time
+import timeit
+from datetime import datetime, timedelta
+import babel.dates
+import dateutil.parser
+
+from filters import format_datetime, datetime_cache_info, datetime_cache_clear
+from models import db, Venue, Artist, Show, rebuild_show_counts
+from scheduling import schedule_shows
+import cache
+
+#----------------------------------------------------------------------------#
+# Fixtures.
+#----------------------------------------------------------------------------#
+
+CITIES = [('San Francisco', 'CA'), ('New York', 'NY'), ('Austin', 'TX'), ('Seattle', 'WA')]
+
+def seed_catalog(num_venues=1000, num_artists=1000, shows_per_venue=10, now=None):
+    '''
+    Fills an empty database with venues, artists and a mix of past and
+    upcoming shows. Must run inside an app context.
+    '''
+    if now is None:
+        now = datetime.now()
+    venues = [Venue(
+        name='Venue {}'.format(i),
+        city=CITIES[i % len(CITIES)][0],
+        state=CITIES[i % len(CITIES)][1],
+        address='{} Main St'.format(i),
+        phone='123-123-1234',
+        genres=['Jazz']
+    ) for i in range(num_venues)]
+    artists = [Artist(
+        name='Artist {}'.format(i),
+        city=CITIES[i % len(CITIES)][0],
+        state=CITIES[i % len(CITIES)][1],
+        phone='326-123-5000',
+        genres=['Rock n Roll']
+    ) for i in range(num_artists)]
+    db.session.add_all(venues)
+    db.session.add_all(artists)
+    db.session.flush()
+
+    shows = []
+    for i, venue in enumerate(venues):
+        for j in range(shows_per_venue):
+            shows.append({
+                'venue_id': venue.id,
+                'artist_id': artists[(i + j) % num_artists].id,
+                'start_time': now + timedelta(days=j - shows_per_venue // 2, hours=i % 24)
+            })
+    db.session.bulk_insert_mappings(Show, shows)
+    db.session.commit()
+    # bulk inserts skip the Show mapper events that maintain the counts
+    rebuild_show_counts()
+
+#----------------------------------------------------------------------------#
+# Benchmarks.
+# Run through manage.py, e.g. "python manage.py bench_filters".
+#----------------------------------------------------------------------------#
+
+def legacy_format_datetime(value, format='medium'):
+    # the datetime filter as it was before filters.py, kept for comparison
+    date = dateutil.parser.parse(value)
+    if format == 'full':
+        format="EEEE MMMM, d, y 'at' h:mma"
+    elif format == 'medium':
+        format="EE MM, dd, y h:mma"
+    return babel.dates.format_datetime(date, format)
+
+def bench_filters(rows=5000, distinct=200, repeat=5):
+    '''
+    Renders rows show times (distinct unique values) through the original
+    and the cached datetime filter and prints the best of repeat runs.
+    '''
+    start = datetime(2021, 1, 1, 20, 0)
+    start_times = [start + timedelta(hours=i % distinct) for i in range(rows)]
+
+    legacy = min(timeit.repeat(
+        lambda: [legacy_format_datetime(str(value), 'full') for value in start_times],
+        number=1, repeat=repeat))
+    datetime_cache_clear()
+    cached = min(timeit.repeat(
+        lambda: [format_datetime(value, 'full') for value in start_times],
+        number=1, repeat=repeat))
+
+    print('datetime filter, {} rows, {} distinct start times'.format(rows, distinct))
+    print('  legacy: {:.4f}s'.format(legacy))
+    print('  cached: {:.4f}s ({:.1f}x)'.format(cached, legacy / cached))
+    print('  {}'.format(datetime_cache_info()))
+    return legacy, cached
+
+def bench_bulk_shows(rows=10000):
+    '''
+    Schedules rows shows through schedule_shows and prints the throughput.
+    Needs at least one venue and artist in the configured database and
+    leaves the new shows in place.
+    '''
+    venue_id = db.session.query(Venue.id).limit(1).scalar()
+    artist_id = db.session.query(Artist.id).limit(1).scalar()
+    start = datetime.now() + timedelta(days=365)
+    shows = [{
+        'artist_id': artist_id,
+        'venue_id': venue_id,
+        'start_time': start + timedelta(hours=i)
+    } for i in range(rows)]
+
+    started = time.perf_counter()
+    report = schedule_shows(shows)
+    elapsed = time.perf_counter() - started
+
+    print('bulk scheduling, {} rows'.format(rows))
+    print('  {} created in {:.3f}s ({:.0f} shows/s)'.format(report['created'], elapsed, report['created'] / elapsed))
+    return elapsed
+
+# read pages hit by bench_pages, ids refer to rows made by seed_catalog
+READ_PAGES = ['/venues', '/artists', '/shows', '/venues/1', '/artists/1']
+
+def bench_pages(requests=2000, threads=8):
+    '''
+    Requests the read pages round robin from threads test clients, once
+    with the response cache off and once with it on, and prints the
+    throughput and the cache stats.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from app import app
+
+    def run():
+        def worker(n):
+            client = app.test_client()
+            for i in range(n):
+                client.get(READ_PAGES[i % len(READ_PAGES)])
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(worker, [requests // threads] * threads))
+        return requests / (time.perf_counter() - started)
+
+    backend = cache.response_cache
+    try:
+        cache.response_cache = None
+        uncached = run()
+        cache.response_cache = cache.MemoryCache()
+        cached = run()
+        stats = cache.cache_stats()
+    finally:
+        cache.response_cache = backend
+
+    print('read pages, {} requests over {} threads'.format(requests, threads))
+    print('  uncached: {:.0f} req/s'.format(uncached))
+    print('  cached:   {:.0f} req/s ({:.1f}x)'.format(cached, cached / uncached))
+    print('  {}'.format(stats))
+    return uncached, cached
+
+def bench_pool(requests=2000, threads=32):
+    '''
+    Sends uncached read requests from more threads than the pool has
+    connections and prints throughput and the pool metrics.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from app import app
+    from db_pool import pool_stats
+
+    per_thread = requests // threads
+
+    def worker(thread):
+        client = app.test_client()
+        for i in range(thread * per_thread, (thread + 1) * per_thread):
+            # distinct query strings bypass the response cache
+            client.get('{}?bench={}'.format(READ_PAGES[i % len(READ_PAGES)], i))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+    with app.app_context():
+        stats = pool_stats(db.engine)
+
+    print('pool stress, {} requests over {} threads'.format(requests, threads))
+    print('  {:.0f} req/s'.format(requests / elapsed))
+    print('  {}'.format(stats))
+    return stats
@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request, session
+
+#----------------------------------------------------------------------------#
+# Response cache.
+# Read pages are cached by path and tagged with the entities they show,
+# e.g. 'venues' or 'artist:4'. Write handlers call invalidate() with the
+# tags they touch.
+#----------------------------------------------------------------------------#
+
+# set by init_cache(), None while caching is off
+response_cache = None
+
+class MemoryCache(object):
+    '''
+    In-process LRU cache whose entries expire ttl seconds after they are
+    stored. Each gunicorn worker holds its own copy, so invalidations only
+    reach the worker that handled the write; use RedisCache to share one.
+    '''
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, body, tags)
+        self.tags = {}  # tag -> keys
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, body, tags=()):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, body, tuple(tags))
+            self.bytes += len(body)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    if key in self.entries:
+                        self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        expires, body, tags = self.entries.pop(key)
+        self.bytes -= len(body)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'memory',
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
+
+class RedisCache(object):
+    '''
+    Same interface as MemoryCache on top of a Redis compatible server, so
+    every worker shares one cache. Needs the redis package.
+    '''
+    def __init__(self, url, ttl=300, prefix='fyyur:cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        body = self.client.get(self.prefix + key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, body, tags=()):
+        pipe = self.client.pipeline()
+        pipe.setex(self.prefix + key, self.ttl, body)
+        for tag in tags:
+            pipe.sadd(self.prefix + 'tag:' + tag, key)
+            pipe.expire(self.prefix + 'tag:' + tag, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [self.prefix + key.decode('utf-8') for key in self.client.smembers(tag_key)]
+            self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        memory = self.client.info('memory')
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': sum(1 for _ in self.client.scan_iter(self.prefix + '/*')),
+            'bytes': memory.get('used_memory', 0)
+        }
+
+def init_cache(app):
+    '''
+    Sets up the cache named by the CACHE_BACKEND setting:
+    'memory', 'redis' or 'none'.
+    '''
+    global response_cache
+    backend = app.config.get('CACHE_BACKEND', 'memory')
+    ttl = app.config.get('CACHE_TTL', 300)
+    if backend == 'memory':
+        response_cache = MemoryCache(app.config.get('CACHE_MAX_ENTRIES', 1024), ttl)
+    elif backend == 'redis':
+        response_cache = RedisCache(app.config['CACHE_REDIS_URL'], ttl)
+    else:
+        response_cache = None
+    return response_cache
+
+def cached(*tags):
+    '''
+    Caches the body of a GET view under its full path. tags may refer to
+    the view's arguments, e.g. 'venue:{venue_id}', and the view can add
+    more while it runs with tag().
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # a page rendered with pending flash messages is not cacheable
+            if response_cache is None or request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+            key = request.full_path
+            body = response_cache.get(key)
+            if body is not None:
+                return Response(body, mimetype='text/html')
+
+            g.cache_tags = {tag.format(**kwargs) for tag in tags}
+            rv = f(*args, **kwargs)
+            if isinstance(rv, str):
+                response_cache.set(key, rv.encode('utf-8'), g.cache_tags)
+            return rv
+        return wrapper
+    return decorator
+
+def tag(*tags):
+    '''
+    Adds tags to the page the current cached view is rendering.
+    '''
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+def invalidate(*tags):
+    '''
+    Drops every cached page carrying any of tags.
+    '''
+    if response_cache is not None:
+        response_cache.invalidate(*tags)
+
+def cache_stats():
+    return response_cache.stats() if response_cache is not None else {'backend': 'none'}
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from flask import current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+#----------------------------------------------------------------------------#
+# Connection pool.
+# Engine options come from the DB_* settings in config.py and every pool
+# keeps its own checkout metrics, so each gunicorn worker reports its own.
+#----------------------------------------------------------------------------#
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that records how long checkouts wait, how often they time
+    out and how many connections had to be opened past pool_size.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+        self.checkout_timeouts = 0
+        self.overflow_connects = 0
+        event.listen(self, 'connect', self.on_connect)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedQueuePool, self).connect()
+        except TimeoutError:
+            with self.metrics_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self.metrics_lock:
+                self.checkouts += 1
+                self.checkout_seconds += waited
+                self.max_checkout_seconds = max(self.max_checkout_seconds, waited)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        # overflow() turns positive once connections beyond pool_size are open
+        if self.overflow() > 0:
+            with self.metrics_lock:
+                self.overflow_connects += 1
+
+    def stats(self):
+        with self.metrics_lock:
+            return {
+                'pid': os.getpid(),
+                'pool_size': self.size(),
+                'active': self.checkedout(),
+                'idle': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'overflow_connects': self.overflow_connects,
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'avg_checkout_ms': 1000 * self.checkout_seconds / self.checkouts if self.checkouts else 0.0,
+                'max_checkout_ms': 1000 * self.max_checkout_seconds
+            }
+
+def configure_engine_options(config, sa_url, options):
+    '''
+    Adds the pool settings to the create_engine options of sa_url. In-memory SQLite keeps its single shared connection.
+    '''
+    if sa_url.drivername.startswith('sqlite'):
+        if sa_url.database in (None, '', ':memory:'):
+            return
+        # file databases can share connections across request threads
+        options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    options['poolclass'] = InstrumentedQueuePool
+    options['pool_size'] = config.get('DB_POOL_SIZE', 5)
+    options['max_overflow'] = config.get('DB_MAX_OVERFLOW', 10)
+    options['pool_timeout'] = config.get('DB_POOL_TIMEOUT', 30)
+    options['pool_recycle'] = config.get('DB_POOL_RECYCLE', 1800)
+    options['pool_pre_ping'] = config.get('DB_POOL_PRE_PING', True)
+
+def set_statement_timeout(session, transaction, connection):
+    '''
+    Limits the Postgres statements of a transaction begun while serving a
+    request to DB_STATEMENT_TIMEOUT_MS. SET LOCAL ends with the
+    transaction, so migrations and manage.py commands run without it.
+    '''
+    if not has_request_context() or connection.dialect.name != 'postgresql':
+        return
+    timeout = current_app.config.get('DB_STATEMENT_TIMEOUT_MS')
+    if timeout:
+        connection.execute(text('SET LOCAL statement_timeout = {:d}'.format(int(timeout))))
+
+class PooledSQLAlchemy(SQLAlchemy):
+    '''
+    SQLAlchemy extension whose engines use the configured, instrumented
+    pool, and whose request transactions have a statement timeout.
+    '''
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super(PooledSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        configure_engine_options(app.config, sa_url, options)
+        return rv
+
+    def create_scoped_session(self, options=None):
+        session = super(PooledSQLAlchemy, self).create_scoped_session(options)
+        event.listen(session, 'after_begin', set_statement_timeout)
+        return session
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'pid': os.getpid(), 'pool': type(pool).__name__}
@@ -0,0 +1,115 @@
+import os
+import re
+import sys
+from sqlalchemy import event
+
+from app import app, db
+from benchmarks import seed_catalog
+
+#----------------------------------------------------------------------------#
+# EXPLAIN checker.
+# Seeds a scratch database, records the SQL the read pages really issue and
+# fails if any of it is planned as a sequential scan.
+#
+#   python explain_check.py [database_url]
+#
+# The database is dropped and recreated, never point this at real data.
+#----------------------------------------------------------------------------#
+
+DEFAULT_DATABASE_URL = 'postgres://localhost:5432/fyyur_explain'
+
+# read pages whose queries are checked, as (method, path, form)
+PAGES = [
+    ('GET', '/venues', None),
+    ('POST', '/venues/search', {'search_term': 'Venue 12'}),
+    ('POST', '/artists/search', {'search_term': 'Artist 12'}),
+    ('GET', '/venues/1', None),
+    ('GET', '/artists/1', None),
+    ('GET', '/shows', None),
+    # the second /shows page exercises the keyset predicate
+    ('GET', '/shows?after=2000-01-01T00:00:00,0', None),
+    ('GET', '/artists', None),
+]
+
+# pages whose sequential scans are expected, with the reason
+KNOWN_SCANS = {
+    '/artists': 'lists every artist, reading the whole table is the cheapest plan',
+}
+
+# postgres: "Seq Scan on "Show"", sqlite: "SCAN Show" without an index
+SEQ_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\S+)'),
+    'sqlite': re.compile(r'^SCAN (\S+)$'),
+}
+
+def record_statements(client):
+    '''
+    Requests every page in PAGES, failing unless each returns 200, and
+    returns the distinct (statement, parameters, path) triples they executed.
+    '''
+    statements = []
+    path = None
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters, path))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for method, path, form in PAGES:
+            res = client.open(path, method=method, data=form)
+            if res.status_code != 200:
+                raise RuntimeError('{} {} returned {}'.format(method, path, res.status_code))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    unique = []
+    for statement in statements:
+        if statement[0] not in [seen for seen, _, _ in unique]:
+            unique.append(statement)
+    return unique
+
+def explain(connection, dialect, statement, parameters):
+    cursor = connection.connection.cursor()
+    if dialect == 'postgresql':
+        # with seq scans priced out the planner only picks one if no index applies
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        return [row[0] for row in cursor.fetchall()]
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    return [row[-1] for row in cursor.fetchall()]
+
+def check(database_url):
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['TESTING'] = True
+    failures = 0
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_catalog()
+        dialect = db.engine.dialect.name
+        statements = record_statements(app.test_client())
+        with db.engine.connect() as connection:
+            for statement, parameters, path in statements:
+                plan = explain(connection, dialect, statement, parameters)
+                # subqueries and fts5 tables show up as scans too, only tables count
+                scans = [match.group(1) for line in plan
+                         for match in [SEQ_SCAN[dialect].search(line.strip())]
+                         if match and match.group(1).strip('"') in db.metadata.tables]
+                known = scans and path in KNOWN_SCANS
+                print('{} {}'.format('FAIL' if scans and not known else 'ok  ', ' '.join(statement.split())[:120]))
+                if known:
+                    print('      known scan on {}: {}'.format(path, KNOWN_SCANS[path]))
+                for line in plan:
+                    print('      ' + line)
+                failures += bool(scans) and not known
+        db.session.remove()
+        db.drop_all()
+
+    print('{} of {} queries fall back to a sequential scan'.format(failures, len(statements)))
+    return failures
+
+if __name__ == '__main__':
+    database_url = sys.argv[1] if len(sys.argv) > 1 else \
+        os.environ.get('FYYUR_EXPLAIN_DATABASE_URL', DEFAULT_DATABASE_URL)
+    sys.exit(1 if check(database_url) else 0)
@@ -0,0 +1,52 @@
+from datetime import datetime
+from functools import lru_cache
+import babel
+import babel.dates
+import dateutil.parser
+
+#----------------------------------------------------------------------------#
+# Datetime filter.
+#----------------------------------------------------------------------------#
+
+# Babel patterns behind the named formats of the datetime filter
+DATETIME_FORMATS = {
+    'full': "EEEE MMMM, d, y 'at' h:mma",
+    'medium': "EE MM, dd, y h:mma",
+}
+
+# how many formatted (timestamp, format, locale) strings to keep
+DATETIME_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=None)
+def compile_format(format, locale):
+    '''
+    Parses a named or custom Babel pattern and its locale once.
+    '''
+    pattern = babel.dates.parse_pattern(DATETIME_FORMATS.get(format, format))
+    return pattern, babel.Locale.parse(locale)
+
+@lru_cache(maxsize=DATETIME_CACHE_SIZE)
+def _format_datetime(value, format, locale):
+    pattern, locale = compile_format(format, locale)
+    # like babel.dates.format_datetime without tzinfo: times are printed as
+    # stored, whatever the server's timezone
+    return pattern.apply(value, locale)
+
+def format_datetime(value, format='medium', locale=babel.dates.LC_TIME):
+    '''
+    Jinja datetime filter. Takes datetime objects as is and only parses
+    strings, then serves repeated (timestamp, format, locale) lookups
+    from a bounded LRU cache.
+    '''
+    if not isinstance(value, datetime):
+        value = dateutil.parser.parse(value)
+    return _format_datetime(value, format, str(locale))
+
+def datetime_cache_info():
+    '''
+    Hit, miss and size counters of the formatted string cache.
+    '''
+    return _format_datetime.cache_info()
+
+def datetime_cache_clear():
+    _format_datetime.cache_clear()
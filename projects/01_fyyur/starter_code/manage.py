@@ -1,10 +1,46 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 from app import app, db
+from models import rollover_show_counts, rebuild_show_counts
+import benchmarks
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+@manager.command
+def rollover_counts():
+    '''Moves shows that have started from the upcoming to the past counts, run periodically'''
+    moved = rollover_show_counts()
+    print('{} shows moved from upcoming to past'.format(moved))
+
+@manager.command
+def rebuild_counts():
+    '''Recounts every venue's and artist's shows and reports any drift'''
+    drift = rebuild_show_counts()
+    for name, row_id, stored, actual in drift:
+        print('{} {}: stored upcoming/past {}/{}, actual {}/{}'.format(name, row_id, *(stored + actual)))
+    print('{} rows rebuilt'.format(len(drift)))
+
+@manager.command
+def bench_filters():
+    '''Compares the cached datetime filter against the original one'''
+    benchmarks.bench_filters()
+
+@manager.command
+def bench_pages():
+    '''Load tests the read pages with and without the response cache'''
+    benchmarks.bench_pages()
+
+@manager.command
+def bench_pool():
+    '''Stress tests the connection pool with concurrent requests'''
+    benchmarks.bench_pool()
+
+@manager.command
+def bench_bulk_shows():
+    '''Measures bulk show scheduling throughput'''
+    benchmarks.bench_bulk_shows()
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
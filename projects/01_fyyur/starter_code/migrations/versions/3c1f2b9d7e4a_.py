@@ -0,0 +1,59 @@
+"""add name search indexes
+
+Revision ID: 3c1f2b9d7e4a
+Revises: a58e3ef83077
+Create Date: 2021-02-03 10:12:44.918231
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f2b9d7e4a'
+down_revision = 'a58e3ef83077'
+branch_labels = None
+depends_on = None
+
+SEARCH_TABLES = [
+    ('Venue', 'venue_search'),
+    ('Artist', 'artist_search'),
+]
+
+
+def sqlite_search_ddl(table, search_table):
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {1} USING fts5("
+        "name, content='{0}', content_rowid='id', tokenize='trigram')",
+        'CREATE TRIGGER IF NOT EXISTS {1}_ai AFTER INSERT ON "{0}" BEGIN '
+        "INSERT INTO {1}(rowid, name) VALUES (new.id, new.name); END",
+        'CREATE TRIGGER IF NOT EXISTS {1}_ad AFTER DELETE ON "{0}" BEGIN '
+        "INSERT INTO {1}({1}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        'CREATE TRIGGER IF NOT EXISTS {1}_au AFTER UPDATE OF name ON "{0}" BEGIN '
+        "INSERT INTO {1}({1}, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO {1}(rowid, name) VALUES (new.id, new.name); END",
+        # index the rows that already exist
+        "INSERT INTO {1}({1}) VALUES ('rebuild')",
+    ]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, search_table in SEARCH_TABLES:
+        op.create_index('ix_{}_name_trgm'.format(table), table, ['name'],
+                        postgresql_using='gin',
+                        postgresql_ops={'name': 'gin_trgm_ops'})
+        if dialect == 'sqlite':
+            for statement in sqlite_search_ddl(table, search_table):
+                op.execute(statement.format(table, search_table))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, search_table in SEARCH_TABLES:
+        if dialect == 'sqlite':
+            for trigger in ('ai', 'ad', 'au'):
+                op.execute('DROP TRIGGER IF EXISTS {}_{}'.format(search_table, trigger))
+            op.execute('DROP TABLE IF EXISTS {}'.format(search_table))
+        op.drop_index('ix_{}_name_trgm'.format(table), table_name=table)
@@ -1,4 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
+from db_pool import PooledSQLAlchemy
+from sqlalchemy import DDL, event
 from datetime import datetime
 from flask_migrate import Migrate
 import dateutil.parser
@@ -9,19 +11,33 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 
 #connect to a local postgresql database
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
 def db_setup(app):
     app.config.from_object('config')
     db.app = app
     db.init_app(app)
     migrate = Migrate(app, db)
     return db
+
+# number of venues or artists per search results page
+SEARCH_RESULTS_PER_PAGE = 20
+
+# number of shows per /shows page, overridable with the SHOWS_PER_PAGE setting
+SHOWS_PER_PAGE = 30
+
+# the trigram name indexes need pg_trgm on postgres
+event.listen(db.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
 class Venue(db.Model):
 	__tablename__ = 'Venue'
+	__table_args__ = (
+		db.Index('ix_Venue_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+		db.Index('ix_Venue_state_city_name', 'state', 'city', 'name'),
+	)
 
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(), nullable=False)
@@ -34,11 +50,16 @@ class Venue(db.Model):
 	website = db.Column(db.String(), nullable=True)
 	seeking_talent = db.Column(db.Boolean, nullable=False, default=False)
 	seeking_description = db.Column(db.String(), nullable=True)
-	shows = db.relationship('Show', backref='Venue', lazy=True)
+	upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	shows = db.relationship('Show', backref='Venue', lazy=True, cascade='all, delete-orphan')
 	genres = db.Column(db.ARRAY(db.String(120)), nullable=False)
 
 class Artist(db.Model):
 	__tablename__ = 'Artist'
+	__table_args__ = (
+		db.Index('ix_Artist_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+	)
 
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String)
@@ -51,13 +72,369 @@ class Artist(db.Model):
 	website = db.Column(db.String(120), nullable=True)
 	seeking_venue = db.Column(db.Boolean, nullable=False, default=False)
 	seeking_description = db.Column(db.String(), nullable=True)
+	upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 	past_shows = db.relationship('Show', backref='Artist', lazy=True)
 	genres = db.Column(db.ARRAY(db.String(120)), nullable=False)
 
 class Show(db.Model):
   __tablename__ = 'Show'
+  __table_args__ = (
+    db.Index('ix_Show_venue_id_start_time', 'venue_id', 'start_time'),
+    db.Index('ix_Show_artist_id_start_time', 'artist_id', 'start_time'),
+    db.Index('ix_Show_start_time_id', 'start_time', 'id'),
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   start_time = db.Column(db.DateTime, default=datetime.now, nullable=False)
   venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
-  artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)
\ No newline at end of file
+  artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)
+
+class ShowCountRollover(db.Model):
+  __tablename__ = 'ShowCountRollover'
+
+  # single row: the stored show counts split past and upcoming at this time
+  id = db.Column(db.Integer, primary_key=True)
+  rolled_over_at = db.Column(db.DateTime, nullable=False)
+
+#----------------------------------------------------------------------------#
+# Show counts.
+# Venue and Artist carry materialized upcoming/past show counts. They are
+# split at ShowCountRollover.rolled_over_at rather than at now(), which
+# rollover_show_counts() moves forward periodically.
+#----------------------------------------------------------------------------#
+
+def rolled_over_at(connection):
+    table = ShowCountRollover.__table__
+    value = connection.execute(db.select([table.c.rolled_over_at]).where(table.c.id == 1)).scalar()
+    if value is None:
+        value = datetime.now()
+        connection.execute(table.insert().values(id=1, rolled_over_at=value))
+    return value
+
+def adjust_show_counts(connection, shows, delta=1):
+    '''
+    Adds delta to the counts of the venues and artists of shows, a list of
+    dicts with venue_id, artist_id and start_time. One UPDATE per table.
+    '''
+    cutoff = rolled_over_at(connection)
+    for model, fk in ((Venue, 'venue_id'), (Artist, 'artist_id')):
+        changes = {}
+        for show in shows:
+            upcoming, past = changes.get(show[fk], (0, 0))
+            if show['start_time'] > cutoff:
+                upcoming += delta
+            else:
+                past += delta
+            changes[show[fk]] = (upcoming, past)
+        if not changes:
+            continue
+        table = model.__table__
+        connection.execute(
+            table.update().where(table.c.id == db.bindparam('row_id')).values(
+                upcoming_shows_count=table.c.upcoming_shows_count + db.bindparam('upcoming'),
+                past_shows_count=table.c.past_shows_count + db.bindparam('past')),
+            [{'row_id': row_id, 'upcoming': upcoming, 'past': past}
+             for row_id, (upcoming, past) in changes.items()])
+
+def show_values(show, history=False):
+    '''
+    The counted columns of show, or their values before the pending update.
+    '''
+    values = {}
+    for key in ('venue_id', 'artist_id', 'start_time'):
+        value = getattr(show, key)
+        if history:
+            deleted = db.inspect(show).attrs[key].history.deleted
+            if deleted:
+                value = deleted[0]
+        values[key] = value
+    return values
+
+@event.listens_for(Show, 'after_insert')
+def count_inserted_show(mapper, connection, show):
+    adjust_show_counts(connection, [show_values(show)], 1)
+
+@event.listens_for(Show, 'after_delete')
+def count_deleted_show(mapper, connection, show):
+    adjust_show_counts(connection, [show_values(show, history=True)], -1)
+
+@event.listens_for(Show, 'after_update')
+def count_updated_show(mapper, connection, show):
+    before = show_values(show, history=True)
+    after = show_values(show)
+    if before != after:
+        adjust_show_counts(connection, [before], -1)
+        adjust_show_counts(connection, [after], 1)
+
+def rollover_show_counts(now=None):
+    '''
+    Moves the shows that started since the last rollover from the
+    upcoming to the past counts. Only venues and artists with such shows
+    are touched. Returns the number of shows moved.
+    '''
+    if now is None:
+        now = datetime.now()
+    connection = db.session.connection()
+    cutoff = rolled_over_at(connection)
+    if now <= cutoff:
+        return 0
+    started = db.and_(Show.start_time > cutoff, Show.start_time <= now)
+    moved = db.session.query(db.func.count(Show.id)).filter(started).scalar()
+    for model, fk in ((Venue, Show.venue_id), (Artist, Show.artist_id)):
+        table = model.__table__
+        count = db.select([db.func.count(Show.id)]).where(db.and_(fk == table.c.id, started)).as_scalar()
+        connection.execute(
+            table.update().where(table.c.id.in_(db.select([fk]).where(started))).values(
+                upcoming_shows_count=table.c.upcoming_shows_count - count,
+                past_shows_count=table.c.past_shows_count + count))
+    connection.execute(ShowCountRollover.__table__.update().values(rolled_over_at=now))
+    db.session.commit()
+    return moved
+
+def rebuild_show_counts(now=None):
+    '''
+    Recounts every venue's and artist's shows from scratch, split at now,
+    and fixes the rows whose stored counts drifted.
+    Returns a list of (model name, id, stored counts, actual counts).
+    '''
+    if now is None:
+        now = datetime.now()
+    connection = db.session.connection()
+    rolled_over_at(connection)
+    connection.execute(ShowCountRollover.__table__.update().values(rolled_over_at=now))
+    drift = []
+    for model, fk in ((Venue, Show.venue_id), (Artist, Show.artist_id)):
+        rows = db.session.query(
+            model.id,
+            model.upcoming_shows_count,
+            model.past_shows_count,
+            db.func.count(Show.id).filter(Show.start_time > now),
+            db.func.count(Show.id).filter(Show.start_time <= now)
+        ).outerjoin(Show, fk == model.id).group_by(model.id).all()
+        fixes = []
+        for row_id, upcoming, past, actual_upcoming, actual_past in rows:
+            if (upcoming, past) != (actual_upcoming, actual_past):
+                drift.append((model.__name__, row_id, (upcoming, past), (actual_upcoming, actual_past)))
+                fixes.append({'row_id': row_id, 'upcoming': actual_upcoming, 'past': actual_past})
+        if fixes:
+            table = model.__table__
+            connection.execute(
+                table.update().where(table.c.id == db.bindparam('row_id')).values(
+                    upcoming_shows_count=db.bindparam('upcoming'),
+                    past_shows_count=db.bindparam('past')),
+                fixes)
+    db.session.commit()
+    return drift
+
+#----------------------------------------------------------------------------#
+# Search.
+#----------------------------------------------------------------------------#
+
+# sqlite has no pg_trgm, so names are mirrored into fts5 trigram tables
+SEARCH_TABLES = {
+    Venue: 'venue_search',
+    Artist: 'artist_search',
+}
+
+def sqlite_search_ddl(table, search_table):
+    '''
+    Statements creating the fts5 shadow table for table.name and the
+    triggers that keep it in sync with inserts, updates and deletes.
+    '''
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {1} USING fts5("
+        "name, content='{0}', content_rowid='id', tokenize='trigram')",
+        'CREATE TRIGGER IF NOT EXISTS {1}_ai AFTER INSERT ON "{0}" BEGIN '
+        "INSERT INTO {1}(rowid, name) VALUES (new.id, new.name); END",
+        'CREATE TRIGGER IF NOT EXISTS {1}_ad AFTER DELETE ON "{0}" BEGIN '
+        "INSERT INTO {1}({1}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        'CREATE TRIGGER IF NOT EXISTS {1}_au AFTER UPDATE OF name ON "{0}" BEGIN '
+        "INSERT INTO {1}({1}, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO {1}(rowid, name) VALUES (new.id, new.name); END",
+    ]
+
+for model, search_table in SEARCH_TABLES.items():
+    for statement in sqlite_search_ddl(model.__tablename__, search_table):
+        event.listen(model.__table__, 'after_create',
+            DDL(statement.format(model.__tablename__, search_table)).execute_if(dialect='sqlite'))
+    event.listen(model.__table__, 'before_drop',
+        DDL('DROP TABLE IF EXISTS ' + search_table).execute_if(dialect='sqlite'))
+
+def search(model, search_term, page=1, per_page=SEARCH_RESULTS_PER_PAGE):
+    '''
+    Case-insensitive partial name search over Venue or Artist.
+    Matches are ranked, paginated and carry their upcoming show count,
+    all from one indexed query.
+    '''
+    query = db.session.query(
+        model.id,
+        model.name,
+        model.upcoming_shows_count.label('num_upcoming_shows'),
+        db.func.count().over().label('total')
+    )
+
+    search_term = search_term.strip()
+    dialect = db.engine.dialect.name
+    if not search_term:
+        query = query.order_by(model.name, model.id)
+    elif dialect == 'sqlite' and len(search_term) >= 3:
+        # the trigram tokenizer only matches terms of three or more characters
+        search_table = db.table(SEARCH_TABLES[model], db.column('rowid'), db.column('rank'))
+        phrase = '"{}"'.format(search_term.replace('"', '""'))
+        query = query.join(search_table, search_table.c.rowid == model.id) \
+            .filter(db.literal_column(SEARCH_TABLES[model]).op('MATCH')(phrase)) \
+            .order_by(search_table.c.rank, model.name, model.id)
+    else:
+        pattern = '%{}%'.format(search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        query = query.filter(model.name.ilike(pattern, escape='\\'))
+        if dialect == 'postgresql':
+            query = query.order_by(db.func.similarity(model.name, search_term).desc(), model.name, model.id)
+        else:
+            query = query.order_by(model.name, model.id)
+
+    rows = query.limit(per_page).offset((page - 1) * per_page).all()
+    if rows:
+        count = rows[0].total
+    elif page > 1:
+        # past the last page there is no row to read the total from
+        count = query.order_by(None).count()
+    else:
+        count = 0
+
+    return {
+        "count": count,
+        "data": [{
+            "id": row.id,
+            "name": row.name,
+            "num_upcoming_shows": row.num_upcoming_shows
+        } for row in rows]
+    }
+
+#----------------------------------------------------------------------------#
+# Queries.
+#----------------------------------------------------------------------------#
+
+def venue_areas():
+    '''
+    Builds the area -> venue -> upcoming show count tree for /venues
+    with one query, regardless of how many venues there are.
+    '''
+    rows = db.session.query(
+        Venue.state,
+        Venue.city,
+        Venue.id,
+        Venue.name,
+        Venue.upcoming_shows_count.label('num_upcoming_shows')
+    ).order_by(Venue.state, Venue.city, Venue.name, Venue.id).all()
+
+    # rows arrive sorted by area, so each area is emitted exactly once
+    areas = []
+    for row in rows:
+        if not areas or (areas[-1]['state'], areas[-1]['city']) != (row.state, row.city):
+            areas.append({
+                "city": row.city,
+                "state": row.state,
+                "venues": []
+            })
+        areas[-1]['venues'].append({
+            "id": row.id,
+            "name": row.name,
+            "num_upcoming_shows": row.num_upcoming_shows
+        })
+    return areas
+
+def show_detail(model, entity_id, now=None):
+    '''
+    Loads a venue or artist together with all of its shows and each
+    show's artist or venue in one query, then splits the shows into
+    past and upcoming in a single pass.
+    Returns (entity, past_shows, upcoming_shows).
+    '''
+    if model is Venue:
+        shows_attr, counterpart = Venue.shows, 'Artist'
+    else:
+        shows_attr, counterpart = Artist.past_shows, 'Venue'
+    entity = model.query.options(
+        db.joinedload(shows_attr).joinedload(getattr(Show, counterpart))
+    ).filter(model.id == entity_id).first_or_404()
+
+    if now is None:
+        now = datetime.now()
+    prefix = counterpart.lower()
+    past_shows = []
+    upcoming_shows = []
+    for show in sorted(getattr(entity, shows_attr.key), key=lambda show: show.start_time):
+        other = getattr(show, counterpart)
+        shows = upcoming_shows if show.start_time > now else past_shows
+        shows.append({
+            prefix + "_id": other.id,
+            prefix + "_name": other.name,
+            prefix + "_image_link": other.image_link,
+            "start_time": show.start_time
+        })
+    return entity, past_shows, upcoming_shows
+
+def show_rows():
+    '''
+    Shows joined to the artist and venue names and images the listing
+    needs, in (start_time, id) keyset order.
+    '''
+    return db.session.query(
+        Show.id,
+        Show.start_time,
+        Show.venue_id,
+        Venue.name.label('venue_name'),
+        Show.artist_id,
+        Artist.name.label('artist_name'),
+        Artist.image_link.label('artist_image_link')
+    ).join(Venue, Show.venue_id == Venue.id) \
+        .join(Artist, Show.artist_id == Artist.id) \
+        .order_by(Show.start_time, Show.id)
+
+def show_listing(row):
+    return {
+        "venue_id": row.venue_id,
+        "venue_name": row.venue_name,
+        "artist_id": row.artist_id,
+        "artist_name": row.artist_name,
+        "artist_image_link": row.artist_image_link,
+        "start_time": row.start_time
+    }
+
+def encode_cursor(start_time, show_id):
+    return '{},{}'.format(start_time.isoformat(), show_id)
+
+def decode_cursor(cursor):
+    '''
+    Inverse of encode_cursor, raises ValueError on a malformed cursor.
+    '''
+    start_time, show_id = cursor.rsplit(',', 1)
+    return datetime.fromisoformat(start_time), int(show_id)
+
+def shows_page(after=None, per_page=SHOWS_PER_PAGE):
+    '''
+    One keyset page of shows. after is the decoded cursor of the last
+    show on the previous page, so deep pages cost the same as the first.
+    Returns (shows, next_cursor), next_cursor being None on the last page.
+    '''
+    query = show_rows()
+    if after is not None:
+        start_time, show_id = after
+        query = query.filter(db.tuple_(Show.start_time, Show.id) > db.tuple_(
+            db.literal(start_time, Show.start_time.type), db.literal(show_id, Show.id.type)))
+    # one extra row tells whether there is a next page
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].start_time, rows[-1].id)
+    return [show_listing(row) for row in rows], next_cursor
+
+def iter_shows(batch_size=1000):
+    '''
+    Yields every show listing while reading the cursor batch_size rows
+    at a time, so memory stays flat however many shows there are.
+    '''
+    for row in show_rows().yield_per(batch_size):
+        yield show_listing(row)
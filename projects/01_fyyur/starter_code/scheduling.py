@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+from datetime import datetime
+import dateutil.parser
+from dateutil.rrule import rrulestr
+
+from models import db, Venue, Artist, Show, adjust_show_counts
+
+#----------------------------------------------------------------------------#
+# Bulk show scheduling.
+#----------------------------------------------------------------------------#
+
+# most rows per INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+# most shows a single recurrence rule may expand to
+MAX_RECURRENCES = 1000
+
+class ScheduleError(Exception):
+    '''
+    Raised when a bulk scheduling request can not be read at all.
+    Problems with single rows are reported per row instead.
+    '''
+    pass
+
+def parse_schedule(body, content_type):
+    '''
+    Turns a request body into a list of row dicts. Accepts a CSV file with
+    an artist_id,venue_id,start_time header, a JSON array of such objects,
+    or a JSON object with an RFC 5545 "rrule" expanding from start_time:
+
+        {"artist_id": 1, "venue_id": 2, "start_time": "2035-04-06 20:00",
+         "rrule": "FREQ=WEEKLY;BYDAY=FR;COUNT=12"}
+    '''
+    if content_type.startswith('text/csv'):
+        return list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise ScheduleError('body is neither CSV nor JSON')
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and 'rrule' in data:
+        return expand_recurrence(data)
+    raise ScheduleError('expected a JSON array of shows or an object with an rrule')
+
+def expand_recurrence(rule):
+    '''
+    Expands a recurring booking into one row per occurrence.
+    '''
+    try:
+        start_time = dateutil.parser.parse(rule['start_time'])
+        occurrences = rrulestr(rule['rrule'], dtstart=start_time)
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        raise ScheduleError('invalid recurrence: {}'.format(e))
+    rows = []
+    for occurrence in occurrences:
+        if len(rows) == MAX_RECURRENCES:
+            raise ScheduleError('recurrence expands to more than {} shows'.format(MAX_RECURRENCES))
+        rows.append({
+            'artist_id': rule.get('artist_id'),
+            'venue_id': rule.get('venue_id'),
+            'start_time': occurrence
+        })
+    return rows
+
+def clean_row(row):
+    '''
+    Coerces one row to Show column values, raises ValueError if it can't.
+    '''
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with artist_id, venue_id and start_time')
+    try:
+        artist_id = int(row['artist_id'])
+        venue_id = int(row['venue_id'])
+    except KeyError as e:
+        raise ValueError('missing {}'.format(e.args[0]))
+    except (TypeError, ValueError):
+        raise ValueError('artist_id and venue_id must be integers')
+    start_time = row.get('start_time')
+    if not start_time:
+        raise ValueError('missing start_time')
+    if isinstance(start_time, str):
+        try:
+            start_time = dateutil.parser.parse(start_time)
+        except (ValueError, OverflowError):
+            raise ValueError('invalid start_time {!r}'.format(row['start_time']))
+    if not isinstance(start_time, datetime):
+        raise ValueError('invalid start_time {!r}'.format(row['start_time']))
+    if start_time.tzinfo is not None:
+        # start_time columns hold naive local times
+        start_time = start_time.astimezone().replace(tzinfo=None)
+    return {
+        'artist_id': artist_id,
+        'venue_id': venue_id,
+        'start_time': start_time
+    }
+
+def schedule_shows(rows):
+    '''
+    Inserts every valid row as a Show in a single transaction.
+    Foreign keys of all rows are checked with one query and rows that fail
+    any check are skipped and reported by their position in rows.
+    '''
+    errors = []
+    shows = []
+    for i, row in enumerate(rows):
+        try:
+            shows.append((i, clean_row(row)))
+        except ValueError as e:
+            errors.append({'row': i, 'error': str(e)})
+
+    artist_ids = {show['artist_id'] for _, show in shows}
+    venue_ids = {show['venue_id'] for _, show in shows}
+    known = []
+    if shows:
+        known = db.session.query(Artist.id, db.literal('artist').label('kind')) \
+            .filter(Artist.id.in_(artist_ids)) \
+            .union_all(
+                db.session.query(Venue.id, db.literal('venue').label('kind'))
+                .filter(Venue.id.in_(venue_ids))
+            ).all()
+    artist_ids = {row[0] for row in known if row[1] == 'artist'}
+    venue_ids = {row[0] for row in known if row[1] == 'venue'}
+
+    values = []
+    for i, show in shows:
+        if show['artist_id'] not in artist_ids:
+            errors.append({'row': i, 'error': 'unknown artist_id {}'.format(show['artist_id'])})
+        elif show['venue_id'] not in venue_ids:
+            errors.append({'row': i, 'error': 'unknown venue_id {}'.format(show['venue_id'])})
+        else:
+            values.append(show)
+
+    try:
+        for start in range(0, len(values), INSERT_BATCH_SIZE):
+            db.session.execute(Show.__table__.insert().values(values[start:start + INSERT_BATCH_SIZE]))
+        # core inserts skip the Show mapper events, so count them here
+        adjust_show_counts(db.session.connection(), values, 1)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {
+        'created': len(values),
+        'errors': sorted(errors, key=lambda error: error['row'])
+    }
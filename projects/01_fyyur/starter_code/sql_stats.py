@@ -0,0 +1,136 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#----------------------------------------------------------------------------#
+# SQL statement stats.
+# Counts the statements and database time of every request, groups them by
+# fingerprint and flags the ones a request repeats often enough to look
+# like an N+1 loop. Results go to the X-SQL-* and Server-Timing response
+# headers and to the 'sql_stats' logger. Transaction control statements
+# such as SAVEPOINT are not counted.
+#----------------------------------------------------------------------------#
+
+logger = logging.getLogger('sql_stats')
+
+NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+STRING = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDERS = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+TRANSACTION_CONTROL = re.compile(r'\s*(BEGIN|SAVEPOINT|RELEASE|ROLLBACK TO)\b', re.IGNORECASE)
+
+def fingerprint(statement):
+    '''
+    statement with literals, placeholders and IN lists folded, so the
+    queries of one loop share a fingerprint whatever their parameters.
+    '''
+    statement = STRING.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = re.sub(r'%\(\w+\)s|%s|:\w+', '?', statement)
+    statement = PLACEHOLDERS.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+class SQLStats(object):
+    '''
+    Flask extension, SQLStats(app) or init_app(app) later. Settings:
+
+    SQL_STATS_HEADERS     add the X-SQL-* headers, defaults to app.debug or app.testing
+    SQL_STATS_N_PLUS_ONE  times one SELECT may repeat in a request before
+                          it is flagged, 5 by default
+    '''
+    def __init__(self, app=None):
+        self.observers = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_STATS_HEADERS', app.debug or app.testing)
+        app.config.setdefault('SQL_STATS_N_PLUS_ONE', 5)
+        app.extensions['sql_stats'] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        # engines are created lazily and per app, so listen on all of them
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    def start_request(self):
+        g.sql_stats = {'count': 0, 'seconds': 0.0, 'fingerprints': Counter()}
+
+    def finish_request(self, response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+        threshold = current_app.config['SQL_STATS_N_PLUS_ONE']
+        repeated = [(statement, count) for statement, count in stats['fingerprints'].most_common()
+                    if count >= threshold and statement.upper().startswith('SELECT')]
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'statements': stats['count'],
+            'db_ms': round(1000 * stats['seconds'], 3),
+            'repeated': [{'statement': statement, 'count': count} for statement, count in repeated]
+        }
+
+        if current_app.config['SQL_STATS_HEADERS']:
+            response.headers['X-SQL-Count'] = str(record['statements'])
+            response.headers['X-SQL-Time-Ms'] = '{:.3f}'.format(record['db_ms'])
+            if repeated:
+                response.headers['X-SQL-N-Plus-One'] = str(repeated[0][1])
+            response.headers.add('Server-Timing', 'db;dur={:.3f}'.format(record['db_ms']))
+        if repeated:
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+        for observer in self.observers:
+            observer(record)
+        return response
+
+def current_stats():
+    if has_app_context():
+        return g.get('sql_stats')
+    return None
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None and not TRANSACTION_CONTROL.match(statement):
+        conn.info.setdefault('sql_stats_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get('sql_stats_started')
+    if stats is None or not started or TRANSACTION_CONTROL.match(statement):
+        return
+    stats['count'] += 1
+    stats['seconds'] += time.perf_counter() - started.pop()
+    stats['fingerprints'][fingerprint(statement)] += 1
+
+@contextmanager
+def statement_budget(budget, app=None):
+    '''
+    Fails with AssertionError when a request made inside the block runs
+    more than budget statements or repeats a SELECT often enough to be
+    flagged as N+1. Yields the list of request records.
+
+        with statement_budget(3):
+            client.get('/venues')
+    '''
+    extension = (app or current_app).extensions['sql_stats']
+    records = []
+    extension.observers.append(records.append)
+    try:
+        yield records
+    finally:
+        extension.observers.remove(records.append)
+    for record in records:
+        if record['statements'] > budget or record['repeated']:
+            raise AssertionError('{} {} ran {} statements, budget {}{}'.format(
+                record['method'], record['path'], record['statements'], budget,
+                ''.join('\n  {count}x {statement}'.format(**repeated) for repeated in record['repeated'])))
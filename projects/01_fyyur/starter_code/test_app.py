@@ -0,0 +1,465 @@
+import os
+import subprocess
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event
+
+from app import app, db
+from models import (Venue, Artist, Show, venue_areas, search, shows_page, decode_cursor,
+                    rollover_show_counts, rebuild_show_counts)
+from filters import format_datetime, datetime_cache_info, datetime_cache_clear
+from benchmarks import legacy_format_datetime
+import cache
+from db_pool import pool_stats, set_statement_timeout
+from flask import Response
+from sql_stats import statement_budget
+
+
+@contextmanager
+def count_statements():
+    """Collects every SQL statement the engine executes inside the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the fyyur test case"""
+
+    def setUp(self):
+        """Define test variables and initialize the test database."""
+        self.database_path = os.environ.get(
+            'FYYUR_TEST_DATABASE_URL', 'postgres://localhost:5432/fyyur_test')
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.database_path
+        app.config['TESTING'] = True
+        self.client = app.test_client
+        cache.init_cache(app)
+
+        # binds the app to the current context
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def seed(self, num_venues, cities=(('San Francisco', 'CA'), ('New York', 'NY'))):
+        """Seeds num_venues venues spread over cities, each with one past and one upcoming show."""
+        now = datetime.now()
+        with app.app_context():
+            artist = Artist(name='Guns N Petals', city='San Francisco', state='CA',
+                            phone='326-123-5000', genres=['Rock n Roll'])
+            db.session.add(artist)
+            for i in range(num_venues):
+                city, state = cities[i % len(cities)]
+                venue = Venue(name='Venue {}'.format(i), city=city, state=state,
+                              address='{} Main St'.format(i), phone='123-123-1234',
+                              genres=['Jazz'])
+                venue.shows = [
+                    Show(Artist=artist, start_time=now - timedelta(days=7)),
+                    Show(Artist=artist, start_time=now + timedelta(days=7)),
+                ]
+                db.session.add(venue)
+            db.session.commit()
+
+    def test_venues_collapses_areas(self):
+        self.seed(4)
+        res = self.client().get('/venues')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.count(b'<h3>San Francisco, CA</h3>'), 1)
+        self.assertEqual(res.data.count(b'<h3>New York, NY</h3>'), 1)
+
+    def test_venue_areas_counts_upcoming_shows(self):
+        self.seed(2)
+        with app.app_context():
+            areas = venue_areas()
+
+        self.assertEqual(len(areas), 2)
+        self.assertTrue(all(venue['num_upcoming_shows'] == 1
+                            for area in areas for venue in area['venues']))
+
+    def test_venues_statement_count_is_constant(self):
+        counts = []
+        for num_venues in (5, 50):
+            self.tearDown()
+            self.setUp()
+            self.seed(num_venues)
+            with count_statements() as statements:
+                res = self.client().get('/venues')
+            self.assertEqual(res.status_code, 200)
+            counts.append(len(statements))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def seed_search(self):
+        with app.app_context():
+            for name in ('The Musical Hop', 'The Dueling Pianos Bar', 'Park Square Live Music & Coffee'):
+                db.session.add(Venue(name=name, city='San Francisco', state='CA',
+                                     address='1015 Folsom Street', phone='123-123-1234',
+                                     genres=['Jazz']))
+            db.session.commit()
+
+    def test_search_venues_partial_match(self):
+        self.seed_search()
+        with app.app_context():
+            hop = search(Venue, 'Hop')
+            music = search(Venue, 'music')
+
+        self.assertEqual(hop['count'], 1)
+        self.assertEqual(hop['data'][0]['name'], 'The Musical Hop')
+        self.assertEqual(music['count'], 2)
+        self.assertEqual(sorted(venue['name'] for venue in music['data']),
+                         ['Park Square Live Music & Coffee', 'The Musical Hop'])
+
+    def test_search_venues_paginates(self):
+        self.seed_search()
+        with app.app_context():
+            first = search(Venue, 'The', page=1, per_page=1)
+            past_end = search(Venue, 'The', page=5, per_page=1)
+
+        self.assertEqual(first['count'], 2)
+        self.assertEqual(len(first['data']), 1)
+        self.assertEqual(past_end['count'], 2)
+        self.assertEqual(past_end['data'], [])
+
+    def test_search_is_one_statement(self):
+        self.seed(20)
+        with app.app_context():
+            with count_statements() as statements:
+                results = search(Venue, 'Venue')
+
+        self.assertEqual(results['count'], 20)
+        self.assertEqual(len(statements), 1)
+
+    def test_show_venue_splits_past_and_upcoming(self):
+        self.seed(1)
+        res = self.client().get('/venues/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'1 Upcoming Show', res.data)
+        self.assertIn(b'1 Past Show', res.data)
+        self.assertIn(b'Guns N Petals', res.data)
+
+    def test_show_venue_not_found(self):
+        res = self.client().get('/venues/1000')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_detail_statement_count_is_constant(self):
+        counts = []
+        for num_venues in (1, 30):
+            self.tearDown()
+            self.setUp()
+            # every venue shares the one seeded artist
+            self.seed(num_venues)
+            with count_statements() as statements:
+                artist_res = self.client().get('/artists/1')
+                venue_res = self.client().get('/venues/1')
+            self.assertEqual(artist_res.status_code, 200)
+            self.assertEqual(venue_res.status_code, 200)
+            counts.append(len(statements))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_datetime_filter_matches_legacy_filter(self):
+        start_time = datetime(2035, 4, 1, 20, 0)
+        for format in ('full', 'medium'):
+            self.assertEqual(format_datetime(start_time, format),
+                             legacy_format_datetime(str(start_time), format))
+        self.assertEqual(format_datetime('2019-05-21T21:30:00.000Z', 'full'),
+                         legacy_format_datetime('2019-05-21T21:30:00.000Z', 'full'))
+
+    def test_datetime_filter_ignores_server_timezone(self):
+        # babel reads the local timezone when imported, so each TZ gets its own process
+        script = ('from datetime import datetime; from filters import format_datetime; '
+                  'print(format_datetime(datetime(2019, 5, 21, 21, 30), "full"))')
+        for tz in ('UTC', 'America/New_York', 'Asia/Tokyo'):
+            output = subprocess.run([sys.executable, '-c', script], env=dict(os.environ, TZ=tz),
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            self.assertEqual(output.strip(), 'Tuesday May, 21, 2019 at 9:30PM', tz)
+
+    def test_datetime_filter_caches_formatted_strings(self):
+        datetime_cache_clear()
+        start_time = datetime(2035, 4, 1, 20, 0)
+        for _ in range(3):
+            format_datetime(start_time, 'full')
+        info = datetime_cache_info()
+
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+
+    def test_shows_keyset_pages_cover_every_show(self):
+        # every seeded show shares one of two start times, so pages split ties
+        self.seed(20)
+        seen = []
+        cursor = None
+        with app.app_context():
+            while True:
+                data, next_cursor = shows_page(cursor and decode_cursor(cursor), per_page=7)
+                seen.extend((show['start_time'], show['venue_id']) for show in data)
+                if next_cursor is None:
+                    break
+                cursor = next_cursor
+
+        self.assertEqual(len(seen), 40)
+        self.assertEqual(len(set(seen)), 40)
+        self.assertEqual(seen, sorted(seen, key=lambda show: show[0]))
+
+    def test_shows_page_includes_names(self):
+        self.seed(1)
+        res = self.client().get('/shows')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Guns N Petals', res.data)
+        self.assertIn(b'Venue 0', res.data)
+
+    def test_shows_rejects_bad_cursor(self):
+        res = self.client().get('/shows?after=yesterday')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_stream_shows(self):
+        self.seed(40)
+        res = self.client().get('/shows/stream')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.count(b'tile-show'), 80)
+
+    def test_bulk_shows_json(self):
+        self.seed(1)
+        rows = [{'artist_id': 1, 'venue_id': 1, 'start_time': '2035-04-01 20:00'}] * 1500
+        rows += [
+            {'artist_id': 1, 'venue_id': 99, 'start_time': '2035-04-01 20:00'},
+            {'artist_id': 1, 'venue_id': 1, 'start_time': 'tomorrow-ish'},
+        ]
+        with count_statements() as statements:
+            res = self.client().post('/shows/bulk', json=rows)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1500)
+        self.assertEqual([error['row'] for error in data['errors']], [1500, 1501])
+        # one foreign key check and two batched inserts
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT')]), 2)
+        with app.app_context():
+            self.assertEqual(Show.query.count(), 1502)
+
+    def test_bulk_shows_aware_start_time(self):
+        self.seed(1)
+        rows = [{'artist_id': 1, 'venue_id': 1, 'start_time': '2035-04-06T20:00:00Z'}]
+        res = self.client().post('/shows/bulk', json=rows)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['created'], 1)
+        local = datetime(2035, 4, 6, 20, 0, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+        with app.app_context():
+            self.assertEqual(Show.query.filter(Show.start_time > datetime(2035, 1, 1)).one().start_time, local)
+
+    def test_bulk_shows_start_time_type(self):
+        self.seed(1)
+        rows = [
+            {'artist_id': 1, 'venue_id': 1, 'start_time': 2035},
+            {'artist_id': 1, 'venue_id': 1, 'start_time': ['2035-04-06 20:00']},
+            {'artist_id': 1, 'venue_id': 1, 'start_time': '2035-04-06 20:00'},
+        ]
+        res = self.client().post('/shows/bulk', json=rows)
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [0, 1])
+
+    def test_bulk_shows_csv(self):
+        self.seed(1)
+        body = 'artist_id,venue_id,start_time\n1,1,2035-04-01 20:00\n1,1,2035-04-08 20:00\n'
+        res = self.client().post('/shows/bulk', data=body, content_type='text/csv')
+
+        self.assertEqual(res.get_json()['created'], 2)
+
+    def test_bulk_shows_recurrence(self):
+        self.seed(1)
+        rule = {'artist_id': 1, 'venue_id': 1, 'start_time': '2035-04-06 20:00',
+                'rrule': 'FREQ=WEEKLY;BYDAY=FR;COUNT=12'}
+        res = self.client().post('/shows/bulk', json=rule)
+
+        self.assertEqual(res.get_json()['created'], 12)
+        with app.app_context():
+            fridays = Show.query.filter(Show.start_time > datetime(2035, 1, 1)).all()
+        self.assertEqual(len(fridays), 12)
+        self.assertTrue(all(show.start_time.weekday() == 4 for show in fridays))
+
+    def test_bulk_shows_unreadable_body(self):
+        res = self.client().post('/shows/bulk', data='not json', content_type='application/json')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['success'], False)
+
+    def test_show_counts_follow_inserts_and_deletes(self):
+        self.seed(1)
+        with app.app_context():
+            venue = Venue.query.get(1)
+            self.assertEqual((venue.upcoming_shows_count, venue.past_shows_count), (1, 1))
+            db.session.delete(Show.query.filter(Show.start_time > datetime.now()).first())
+            db.session.commit()
+            venue = Venue.query.get(1)
+            artist = Artist.query.get(1)
+
+            self.assertEqual((venue.upcoming_shows_count, venue.past_shows_count), (0, 1))
+            self.assertEqual((artist.upcoming_shows_count, artist.past_shows_count), (0, 1))
+
+    def test_show_counts_follow_bulk_scheduling(self):
+        self.seed(1)
+        rows = [{'artist_id': 1, 'venue_id': 1, 'start_time': '2035-04-01 20:00'}] * 5
+        self.client().post('/shows/bulk', json=rows)
+        with app.app_context():
+            venue = Venue.query.get(1)
+
+            self.assertEqual(venue.upcoming_shows_count, 6)
+
+    def test_rollover_moves_started_shows_to_past(self):
+        self.seed(2)
+        with app.app_context():
+            moved = rollover_show_counts(datetime.now() + timedelta(days=8))
+            venue = Venue.query.get(1)
+            artist = Artist.query.get(1)
+
+            self.assertEqual(moved, 2)
+            self.assertEqual((venue.upcoming_shows_count, venue.past_shows_count), (0, 2))
+            self.assertEqual((artist.upcoming_shows_count, artist.past_shows_count), (0, 4))
+            self.assertEqual(rebuild_show_counts(datetime.now() + timedelta(days=8)), [])
+
+    def test_rebuild_show_counts_reports_drift(self):
+        self.seed(2)
+        with app.app_context():
+            Venue.query.filter_by(id=1).update({'upcoming_shows_count': 7})
+            db.session.commit()
+            drift = rebuild_show_counts()
+
+            self.assertEqual(drift, [('Venue', 1, (7, 1), (1, 1))])
+            self.assertEqual(Venue.query.get(1).upcoming_shows_count, 1)
+
+    def test_read_pages_are_cached(self):
+        self.seed(1)
+        with count_statements() as statements:
+            first = self.client().get('/venues/1')
+            second = self.client().get('/venues/1')
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(len([s for s in statements if s.startswith('SELECT')]), 1)
+        self.assertEqual(cache.cache_stats()['hits'], 1)
+
+    def test_creating_a_show_invalidates_its_pages(self):
+        self.seed(1)
+        self.client().get('/artists/1')
+        self.client().get('/venues')
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1', 'start_time': '2035-04-01 20:00:00'})
+        artist = self.client().get('/artists/1')
+
+        self.assertIn(b'2 Upcoming Shows', artist.data)
+        self.assertEqual(cache.cache_stats()['entries'], 1)
+
+    def test_editing_an_artist_invalidates_venue_pages(self):
+        self.seed(1)
+        self.client().get('/venues/1')
+        self.client().get('/venues')
+        self.client().post('/artists/1/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA',
+            'phone': '432-325-5432', 'genres': ['Jazz']})
+        venue = self.client().get('/venues/1')
+
+        self.assertIn(b'The Wild Sax Band', venue.data)
+        # the venue listing does not show artists and stays cached
+        self.assertEqual(cache.cache_stats()['entries'], 2)
+
+    def test_pool_survives_concurrent_requests(self):
+        self.seed(5)
+
+        def fetch(venue_id):
+            # a distinct query string per request bypasses the response cache
+            return self.client().get('/venues/{}?n={}'.format(venue_id % 5 + 1, venue_id)).status_code
+
+        with ThreadPoolExecutor(16) as pool:
+            statuses = list(pool.map(fetch, range(200)))
+        with app.app_context():
+            stats = pool_stats(db.engine)
+
+        self.assertEqual(statuses, [200] * 200)
+        if 'checkouts' in stats:
+            self.assertGreaterEqual(stats['checkouts'], 200)
+            self.assertEqual(stats['checkout_timeouts'], 0)
+            # every connection went back to the pool
+            self.assertEqual(stats['active'], 0)
+
+    def test_statement_timeout_only_in_requests(self):
+        class Connection(object):
+            dialect = type('Dialect', (), {'name': 'postgresql'})
+            statements = []
+            def execute(self, statement):
+                self.statements.append(str(statement))
+
+        connection = Connection()
+        # e.g. manage.py or a migration
+        with app.app_context():
+            set_statement_timeout(db.session, None, connection)
+        with app.test_request_context('/venues'):
+            set_statement_timeout(db.session, None, connection)
+
+        self.assertEqual(connection.statements, [
+            'SET LOCAL statement_timeout = {}'.format(app.config['DB_STATEMENT_TIMEOUT_MS'])])
+
+    def test_read_pages_within_statement_budget(self):
+        self.seed(6)
+        with app.app_context(), statement_budget(1) as records:
+            for url in ('/venues', '/artists', '/shows', '/venues/1', '/artists/1'):
+                self.assertEqual(self.client().get(url).status_code, 200)
+
+        self.assertEqual(len(records), 5)
+
+    def test_sql_headers(self):
+        self.seed(2)
+        res = self.client().get('/venues')
+
+        self.assertEqual(res.headers['X-SQL-Count'], '1')
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+
+    def test_repeated_selects_flagged_as_n_plus_one(self):
+        self.seed(6)
+        sql_stats = app.extensions['sql_stats']
+        with app.test_request_context('/venues'):
+            sql_stats.start_request()
+            for venue_id in range(1, 7):
+                Venue.query.get(venue_id)
+            response = sql_stats.finish_request(Response())
+
+        self.assertEqual(response.headers['X-SQL-Count'], '6')
+        self.assertEqual(response.headers['X-SQL-N-Plus-One'], '6')
+
+        with app.app_context():
+            with self.assertRaises(AssertionError) as raised:
+                with statement_budget(10):
+                    with app.test_request_context('/venues'):
+                        sql_stats.start_request()
+                        for venue_id in range(1, 7):
+                            Venue.query.get(venue_id)
+                        sql_stats.finish_request(Response())
+        self.assertIn('6x SELECT', str(raised.exception))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+import csv
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+import flask
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from sqlalchemy import func
+
+import json_provider
+from loader import load_questions
+from models import db, process_cache, search_index, rebuild_category_stats, search_questions, Question, Category
+
+'''
+Benchmarks
+    run against a scratch database, e.g.
+
+        TRIVIA_BENCH_DATABASE_URL=postgres://localhost:5432/trivia_bench python benchmarks.py pages
+
+    Every run drops and recreates the tables of that database. By default
+    it is a SQLite file in the temp directory, outside the source tree.
+'''
+database_path = os.environ.get('TRIVIA_BENCH_DATABASE_URL',
+  'sqlite:///' + os.path.join(tempfile.gettempdir(), 'trivia_bench.db'))
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+
+# made up vocabulary of 4096 words for question text that searches can hit
+WORDS = [''.join(syllables) for syllables in itertools.product(
+  ['ka', 'lo', 'mi', 'nu', 'pe', 'ra', 'so', 'ti'], repeat=4)]
+
+def benchmark_question(i):
+  return 'Benchmark question {}?'.format(i)
+
+def worded_question(i):
+  words = random.Random(i).sample(WORDS, 8)
+  return '{}?'.format(' '.join(words)).capitalize()
+
+def seed_questions(num_questions, batch_size=10000, question_text=benchmark_question):
+  db.drop_all()
+  db.create_all()
+  db.session.execute(Category.__table__.insert(), [{'type': type} for type in CATEGORIES])
+  for start in range(0, num_questions, batch_size):
+    db.session.execute(Question.__table__.insert(), [{
+      'question': question_text(i),
+      'answer': 'Answer {}'.format(i),
+      'category': str(i % len(CATEGORIES) + 1),
+      'difficulty': i % 5 + 1
+    } for i in range(start, min(start + batch_size, num_questions))])
+  db.session.commit()
+  rebuild_category_stats()
+  process_cache.clear()
+  search_index.clear()
+
+def time_requests(client, url, repeat):
+  started = time.perf_counter()
+  for _ in range(repeat):
+    res = client.get(url)
+    assert res.status_code == 200, (url, res.status_code)
+  return 1000 * (time.perf_counter() - started) / repeat
+
+def bench_pages(num_questions=1000000, repeat=50):
+  '''
+  GET /questions latency of the first, a middle and the last page
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.app_context():
+    seed_questions(num_questions)
+    client = app.test_client()
+    last_page = (num_questions + QUESTIONS_PER_PAGE - 1) // QUESTIONS_PER_PAGE
+    # the first request pays for the count and the page anchors
+    client.get('/questions?page=2')
+    print('pages over {} questions'.format(num_questions))
+    for page in (1, 10000, last_page):
+      if page <= last_page:
+        print('  page {:>7}: {:.2f} ms'.format(page, time_requests(client, '/questions?page={}'.format(page), repeat)))
+
+def bench_quiz(num_questions=1000000, repeat=50):
+  '''
+  POST /quizzes latency as previous_questions grows, next to picking
+  with ORDER BY random() over the category
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.app_context():
+    seed_questions(num_questions)
+    client = app.test_client()
+    category_ids = [id for id, in db.session.query(Question.id).filter(Question.category == '1')]
+    # the first turn pays for reading the category's ids
+    client.post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 1}})
+    print('quiz turns over {} questions, {} in the category'.format(num_questions, len(category_ids)))
+    for played in (0, 10, 100, 1000):
+      body = {'previous_questions': random.sample(category_ids, played), 'quiz_category': {'id': 1}}
+      started = time.perf_counter()
+      for _ in range(repeat):
+        assert client.post('/quizzes', json=body).status_code == 200
+      print('  {:>5} played: {:.2f} ms'.format(played, 1000 * (time.perf_counter() - started) / repeat))
+
+    started = time.perf_counter()
+    for _ in range(5):
+      Question.query.filter(Question.category == '1').order_by(func.random()).first()
+    print('  ORDER BY random(): {:.2f} ms'.format(1000 * (time.perf_counter() - started) / 5))
+
+def bench_search(num_questions=200000, repeat=20):
+  '''
+  search_questions() next to the ILIKE substring search it replaces
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.app_context():
+    seed_questions(num_questions, question_text=worded_question)
+    started = time.perf_counter()
+    search_questions(WORDS[0])
+    print('search over {} questions, first search {:.0f} ms'.format(
+      num_questions, 1000 * (time.perf_counter() - started)))
+    for term in (WORDS[1], WORDS[2][:6], '{} {}'.format(WORDS[3], WORDS[4][:4])):
+      started = time.perf_counter()
+      for _ in range(repeat):
+        questions, total = search_questions(term, 1, QUESTIONS_PER_PAGE)
+      ranked = 1000 * (time.perf_counter() - started) / repeat
+
+      pattern = '%{}%'.format(term)
+      started = time.perf_counter()
+      for _ in range(repeat):
+        query = Question.query.filter(Question.question.ilike(pattern))
+        query.count()
+        query.order_by(Question.id).limit(QUESTIONS_PER_PAGE).all()
+      substring = 1000 * (time.perf_counter() - started) / repeat
+      print('  {:<16} {:>6} matches: {:.2f} ms ranked, {:.2f} ms ILIKE'.format(repr(term), total, ranked, substring))
+
+def bench_load(num_questions=500000):
+  '''
+  load_questions() of a generated CSV bank, a tenth of it duplicated
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.app_context(), tempfile.TemporaryFile('w+', newline='') as bank:
+    seed_questions(0)
+    writer = csv.writer(bank)
+    writer.writerow(['question', 'answer', 'category', 'difficulty'])
+    for i in range(num_questions):
+      writer.writerow([worded_question(i % (num_questions - num_questions // 10)), 'Answer', CATEGORIES[i % len(CATEGORIES)], i % 5 + 1])
+    bank.seek(0)
+
+    totals = load_questions(bank)
+    print('loaded {read} rows: {inserted} inserted, {duplicates} duplicates, {rows_per_second:.0f} rows/s'.format(**totals))
+
+def bench_polling(num_questions=10000, polls=3000, write_every=100):
+  '''
+  bytes and latency of a client polling /questions, /categories and a
+  category page, once refetching every body and once revalidating with
+  If-None-Match and Accept-Encoding, while a question is added every
+  write_every polls
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.app_context():
+    seed_questions(num_questions)
+    client = app.test_client()
+    urls = ['/questions', '/categories', '/categories/1/questions']
+    print('polling over {} questions, a write every {} polls'.format(num_questions, write_every))
+    for name, revalidate in (('refetch', False), ('revalidate', True)):
+      etags = {}
+      received = not_modified = 0
+      elapsed = 0.0
+      for i in range(polls):
+        if i and i % write_every == 0:
+          Question('Polled question {}?'.format(i), 'Answer', '1', 1).insert()
+        url = urls[i % len(urls)]
+        headers = {}
+        if revalidate:
+          headers['Accept-Encoding'] = 'br, gzip'
+          if url in etags:
+            headers['If-None-Match'] = etags[url]
+        started = time.perf_counter()
+        res = client.get(url, headers=headers)
+        elapsed += time.perf_counter() - started
+        received += len(res.data)
+        if res.status_code == 304:
+          not_modified += 1
+        else:
+          etags[url] = res.headers['ETag']
+      print('  {:<10} {:>9} body bytes, {:.2f} ms per poll, {} not modified'.format(
+        name, received, 1000 * elapsed / polls, not_modified))
+
+def bench_json(num_rows=10000, repeat=20):
+  '''
+  encoding a response of num_rows questions with flask.jsonify and with
+  the stdlib and orjson backends of json_provider, from formatted dicts,
+  from the model instances and streamed
+  '''
+  app = create_app({'DATABASE_PATH': database_path})
+  with app.test_request_context():
+    questions = []
+    for i in range(num_rows):
+      question = Question(worded_question(i), 'Answer {}'.format(i), str(i % len(CATEGORIES) + 1), i % 5 + 1)
+      question.id = i + 1
+      questions.append(question)
+    formatted = [question.format() for question in questions]
+
+    def time_encoding(encode):
+      started = time.perf_counter()
+      for _ in range(repeat):
+        size = len(encode())
+      return 1000 * (time.perf_counter() - started) / repeat, size
+
+    print('encoding {} questions'.format(num_rows))
+    ms, size = time_encoding(lambda: flask.jsonify({'success': True, 'questions': formatted}).get_data())
+    print('  {:<8} {:<10} {:>7.2f} ms, {} bytes'.format('flask', 'dicts', ms, size))
+    installed = json_provider.orjson
+    for name, backend in (('json', None), ('orjson', installed)):
+      if name == 'orjson' and backend is None:
+        print('  orjson is not installed')
+        continue
+      json_provider.orjson = backend
+      for shape, encode in (
+          ('dicts', lambda: json_provider.jsonify({'success': True, 'questions': formatted}).get_data()),
+          ('rows', lambda: json_provider.jsonify({'success': True, 'questions': questions}).get_data()),
+          ('streamed', lambda: b''.join(json_provider.stream_array(formatted, {'success': True}, 'questions').response))):
+        ms, size = time_encoding(encode)
+        print('  {:<8} {:<10} {:>7.2f} ms, {} bytes'.format(name, shape, ms, size))
+    json_provider.orjson = installed
+
+BENCHMARKS = {
+  'pages': bench_pages,
+  'load': bench_load,
+  'polling': bench_polling,
+  'json': bench_json,
+  'quiz': bench_quiz,
+  'search': bench_search,
+}
+
+if __name__ == '__main__':
+  for name in sys.argv[1:] or sorted(BENCHMARKS):
+    BENCHMARKS[name]()
@@ -0,0 +1,157 @@
+"""
+Test database fixtures.
+
+The app and its schema are created once per test run. Every test then
+runs inside a transaction on a single connection, the session works in a
+SAVEPOINT that is reopened whenever the code under test commits or rolls
+back, and the whole transaction is rolled back when the test ends.
+
+    TRIVIA_TEST_DATABASE_URL=sqlite:// python test_flaskr.py    # offline, in memory
+    pytest -n 4 test_flaskr.py                                   # one database per worker
+    TRIVIA_TEST_SQL_REPORT=1 python test_flaskr.py               # statements per test
+"""
+
+import copy
+import os
+import sys
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+
+from flaskr import create_app
+from models import db, ensure_indexes
+
+DEFAULT_DATABASE_URL = "postgres://{}/{}".format('localhost:5432', 'trivia_test')
+
+
+def database_url():
+    return worker_database_url(os.environ.get('TRIVIA_TEST_DATABASE_URL', DEFAULT_DATABASE_URL))
+
+
+def worker_database_url(url):
+    """The database of this pytest-xdist worker, url itself outside xdist.
+    Postgres worker databases are created on first use."""
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    url = make_url(url)
+    if not worker or (url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')):
+        return str(url)
+    if url.drivername.startswith('sqlite'):
+        root, ext = os.path.splitext(url.database)
+        url.database = '{}_{}{}'.format(root, worker, ext)
+    else:
+        url.database = '{}_{}'.format(url.database, worker)
+        create_postgres_database(url)
+    return str(url)
+
+
+def create_postgres_database(url):
+    server = copy.copy(url)
+    server.database = 'postgres'
+    engine = create_engine(server, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(
+                text('SELECT 1 FROM pg_database WHERE datname = :name'), name=url.database).scalar()
+            if not exists:
+                connection.execute('CREATE DATABASE "{}"'.format(url.database))
+    finally:
+        engine.dispose()
+
+
+class FixtureSession(scoped_session):
+    """Scoped session that keeps its one session bound to the test
+    transaction. remove(), which Flask-SQLAlchemy calls after every
+    request, forgets pending changes and loaded objects instead."""
+
+    def remove(self):
+        if self.registry.has():
+            session = self.registry()
+            session.rollback()
+            session.expunge_all()
+
+
+class DatabaseFixture(object):
+    """The app of the test run and the transaction of the current test."""
+
+    def __init__(self, url, seed=None):
+        self.app = create_app({'DATABASE_PATH': url, 'TESTING': True})
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.sqlite = db.engine.dialect.name == 'sqlite'
+        if self.sqlite:
+            # pysqlite starts transactions on its own and breaks SAVEPOINT,
+            # so it is switched to autocommit and BEGIN is sent explicitly
+            event.listen(db.engine, 'connect', self.sqlite_autocommit)
+            event.listen(db.engine, 'begin', self.sqlite_begin)
+            db.engine.dispose()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        ensure_indexes()
+        if seed is not None:
+            seed()
+            db.session.commit()
+        db.session.remove()
+
+        self.statements = 0
+        self.sql_counts = {}
+        event.listen(db.engine, 'before_cursor_execute', self.count_statement)
+
+    @staticmethod
+    def sqlite_autocommit(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @staticmethod
+    def sqlite_begin(connection):
+        connection.execute('BEGIN')
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def begin(self):
+        """Starts the transaction of a test and binds db.session to it."""
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = FixtureSession(db.create_session({'bind': self.connection, 'binds': {}}))
+
+        session = db.session()
+        session.begin_nested()
+        self.nested = True
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if self.nested and transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        self.statements = 0
+
+    def rollback(self, test_id=None):
+        """Ends the test, dropping everything it wrote."""
+        if test_id is not None:
+            self.sql_counts[test_id] = self.statements
+        self.nested = False
+        # the savepoint first, so the outer transaction is the one rolled
+        # back and the connection goes back to the pool without a reset
+        session = db.session.registry()
+        session.rollback()
+        self.transaction.rollback()
+        session.close()
+        db.session = self.app_session
+        self.connection.close()
+
+    def close(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count_statement)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def report(self, stream=sys.stderr, limit=10):
+        """Writes the tests that ran the most statements to stream."""
+        if not self.sql_counts:
+            return
+        stream.write('\nSQL statements per test, {} in total\n'.format(sum(self.sql_counts.values())))
+        for test_id, count in sorted(self.sql_counts.items(), key=lambda item: -item[1])[:limit]:
+            stream.write('  {:5d}  {}\n'.format(count, test_id))
@@ -1,45 +1,73 @@
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, request, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import random
 
-from models import setup_db, Question, Category
+from models import db, setup_db, Question, Category, category_map, category_stats, question_count, questions_page, random_question, \
+  invalidate_tables, rebuild_category_stats, search_questions
+from quiz_sessions import quiz_sessions
+from loader import LoadError, load_questions, file_format
+from sql_stats import SQLStats
+from http_cache import HTTPCache, conditional
+from json_provider import JSONProvider, jsonify
 
 QUESTIONS_PER_PAGE = 10
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
-  
-  '''
-  @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
-  '''
+  if test_config is None:
+    setup_db(app)
+  else:
+    app.config.from_mapping(test_config)
+    setup_db(app, test_config['DATABASE_PATH'])
 
-  '''
-  @TODO: Use the after_request decorator to set Access-Control-Allow
-  '''
+  CORS(app, resources={r'/*': {'origins': '*'}})
+  JSONProvider(app)
+  SQLStats(app)
+  http_cache = HTTPCache(app, db)
+  http_cache.observers.append(invalidate_tables)
 
-  '''
-  @TODO: 
-  Create an endpoint to handle GET requests 
-  for all available categories.
-  '''
+  @app.after_request
+  def after_request(response):
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,DELETE,OPTIONS')
+    return response
 
+  @app.route('/categories')
+  @conditional('categories')
+  def get_categories():
+    return jsonify({
+      'success': True,
+      'categories': category_map()
+    })
 
   '''
-  @TODO: 
-  Create an endpoint to handle GET requests for questions, 
-  including pagination (every 10 questions). 
-  This endpoint should return a list of questions, 
-  number of total questions, current category, categories. 
-
-  TEST: At this point, when you start the application
-  you should see questions and categories generated,
-  ten questions per page and pagination at the bottom of the screen for three pages.
-  Clicking on the page numbers should update the questions. 
+  GET /questions?page=<n> or /questions?after=<id>
+  Pages are read by keyset on the question id. Follow next_cursor with
+  ?after= to walk the list, ?page= jumps straight to a page.
   '''
+  @app.route('/questions')
+  @conditional('categories', 'questions')
+  def get_questions():
+    after = request.args.get('after', None, type=int)
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      abort(400)
+    questions, next_cursor = questions_page(after, page, QUESTIONS_PER_PAGE)
+    if not questions and (after is not None or page > 1):
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'questions': [question.format() for question in questions],
+      'total_questions': question_count(),
+      'categories': category_map(),
+      'current_category': None,
+      'next_cursor': next_cursor
+    })
 
   '''
   @TODO: 
@@ -61,44 +89,211 @@ def create_app(test_config=None):
   '''
 
   '''
-  @TODO: 
-  Create a POST endpoint to get questions based on a search term. 
-  It should return any questions for whom the search term 
-  is a substring of the question. 
+  POST /questions/search
+  Takes searchTerm and an optional page. Returns the questions containing
+  a word that starts with each word of searchTerm, best matches first.
+  '''
+  @app.route('/questions/search', methods=['POST'])
+  def search():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    search_term = body.get('searchTerm')
+    if not isinstance(search_term, str):
+      abort(422)
+    try:
+      page = int(body.get('page', 1))
+    except (TypeError, ValueError):
+      abort(422)
+    if page < 1:
+      abort(400)
 
-  TEST: Search by any phrase. The questions list will update to include 
-  only question that include that string within their question. 
-  Try using the word "title" to start. 
+    # notices questions written by other processes, e.g. flask import-questions
+    http_cache.versions(['questions'])
+    questions, total_questions = search_questions(search_term, page, QUESTIONS_PER_PAGE)
+    return jsonify({
+      'success': True,
+      'questions': [question.format() for question in questions],
+      'total_questions': total_questions,
+      'current_category': None
+    })
+
+  '''
+  GET /categories/<category_id>/questions?page=<n> or ?after=<id>
+  Same pages as /questions, limited to one category.
   '''
+  @app.route('/categories/<int:category_id>/questions')
+  @conditional('categories', 'questions')
+  def get_category_questions(category_id):
+    categories = category_map()
+    if category_id not in categories:
+      abort(404)
+    after = request.args.get('after', None, type=int)
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      abort(400)
+    questions, next_cursor = questions_page(after, page, QUESTIONS_PER_PAGE, str(category_id))
+    if not questions and (after is not None or page > 1):
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'questions': [question.format() for question in questions],
+      'total_questions': question_count(str(category_id)),
+      'current_category': categories[category_id],
+      'next_cursor': next_cursor
+    })
 
   '''
-  @TODO: 
-  Create a GET endpoint to get questions based on category. 
+  GET /categories/stats
+  Question totals and difficulty histograms per category, served from the
+  category_stats summary table.
+  '''
+  @app.route('/categories/stats')
+  @conditional('categories', 'category_stats', 'questions')
+  def get_category_stats():
+    stats = category_stats()
+    return jsonify({
+      'success': True,
+      'categories': {
+        id: dict(stats.get(str(id), {'total_questions': 0, 'difficulties': {}}), type=type)
+        for id, type in category_map().items()
+      }
+    })
+
 
-  TEST: In the "List" tab / main screen, clicking on one of the 
-  categories in the left column will cause only questions of that 
-  category to be shown. 
   '''
+  POST /quizzes
+  Takes previous_questions, a list of ids, and quiz_category, whose id is
+  missing or 0 for all categories. Returns a random question that was not
+  played yet, or null once the category is exhausted.
+  '''
+  @app.route('/quizzes', methods=['POST'])
+  def play_quiz():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    previous_questions = body.get('previous_questions') or []
+    quiz_category = body.get('quiz_category') or {}
+    if not isinstance(previous_questions, list) or not isinstance(quiz_category, dict):
+      abort(422)
+    try:
+      category_id = int(quiz_category.get('id') or 0)
+      previous_questions = [int(id) for id in previous_questions]
+    except (TypeError, ValueError):
+      abort(422)
 
+    question = random_question(str(category_id) if category_id else None, previous_questions)
+    return jsonify({
+      'success': True,
+      'question': question.format() if question is not None else None
+    })
 
   '''
-  @TODO: 
-  Create a POST endpoint to get questions to play the quiz. 
-  This endpoint should take category and previous question parameters 
-  and return a random questions within the given category, 
-  if provided, and that is not one of the previous questions. 
+  POST /quizzes/sessions
+  Starts a quiz kept on the server. Takes quiz_category like /quizzes and
+  returns a session_id to pass to /quizzes/sessions/<session_id>/next.
+  '''
+  @app.route('/quizzes/sessions', methods=['POST'])
+  def create_quiz_session():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    quiz_category = body.get('quiz_category') or {}
+    if not isinstance(quiz_category, dict):
+      abort(422)
+    try:
+      category_id = int(quiz_category.get('id') or 0)
+    except (TypeError, ValueError):
+      abort(422)
+
+    session_id, total_questions = quiz_sessions.create(str(category_id) if category_id else None)
+    return jsonify({
+      'success': True,
+      'session_id': session_id,
+      'total_questions': total_questions
+    }), 201
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+  def next_quiz_question(session_id):
+    try:
+      question = quiz_sessions.next_question(session_id)
+    except KeyError:
+      abort(404)
+    return jsonify({
+      'success': True,
+      'question': question.format() if question is not None else None
+    })
+
+  @app.route('/metrics/quiz-sessions')
+  def quiz_session_metrics():
+    return jsonify(quiz_sessions.stats())
 
-  TEST: In the "Play" tab, after a user selects "All" or a category,
-  one question at a time is displayed, the user is allowed to answer
-  and shown whether they were correct or not. 
   '''
+  flask import-questions FILE
+  Bulk loads a CSV or JSONL question bank, see loader.py.
+  '''
+  @app.cli.command('import-questions')
+  @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+  @click.option('--format', type=click.Choice(['csv', 'jsonl']), help='defaults to the file extension')
+  @click.option('--batch-size', default=5000, show_default=True)
+  def import_questions(path, format, batch_size):
+    def report(totals):
+      click.echo('{read} read, {inserted} inserted, {duplicates} duplicates, '
+        '{rejected} rejected, {rows_per_second:.0f} rows/s'.format(**totals))
+
+    with open(path, newline='', encoding='utf-8') as file:
+      try:
+        totals = load_questions(file, format or file_format(path), batch_size, report)
+      except LoadError as e:
+        raise click.ClickException(str(e))
+    for error in totals['errors']:
+      click.echo('row {row}: {error}'.format(**error), err=True)
 
   '''
-  @TODO: 
-  Create error handlers for all expected errors 
-  including 404 and 422. 
+  flask reconcile-category-stats
+  Rebuilds category_stats from the questions table and lists the counts
+  that had drifted.
   '''
-  
+  @app.cli.command('reconcile-category-stats')
+  def reconcile_category_stats():
+    drift = rebuild_category_stats()
+    for category, difficulty, stored, actual in drift:
+      click.echo('category {!r} difficulty {}: stored {}, actual {}'.format(category, difficulty, stored, actual))
+    click.echo('{} counts drifted'.format(len(drift)))
+
+  @app.errorhandler(400)
+  def bad_request(error):
+    return jsonify({
+      'success': False,
+      'error': 400,
+      'message': 'bad request'
+    }), 400
+
+  @app.errorhandler(404)
+  def not_found(error):
+    return jsonify({
+      'success': False,
+      'error': 404,
+      'message': 'resource not found'
+    }), 404
+
+  @app.errorhandler(422)
+  def unprocessable(error):
+    return jsonify({
+      'success': False,
+      'error': 422,
+      'message': 'unprocessable'
+    }), 422
+
+  @app.errorhandler(500)
+  def server_error(error):
+    return jsonify({
+      'success': False,
+      'error': 500,
+      'message': 'internal server error'
+    }), 500
+
   return app
 
     
\ No newline at end of file
@@ -0,0 +1,138 @@
+import datetime
+import decimal
+import json
+import secrets
+import uuid
+from flask import current_app, json as flask_json, stream_with_context
+from sqlalchemy import inspect
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#----------------------------------------------------------------------------#
+# JSON provider.
+# One dumps() for every response body: orjson when it is installed, the
+# stdlib json module otherwise. Both write compact UTF-8 and know dates,
+# decimals, UUIDs, sets, mapped model instances and result rows.
+# jsonify() is a drop-in for flask.jsonify on top of it, stream_array()
+# sends a large list one item at a time.
+#----------------------------------------------------------------------------#
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# column attribute keys of every class seen by default(), () when unmapped
+MAPPED_COLUMNS = {}
+
+def mapped_columns(cls):
+    columns = MAPPED_COLUMNS.get(cls)
+    if columns is None:
+        mapper = inspect(cls, raiseerr=False)
+        columns = tuple(attr.key for attr in mapper.column_attrs) if hasattr(mapper, 'column_attrs') else ()
+        MAPPED_COLUMNS[cls] = columns
+    return columns
+
+def default(obj):
+    '''
+    the JSON value of the types neither encoder handles on its own
+    '''
+    columns = mapped_columns(type(obj))
+    if columns:
+        # a mapped instance, as its column attributes; loaded ones are read
+        # from __dict__, past the instrumented descriptors
+        loaded = obj.__dict__
+        return {key: loaded[key] if key in loaded else getattr(obj, key) for key in columns}
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, 'keys') and hasattr(obj, 'items'):
+        # a result row
+        return dict(obj.items())
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+def dumps(obj, sort_keys=True):
+    '''
+    obj as compact UTF-8 JSON bytes
+    '''
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option)
+    return json.dumps(obj, default=default, sort_keys=sort_keys, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+def jsonify(*args, **kwargs):
+    '''
+    flask.jsonify through dumps(), JSON_SORT_KEYS is honoured
+    '''
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+    body = dumps(data, current_app.config.get('JSON_SORT_KEYS', True))
+    return current_app.response_class(body + b'\n', mimetype=current_app.config.get('JSONIFY_MIMETYPE', 'application/json'))
+
+def stream_array(items, envelope=None, key='items'):
+    '''
+    A response that writes the array of items as it encodes them, so
+    neither the list nor its JSON is held in memory at once. envelope
+    is an optional dict sent around the array under key. Streamed bodies
+    get no ETag or compression and are not counted by SQLStats.
+
+        return stream_array(Question.query.yield_per(1000), {'success': True}, 'questions')
+    '''
+    sort_keys = current_app.config.get('JSON_SORT_KEYS', True)
+    if envelope is None:
+        head, tail = b'[', b']\n'
+    else:
+        # the envelope is encoded once around a marker the array replaces
+        marker = 'stream-{}'.format(secrets.token_hex(8))
+        envelope = dict(envelope)
+        envelope[key] = marker
+        head, tail = dumps(envelope, sort_keys).split('"{}"'.format(marker).encode('utf-8'))
+        head, tail = head + b'[', b']' + tail + b'\n'
+
+    def generate():
+        # items are encoded one by one and written in chunks of about
+        # STREAM_CHUNK_SIZE bytes
+        chunk = bytearray(head)
+        separator = b''
+        for item in items:
+            chunk += separator
+            chunk += dumps(item, sort_keys)
+            separator = b','
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+        chunk += tail
+        yield bytes(chunk)
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+class JSONEncoder(flask_json.JSONEncoder):
+    '''
+    the Flask encoder with the types of default(), for the responses and
+    templates that still go through flask.json
+    '''
+    def default(self, obj):
+        try:
+            return default(obj)
+        except TypeError:
+            return super(JSONEncoder, self).default(obj)
+
+class JSONProvider(object):
+    '''
+    Flask extension, JSONProvider(app) or init_app(app) later. Installs
+    JSONEncoder, so flask.jsonify knows the same types as jsonify().
+    '''
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.json_encoder = JSONEncoder
+        app.extensions['json_provider'] = self
@@ -0,0 +1,173 @@
+import csv
+import io
+import itertools
+import json
+import time
+from sqlalchemy import text
+
+from http_cache import bump_table_versions
+from models import db, process_cache, search_index, adjust_category_stats, category_map
+
+'''
+Bulk question loader
+    streams a CSV file with a question,answer,category,difficulty header,
+    or a JSONL file with one such object per line, into the questions
+    table. Rows go through a temporary staging table one batch at a time,
+    so memory stays bounded by the batch size, and only questions whose
+    text is not in the table yet are copied over. Loading the same file
+    twice adds nothing the second time. Batches run and commit on the
+    session, so an import joins whatever transaction the caller set up.
+'''
+LOAD_BATCH_SIZE = 5000
+
+STAGING_DDL = text('CREATE TEMP TABLE IF NOT EXISTS questions_import '
+  '(position integer, question text, answer text, category varchar, difficulty integer)')
+
+# the first row of every question text of the batch that is not in the table yet
+NEW_QUESTIONS = '''
+  FROM questions_import
+  WHERE position IN (SELECT min(position) FROM questions_import GROUP BY question)
+    AND NOT EXISTS (SELECT 1 FROM questions WHERE questions.question = questions_import.question)
+'''
+
+COUNT_NEW_QUESTIONS = text(
+  'SELECT category, difficulty, count(*)' + NEW_QUESTIONS + 'GROUP BY category, difficulty')
+
+COPY_NEW_QUESTIONS = text(
+  'INSERT INTO questions (question, answer, category, difficulty) '
+  'SELECT question, answer, category, difficulty' + NEW_QUESTIONS + 'ORDER BY position')
+
+class LoadError(Exception):
+  '''
+  Raised when a question file can not be read at all.
+  '''
+  pass
+
+def read_jsonl(file):
+  for line in file:
+    if line.strip():
+      try:
+        yield json.loads(line)
+      except ValueError:
+        # rejected by clean_row like any other malformed row
+        yield None
+
+def read_rows(file, format):
+  if format == 'csv':
+    return csv.DictReader(file)
+  if format == 'jsonl':
+    return read_jsonl(file)
+  raise LoadError('unknown format {!r}, expected csv or jsonl'.format(format))
+
+def file_format(path):
+  return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def clean_row(row, categories):
+  '''
+  Coerces one row to questions column values, raises ValueError if it
+  can't. category may be a category id or its name.
+  '''
+  if not isinstance(row, dict):
+    raise ValueError('expected an object with question, answer, category and difficulty')
+  question = (row.get('question') or '').strip()
+  answer = (row.get('answer') or '').strip()
+  if not question or not answer:
+    raise ValueError('missing question or answer')
+  category = str(row.get('category') or '').strip()
+  category_id = categories.get(category.lower())
+  if category_id is None:
+    raise ValueError('unknown category {!r}'.format(category))
+  try:
+    difficulty = int(row.get('difficulty'))
+  except (TypeError, ValueError):
+    raise ValueError('difficulty must be an integer')
+  return {
+    'question': question,
+    'answer': answer,
+    'category': str(category_id),
+    'difficulty': difficulty
+  }
+
+def stage_batch(connection, rows):
+  '''
+  Fills questions_import with rows, through COPY on Postgres and a single
+  executemany elsewhere.
+  '''
+  if connection.dialect.name == 'postgresql':
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+      writer.writerow([row['position'], row['question'], row['answer'], row['category'], row['difficulty']])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+      'COPY questions_import (position, question, answer, category, difficulty) FROM STDIN WITH (FORMAT csv)',
+      buffer)
+  else:
+    connection.execute(text(
+      'INSERT INTO questions_import (position, question, answer, category, difficulty) '
+      'VALUES (:position, :question, :answer, :category, :difficulty)'), rows)
+
+def load_questions(file, format='csv', batch_size=LOAD_BATCH_SIZE, report=None):
+  '''
+  Loads the questions of an open text file, committing every batch.
+  report is called with the running totals after each batch.
+  Returns the totals: rows read, inserted, skipped as duplicates and
+  rejected, the first rejected rows and the rows per second.
+  '''
+  # one lookup resolves category names and ids for the whole file
+  categories = {}
+  for id, type in category_map().items():
+    categories[str(id)] = id
+    categories[type.lower()] = id
+
+  totals = {'read': 0, 'inserted': 0, 'duplicates': 0, 'rejected': 0, 'errors': [], 'rows_per_second': 0.0}
+  rows = enumerate(read_rows(file, format), start=1)
+  started = time.perf_counter()
+  while True:
+    chunk = list(itertools.islice(rows, batch_size))
+    if not chunk:
+      break
+    batch = []
+    for position, row in chunk:
+      try:
+        values = clean_row(row, categories)
+      except ValueError as e:
+        totals['rejected'] += 1
+        if len(totals['errors']) < 100:
+          totals['errors'].append({'row': position, 'error': str(e)})
+        continue
+      values['position'] = position
+      batch.append(values)
+
+    inserted = 0
+    if batch:
+      try:
+        # the pool may hand out another connection per batch, so the
+        # staging table only lives for the batch's transaction
+        connection = db.session.connection()
+        connection.execute(STAGING_DDL)
+        stage_batch(connection, batch)
+        # core inserts skip the Question mapper events that keep category_stats
+        adjust_category_stats(connection, {
+          (category, difficulty): count
+          for category, difficulty, count in connection.execute(COUNT_NEW_QUESTIONS)})
+        inserted = connection.execute(COPY_NEW_QUESTIONS).rowcount
+        if inserted:
+          bump_table_versions(connection, 'questions')
+        connection.execute(text('DROP TABLE questions_import'))
+        db.session.commit()
+      except Exception:
+        db.session.rollback()
+        raise
+    totals['read'] += len(chunk)
+    totals['inserted'] += inserted
+    totals['duplicates'] += len(batch) - inserted
+    totals['rows_per_second'] = totals['read'] / (time.perf_counter() - started)
+    if report is not None:
+      report(totals)
+
+  # nor do they queue the cache and search index updates
+  process_cache.invalidate('question_count', 'page_anchors', 'quiz_ids')
+  search_index.clear()
+  return totals
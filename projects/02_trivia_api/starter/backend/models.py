@@ -1,8 +1,18 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import math
+import random
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from sqlalchemy import Column, String, Integer, Float, Text, Index, create_engine, event, func, inspect, literal_column, text
+from sqlalchemy.orm import Session, object_session
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from http_cache import bump_table_versions, request_versions
+
 database_name = "trivia"
 database_path = "postgres://{}/{}".format('localhost:5432', database_name)
 
@@ -18,6 +28,29 @@ def setup_db(app, database_path=database_path):
     db.app = app
     db.init_app(app)
     db.create_all()
+    ensure_indexes()
+
+'''
+ensure_indexes()
+    create_all() skips tables that already exist, e.g. ones restored from
+    trivia.psql, so indexes added since then are created here when missing
+'''
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)',
+    'CREATE INDEX IF NOT EXISTS ix_questions_question ON questions (question)',
+]
+POSTGRES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_questions_question_tsv ON questions "
+    "USING gin (to_tsvector('english', coalesce(question, '')))",
+]
+
+def ensure_indexes():
+    statements = INDEXES
+    if db.engine.dialect.name == 'postgresql':
+        statements = statements + POSTGRES_INDEXES
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
 
 '''
 Question
@@ -25,6 +58,10 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_question', 'question'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
@@ -75,4 +112,485 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+CategoryStats
+    number of questions per category and difficulty, kept current by the
+    Question mapper events so totals and histograms never count questions
+'''
+class CategoryStats(db.Model):
+  __tablename__ = 'category_stats'
+
+  category = Column(String, primary_key=True)
+  difficulty = Column(Integer, primary_key=True, autoincrement=False)
+  question_count = Column(Integer, nullable=False, default=0)
+
+def stats_key(category, difficulty):
+  # primary key columns can't hold the NULLs the questions table allows
+  return (category or '', difficulty or 0)
+
+# works on Postgres 9.5+ and SQLite 3.24+
+ADJUST_CATEGORY_STATS = text('''
+  INSERT INTO category_stats (category, difficulty, question_count)
+  VALUES (:category, :difficulty, :delta)
+  ON CONFLICT (category, difficulty)
+  DO UPDATE SET question_count = category_stats.question_count + excluded.question_count
+''')
+
+def adjust_category_stats(connection, changes):
+  '''
+  Adds the deltas of changes, a dict {(category, difficulty): delta},
+  to the stored counts with one upsert per changed key.
+  '''
+  params = [{'category': category, 'difficulty': difficulty, 'delta': delta}
+    for (category, difficulty), delta in changes.items() if delta]
+  if params:
+    connection.execute(ADJUST_CATEGORY_STATS, params)
+
+def question_stats_key(question, history=False):
+  '''
+  the stats key of question, or its key before the pending update
+  '''
+  values = []
+  for key in ('category', 'difficulty'):
+    value = getattr(question, key)
+    if history:
+      deleted = inspect(question).attrs[key].history.deleted
+      if deleted:
+        value = deleted[0]
+    values.append(value)
+  return stats_key(*values)
+
+@event.listens_for(Question, 'after_insert')
+def count_inserted_question(mapper, connection, question):
+  adjust_category_stats(connection, {question_stats_key(question): 1})
+
+@event.listens_for(Question, 'after_delete')
+def count_deleted_question(mapper, connection, question):
+  adjust_category_stats(connection, {question_stats_key(question, history=True): -1})
+
+@event.listens_for(Question, 'after_update')
+def count_updated_question(mapper, connection, question):
+  before = question_stats_key(question, history=True)
+  after = question_stats_key(question)
+  if before != after:
+    adjust_category_stats(connection, {before: -1, after: 1})
+
+@event.listens_for(CategoryStats.__table__, 'after_create')
+def mark_category_stats_created(table, connection, **kw):
+  connection.info['backfill_category_stats'] = True
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def backfill_category_stats(metadata, connection, **kw):
+  # the summary table was just added next to existing questions
+  if connection.info.pop('backfill_category_stats', False):
+    connection.execute(text('''
+      INSERT INTO category_stats (category, difficulty, question_count)
+      SELECT coalesce(category, ''), coalesce(difficulty, 0), count(*) FROM questions
+      GROUP BY coalesce(category, ''), coalesce(difficulty, 0)
+    '''))
+
+'''
+rebuild_category_stats()
+    recounts the questions of every category and difficulty from scratch
+    and replaces the stored counts. Returns the keys that drifted as a list
+    of (category, difficulty, stored count, actual count).
+'''
+def rebuild_category_stats():
+  actual = {}
+  for category, difficulty, count in db.session.query(
+      Question.category, Question.difficulty, func.count(Question.id)) \
+      .group_by(Question.category, Question.difficulty):
+    key = stats_key(category, difficulty)
+    actual[key] = actual.get(key, 0) + count
+  stored = {(stats.category, stats.difficulty): stats.question_count for stats in CategoryStats.query}
+
+  drift = []
+  for key in sorted(set(actual) | set(stored)):
+    if actual.get(key, 0) != stored.get(key, 0):
+      drift.append(key + (stored.get(key, 0), actual.get(key, 0)))
+  if drift:
+    connection = db.session.connection()
+    connection.execute(CategoryStats.__table__.delete())
+    connection.execute(CategoryStats.__table__.insert(), [
+      {'category': category, 'difficulty': difficulty, 'question_count': count}
+      for (category, difficulty), count in actual.items()])
+    bump_table_versions(connection, 'category_stats')
+  db.session.commit()
+  return drift
+
+'''
+category_stats()
+    {category id: {'total_questions': n, 'difficulties': {difficulty: n}}}
+    read from the summary table only
+'''
+def category_stats():
+  stats = {}
+  for row in CategoryStats.query.filter(CategoryStats.question_count > 0) \
+      .order_by(CategoryStats.category, CategoryStats.difficulty):
+    category = stats.setdefault(row.category, {'total_questions': 0, 'difficulties': {}})
+    category['total_questions'] += row.question_count
+    category['difficulties'][row.difficulty] = row.question_count
+  return stats
+
+'''
+QuizSession
+    a quiz played through /quizzes/sessions, shared by every worker.
+    played is the JSON list of the question ids sent so far. Rows are
+    written with Core statements, so turns don't bump table_versions.
+'''
+class QuizSession(db.Model):
+  __tablename__ = 'quiz_sessions'
+
+  id = Column(String, primary_key=True)
+  category = Column(String)
+  played = Column(Text, nullable=False, default='[]')
+  expires = Column(Float, nullable=False, index=True)
+
+'''
+ProcessCache
+    values that are expensive to read but rarely change, kept per worker.
+    Commits that write a Question or Category drop the affected keys in
+    this process, other workers pick the change up once ttl runs out.
+'''
+CACHE_TTL = 60
+
+class ProcessCache(object):
+  def __init__(self, ttl=CACHE_TTL):
+    self.ttl = ttl
+    self.values = {}
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get(self, key, load):
+    now = time.time()
+    # the table versions this request checked, values built from others
+    # are loaded again rather than sent under its ETag
+    versions = request_versions(key_tables(key))
+    with self.lock:
+      entry = self.values.get(key)
+      if entry is not None and entry[0] > now and versions in (None, entry[2]):
+        return entry[1]
+      generation = self.generation
+    value = load()
+    with self.lock:
+      # don't store a value loaded while an invalidation ran
+      if generation == self.generation:
+        self.values[key] = (now + self.ttl, value, versions)
+    return value
+
+  def invalidate(self, *names):
+    '''
+    drops every key named in names, keys may carry a ':'-separated suffix
+    '''
+    with self.lock:
+      self.generation += 1
+      for key in list(self.values):
+        if key.split(':')[0] in names:
+          del self.values[key]
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.values.clear()
+
+process_cache = ProcessCache()
+
+def queue_invalidation(*names):
+  def listener(mapper, connection, target):
+    object_session(target).info.setdefault('invalidate', set()).update(names)
+  return listener
+
+for event_name in ('after_insert', 'after_delete'):
+  event.listen(Question, event_name, queue_invalidation('question_count', 'page_anchors', 'quiz_ids'))
+event.listen(Question, 'after_update', queue_invalidation('question_count', 'page_anchors', 'quiz_ids'))
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+  event.listen(Category, event_name, queue_invalidation('categories'))
+
+# the cached values that depend on each table
+TABLE_CACHE_KEYS = {
+  'questions': ('question_count', 'page_anchors', 'quiz_ids'),
+  'categories': ('categories',)
+}
+
+def key_tables(key):
+  '''
+  the tables the cached value of key is read from
+  '''
+  name = key.split(':')[0]
+  return [table for table, keys in sorted(TABLE_CACHE_KEYS.items()) if name in keys]
+
+def invalidate_tables(names):
+  '''
+  drops the cached values of tables written outside this process, as
+  noticed by the version checks of HTTPCache
+  '''
+  keys = [key for name in names for key in TABLE_CACHE_KEYS.get(name, ())]
+  if keys:
+    process_cache.invalidate(*keys)
+  if 'questions' in names:
+    # commit hooks only keep the index in step with this process' writes,
+    # so it is built again from the table on the next search
+    search_index.clear()
+
+def queue_search_update(deleted):
+  def listener(mapper, connection, target):
+    update = (target.id, None if deleted else target.question)
+    object_session(target).info.setdefault('search', []).append(update)
+  return listener
+
+event.listen(Question, 'after_insert', queue_search_update(False))
+event.listen(Question, 'after_update', queue_search_update(False))
+event.listen(Question, 'after_delete', queue_search_update(True))
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+  names = session.info.pop('invalidate', None)
+  if names:
+    process_cache.invalidate(*names)
+  updates = session.info.pop('search', None)
+  if updates:
+    search_index.update(updates)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_rolled_back(session, previous_transaction):
+  session.info.pop('invalidate', None)
+  session.info.pop('search', None)
+
+'''
+QuestionSearchIndex
+    inverted index of the question text for databases without full text
+    search, i.e. SQLite and the test runs. It is built from the questions
+    table on the first search and then kept current by the commits of this
+    process, so it only suits single process deployments.
+'''
+def tokenize(body):
+  return re.findall(r'\w+', (body or '').lower())
+
+class QuestionSearchIndex(object):
+  def __init__(self):
+    self.postings = {}  # token -> {question id: term frequency}
+    self.documents = {}  # question id -> {token: term frequency}
+    self.tokens = []  # sorted vocabulary for prefix lookups
+    self.built = False
+    self.lock = threading.RLock()
+
+  def build(self):
+    with self.lock:
+      if self.built:
+        return
+      self.clear()
+      for id, question in db.session.query(Question.id, Question.question).yield_per(10000):
+        self.add(id, question)
+      self.tokens.sort()
+      self.built = True
+
+  def clear(self):
+    with self.lock:
+      self.postings.clear()
+      self.documents.clear()
+      del self.tokens[:]
+      self.built = False
+
+  def add(self, id, body):
+    frequencies = {}
+    for token in tokenize(body):
+      frequencies[token] = frequencies.get(token, 0) + 1
+    self.documents[id] = frequencies
+    for token, frequency in frequencies.items():
+      postings = self.postings.get(token)
+      if postings is None:
+        postings = self.postings[token] = {}
+        if self.built:
+          self.tokens.insert(bisect_left(self.tokens, token), token)
+        else:
+          # build() sorts once at the end
+          self.tokens.append(token)
+      postings[id] = frequency
+
+  def remove(self, id):
+    for token in self.documents.pop(id, ()):
+      postings = self.postings[token]
+      del postings[id]
+      if not postings:
+        del self.postings[token]
+        del self.tokens[bisect_left(self.tokens, token)]
+
+  def update(self, updates):
+    '''
+    applies committed (id, body) pairs, body is None for deleted questions
+    '''
+    with self.lock:
+      if not self.built:
+        return
+      for id, body in updates:
+        self.remove(id)
+        if body is not None:
+          self.add(id, body)
+
+  def expand(self, prefix):
+    start = bisect_left(self.tokens, prefix)
+    end = bisect_left(self.tokens, prefix + '\uffff')
+    return self.tokens[start:end]
+
+  def search(self, search_term):
+    '''
+    ids of the questions containing a word starting with every term,
+    best matches first. Scores are tf-idf summed over the matched words.
+    '''
+    self.build()
+    with self.lock:
+      scores = None
+      for term in set(tokenize(search_term)):
+        term_scores = {}
+        for token in self.expand(term):
+          postings = self.postings[token]
+          idf = math.log(1 + len(self.documents) / len(postings))
+          for id, frequency in postings.items():
+            term_scores[id] = term_scores.get(id, 0.0) + frequency * idf
+        if scores is None:
+          scores = term_scores
+        else:
+          scores = {id: score + term_scores[id] for id, score in scores.items() if id in term_scores}
+        if not scores:
+          return []
+    return sorted(scores or (), key=lambda id: (-scores[id], id))
+
+search_index = QuestionSearchIndex()
+
+'''
+search_questions(search_term, page, per_page)
+    returns one page of the questions matching every word of search_term
+    as a prefix, best matches first, and the total number of matches.
+    Postgres ranks with ts_rank over the GIN indexed tsvector, other
+    databases use the in-process QuestionSearchIndex.
+'''
+def search_questions(search_term, page=1, per_page=10):
+  terms = tokenize(search_term)
+  if not terms:
+    return [], 0
+
+  if db.engine.dialect.name != 'postgresql':
+    ids = search_index.search(search_term)
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    questions = {question.id: question for question in Question.query.filter(Question.id.in_(page_ids))}
+    return [questions[id] for id in page_ids if id in questions], len(ids)
+
+  # must match the expression of ix_questions_question_tsv
+  document = func.to_tsvector(literal_column("'english'"), func.coalesce(Question.question, literal_column("''")))
+  query = func.to_tsquery(literal_column("'english'"), ' & '.join(term + ':*' for term in terms))
+  total = func.count().over().label('total')
+  rows = db.session.query(Question, total) \
+    .filter(document.op('@@')(query)) \
+    .order_by(func.ts_rank(document, query).desc(), Question.id) \
+    .limit(per_page).offset((page - 1) * per_page).all()
+  return [question for question, _ in rows], rows[0].total if rows else 0
+
+'''
+category_map()
+    {id: type} of every category
+'''
+def category_map():
+  return process_cache.get('categories', lambda: {
+    category.id: category.type for category in Category.query.order_by(Category.id)
+  })
+
+'''
+question_count(category)
+    number of questions, of one category or of all, summed from the
+    category_stats summary table
+'''
+def question_count(category=None):
+  def load():
+    query = db.session.query(func.coalesce(func.sum(CategoryStats.question_count), 0))
+    if category is not None:
+      query = query.filter(CategoryStats.category == category)
+    return query.scalar()
+  return process_cache.get('question_count:{}'.format('all' if category is None else category), load)
+
+'''
+page_anchors(per_page, category)
+    id of the first question on each page of per_page questions, of one
+    category or of all
+'''
+def page_anchors(per_page, category=None):
+  def load():
+    row_number = func.row_number().over(order_by=Question.id).label('row_number')
+    numbered = db.session.query(Question.id, row_number)
+    if category is not None:
+      numbered = numbered.filter(Question.category == category)
+    numbered = numbered.subquery()
+    return [id for id, in db.session.query(numbered.c.id)
+      .filter((numbered.c.row_number - 1) % per_page == 0)
+      .order_by(numbered.c.id)]
+  return process_cache.get('page_anchors:{}:{}'.format(per_page, 'all' if category is None else category), load)
+
+'''
+questions_page(after, page, per_page, category)
+    returns the questions of one page and the cursor of the next one.
+    Pages are read by keyset on id: after is the last id of the previous
+    page, or page is turned into its first id through the cached page
+    anchors, so page 10000 costs the same index range scan as page 1.
+'''
+def questions_page(after=None, page=1, per_page=10, category=None):
+  query = Question.query.order_by(Question.id)
+  if category is not None:
+    query = query.filter(Question.category == category)
+  if after is not None:
+    query = query.filter(Question.id > after)
+  elif page > 1:
+    anchors = page_anchors(per_page, category)
+    if page > len(anchors):
+      return [], None
+    query = query.filter(Question.id >= anchors[page - 1])
+  questions = query.limit(per_page + 1).all()
+  next_cursor = questions[per_page - 1].id if len(questions) > per_page else None
+  return questions[:per_page], next_cursor
+
+'''
+quiz_question_ids(category)
+    compact array of the ids of every question in category, or of all
+    questions when category is None, read once per cache lifetime
+'''
+def quiz_question_ids(category=None):
+  def load():
+    query = db.session.query(Question.id).order_by(Question.id)
+    if category is not None:
+      query = query.filter(Question.category == category)
+    return array('l', (id for id, in query))
+  return process_cache.get('quiz_ids:{}'.format('all' if category is None else category), load)
+
+# random picks tried before falling back to scanning the remaining ids
+QUIZ_RANDOM_TRIES = 8
+
+'''
+random_question(category, previous_questions)
+    a random question of category, or of any category when it is None,
+    that is not in previous_questions. Picks random positions in the
+    cached id array and rejects previous ids with a set lookup, so a turn
+    reads one row by primary key. Only when most of the category has been
+    played are the remaining ids collected from the array.
+    Returns None once every question has been played.
+'''
+def random_question(category=None, previous_questions=()):
+  ids = quiz_question_ids(category)
+  previous = set(previous_questions)
+  for _ in range(QUIZ_RANDOM_TRIES):
+    if not ids:
+      return None
+    id = ids[random.randrange(len(ids))]
+    if id in previous:
+      continue
+    question = Question.query.get(id)
+    if question is not None:
+      return question
+    # deleted by another worker since the ids were cached
+    previous.add(id)
+
+  remaining = [id for id in ids if id not in previous]
+  while remaining:
+    question = Question.query.get(remaining.pop(random.randrange(len(remaining))))
+    if question is not None:
+      return question
+  return None
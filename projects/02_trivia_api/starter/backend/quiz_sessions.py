@@ -0,0 +1,82 @@
+import json
+import secrets
+import time
+from sqlalchemy import func, select
+
+from models import db, QuizSession, quiz_question_ids, random_question
+
+'''
+Quiz sessions
+    the server remembers which questions a quiz has played, so a turn
+    only sends the session id instead of every previous question. The
+    sessions live in the quiz_sessions table, so any worker can play the
+    next turn.
+'''
+QUIZ_SESSION_TTL = 1800
+
+class QuizSessionStore(object):
+  '''
+  Sessions in the quiz_sessions table. A turn locks the session row,
+  picks a question with random_question() and appends it to the played
+  ids, so the row grows with the turns played and not with the size of
+  the category. Expired sessions are deleted whenever one is created.
+  '''
+  def __init__(self, ttl=QUIZ_SESSION_TTL):
+    self.ttl = ttl
+    self.table = QuizSession.__table__
+
+  def create(self, category=None):
+    '''
+    starts a quiz over category, or over every category when it is None,
+    and returns its session id and number of questions
+    '''
+    total_questions = len(quiz_question_ids(category))
+    session_id = secrets.token_urlsafe(16)
+    now = time.time()
+    db.session.execute(self.table.delete().where(self.table.c.expires < now))
+    db.session.execute(self.table.insert().values(
+      id=session_id, category=category, played='[]', expires=now + self.ttl))
+    db.session.commit()
+    return session_id, total_questions
+
+  def next_question(self, session_id):
+    '''
+    the next question of the session, None once all were played.
+    Raises KeyError for unknown or expired sessions.
+    '''
+    now = time.time()
+    # concurrent turns of one quiz wait here, so none replays a question
+    row = db.session.execute(select([self.table.c.category, self.table.c.played, self.table.c.expires])
+      .where(self.table.c.id == session_id).with_for_update()).first()
+    if row is None or row.expires < now:
+      if row is not None:
+        db.session.execute(self.table.delete().where(self.table.c.id == session_id))
+      db.session.commit()
+      raise KeyError(session_id)
+
+    played = json.loads(row.played)
+    question = random_question(row.category, played)
+    if question is not None:
+      played.append(question.id)
+      # keeps its loaded columns through the commit
+      db.session.expunge(question)
+    db.session.execute(self.table.update().where(self.table.c.id == session_id)
+      .values(played=json.dumps(played), expires=now + self.ttl))
+    db.session.commit()
+    return question
+
+  def clear(self):
+    db.session.execute(self.table.delete())
+    db.session.commit()
+
+  def stats(self):
+    active, size = db.session.execute(
+      select([func.count(), func.coalesce(func.sum(func.length(self.table.c.played)), 0)])
+      .where(self.table.c.expires >= time.time())).first()
+    return {
+      'active_sessions': active,
+      'bytes': size,
+      'bytes_per_session': size / active if active else 0.0
+    }
+
+quiz_sessions = QuizSessionStore()
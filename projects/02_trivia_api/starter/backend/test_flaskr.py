@@ -1,10 +1,57 @@
+import datetime
+import gzip
+import io
 import os
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
+from sqlalchemy import event
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import QUESTIONS_PER_PAGE, create_app
+from fixtures import DatabaseFixture, database_url
+from models import db, process_cache, search_index, adjust_category_stats, rebuild_category_stats, CategoryStats, Question, \
+    Category, QuizSession
+from loader import load_questions
+from sql_stats import statement_budget
+from http_cache import bump_table_versions
+from json_provider import jsonify, stream_array
+
+
+@contextmanager
+def count_statements(engine):
+    """Collects the SQL statements run on engine inside the block."""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def seed(num_questions=25):
+    for type in ('Science', 'Art', 'Geography'):
+        db.session.add(Category(type))
+    for i in range(num_questions):
+        db.session.add(Question('Question {}?'.format(i), 'Answer {}'.format(i), str(i % 3 + 1), i % 5 + 1))
+
+
+database = None
+
+def setUpModule():
+    """Creates the schema and the seed data once for every test."""
+    global database, other_app
+    database = DatabaseFixture(database_url(), seed)
+    # a second app on the same database, like another worker
+    other_app = create_app({'DATABASE_PATH': database_url(), 'TESTING': True})
+    db.app = database.app
+
+def tearDownModule():
+    if os.environ.get('TRIVIA_TEST_SQL_REPORT'):
+        database.report()
+    database.close()
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,29 +59,528 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = database.app
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+        database.begin()
+        process_cache.clear()
+        search_index.clear()
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        database.rollback(self.id())
+
+    def test_get_categories(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['categories'], {'1': 'Science', '2': 'Art', '3': 'Geography'})
+
+    def test_get_paginated_questions(self):
+        res = self.client().get('/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertEqual(data['total_questions'], 25)
+        self.assertEqual(len(data['categories']), 3)
+        self.assertEqual(data['next_cursor'], data['questions'][-1]['id'])
+
+    def test_pages_match_cursor_walk(self):
+        walked = []
+        after = None
+        while True:
+            url = '/questions' if after is None else '/questions?after={}'.format(after)
+            data = json.loads(self.client().get(url).data)
+            walked.append([question['id'] for question in data['questions']])
+            after = data['next_cursor']
+            if after is None:
+                break
+
+        paged = []
+        for page in range(1, len(walked) + 1):
+            data = json.loads(self.client().get('/questions?page={}'.format(page)).data)
+            paged.append([question['id'] for question in data['questions']])
+
+        self.assertEqual(walked, paged)
+        self.assertEqual([len(ids) for ids in walked], [10, 10, 5])
+
+    def test_404_beyond_last_page(self):
+        res = self.client().get('/questions?page=1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_400_invalid_page(self):
+        res = self.client().get('/questions?page=0')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_deep_page_reads_one_page_of_rows(self):
+        self.client().get('/questions?page=3')
+        with count_statements(db.engine) as statements:
+            res = self.client().get('/questions?page=3')
+
+        self.assertEqual(res.status_code, 200)
+        # count, categories and page anchors come from the process cache,
+        # the other statement reads the table versions of the ETag
+        statements = [statement for statement in statements if 'table_versions' not in statement]
+        self.assertEqual(len(statements), 1)
+        self.assertIn('LIMIT', statements[0].upper())
+        self.assertNotIn('COUNT', statements[0].upper())
+
+    def test_question_writes_invalidate_count_and_pages(self):
+        self.client().get('/questions?page=3')
+        Question('Late question?', 'Late answer', '1', 1).insert()
+
+        data = json.loads(self.client().get('/questions?page=3').data)
+        self.assertEqual(data['total_questions'], 26)
+        self.assertEqual(len(data['questions']), 6)
+
+        Question.query.order_by(Question.id).first().delete()
+        data = json.loads(self.client().get('/questions?page=3').data)
+        self.assertEqual(data['total_questions'], 25)
+        self.assertEqual(len(data['questions']), 5)
+
+    def test_category_writes_invalidate_category_map(self):
+        self.client().get('/categories')
+        db.session.add(Category('History'))
+        db.session.commit()
+
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['categories']['4'], 'History')
+
+    def test_rolled_back_writes_keep_cache(self):
+        self.client().get('/categories')
+        db.session.add(Category('History'))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertIn('categories', process_cache.values)
+
+    def test_cached_value_of_other_versions_is_reloaded(self):
+        self.client().get('/categories')
+        # as stored by a request that read older versions and finished its
+        # load after the observers of the newer ones ran
+        expires, categories, versions = process_cache.values['categories']
+        process_cache.values['categories'] = (expires, {1: 'Stale'}, ('older',))
+
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['categories']['1'], 'Science')
+        self.assertEqual(process_cache.values['categories'][2], versions)
+
+    def play(self, category_id=0, previous_questions=()):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': list(previous_questions),
+            'quiz_category': {'type': 'any', 'id': category_id}
+        })
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['question']
+
+    def test_quiz_plays_every_question_of_a_category_once(self):
+        played = []
+        while True:
+            question = self.play(2, played)
+            if question is None:
+                break
+            self.assertEqual(question['category'], '2')
+            played.append(question['id'])
+
+        expected = [question.id for question in Question.query.filter_by(category='2')]
+        self.assertEqual(sorted(played), sorted(expected))
+
+    def test_quiz_all_categories(self):
+        res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'type': 'click'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIsNotNone(data['question'])
+
+    def test_quiz_turn_reads_one_row(self):
+        self.play(1)
+        with count_statements(db.engine) as statements:
+            self.play(1, [1, 4, 7])
+
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('random', statements[0].lower())
+
+    def test_quiz_sees_new_questions(self):
+        played = [question.id for question in Question.query.filter_by(category='3')]
+        self.assertIsNone(self.play(3, played))
+
+        Question('Late question?', 'Late answer', '3', 1).insert()
+        self.assertEqual(self.play(3, played)['question'], 'Late question?')
+
+    def test_422_quiz_with_invalid_previous_questions(self):
+        res = self.client().post('/quizzes', json={'previous_questions': ['one'], 'quiz_category': {'id': 1}})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_400_quiz_without_body(self):
+        res = self.client().post('/quizzes')
+
+        self.assertEqual(res.status_code, 400)
+
+    def start_quiz(self, category_id=0):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': category_id}})
+        self.assertEqual(res.status_code, 201)
+        return json.loads(res.data)
+
+    def next_question(self, session_id):
+        return self.client().post('/quizzes/sessions/{}/next'.format(session_id))
+
+    def test_quiz_session_plays_every_question_once(self):
+        quiz = self.start_quiz(2)
+        played = []
+        while True:
+            res = self.next_question(quiz['session_id'])
+            self.assertEqual(res.status_code, 200)
+            question = json.loads(res.data)['question']
+            if question is None:
+                break
+            played.append(question['id'])
+
+        expected = [question.id for question in Question.query.filter_by(category='2')]
+        self.assertEqual(quiz['total_questions'], len(expected))
+        self.assertEqual(sorted(played), sorted(expected))
+
+    def test_quiz_session_turn_reads_one_question(self):
+        quiz = self.start_quiz()
+        with count_statements(db.engine) as statements:
+            self.next_question(quiz['session_id'])
+
+        self.assertEqual(len([s for s in statements if 'FROM questions' in s]), 1)
+        # the session row is read and written, table_versions isn't touched
+        self.assertEqual(len([s for s in statements if 'quiz_sessions' in s]), 2)
+        self.assertFalse([s for s in statements if 'table_versions' in s])
+
+    def test_quiz_session_continues_in_another_app(self):
+        quiz = self.start_quiz(2)
+        first = json.loads(self.next_question(quiz['session_id']).data)['question']
+
+        # the other worker has caches of its own
+        process_cache.clear()
+        played = [first['id']]
+        while True:
+            res = other_app.test_client().post('/quizzes/sessions/{}/next'.format(quiz['session_id']))
+            self.assertEqual(res.status_code, 200)
+            question = json.loads(res.data)['question']
+            if question is None:
+                break
+            played.append(question['id'])
+
+        expected = [question.id for question in Question.query.filter_by(category='2')]
+        self.assertEqual(sorted(played), sorted(expected))
+
+    def test_quiz_session_skips_deleted_questions(self):
+        quiz = self.start_quiz(3)
+        for question in Question.query.filter_by(category='3').all()[1:]:
+            question.delete()
+
+        first = json.loads(self.next_question(quiz['session_id']).data)['question']
+        second = json.loads(self.next_question(quiz['session_id']).data)['question']
+        self.assertEqual(first['category'], '3')
+        self.assertIsNone(second)
+
+    def test_404_unknown_quiz_session(self):
+        res = self.next_question('missing')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_quiz_sessions_expire(self):
+        quiz = self.start_quiz()
+        session = QuizSession.query.get(quiz['session_id'])
+        session.expires = 0
+        db.session.commit()
+
+        self.assertEqual(self.next_question(quiz['session_id']).status_code, 404)
+        self.assertIsNone(QuizSession.query.get(quiz['session_id']))
+
+    def test_quiz_session_metrics(self):
+        quiz = self.start_quiz()
+        self.next_question(quiz['session_id'])
+        self.start_quiz(1)
+        data = json.loads(self.client().get('/metrics/quiz-sessions').data)
+
+        self.assertEqual(data['active_sessions'], 2)
+        self.assertGreater(data['bytes_per_session'], 0)
+
+    def search(self, search_term, page=1):
+        res = self.client().post('/questions/search', json={'searchTerm': search_term, 'page': page})
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def seed_search(self):
+        Question('What is the heaviest organ in the human body?', 'The Liver', '1', 4).insert()
+        Question('Which organ pumps blood through the body?', 'The heart', '1', 1).insert()
+        Question('Hematology is a branch of medicine involving the study of what?', 'Blood', '1', 4).insert()
+
+    def test_search_questions_by_prefix(self):
+        self.seed_search()
+        data = self.search('blo')
+
+        self.assertTrue(data['success'])
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['answer'], 'The heart')
+
+    def test_search_requires_every_term(self):
+        self.seed_search()
+        data = self.search('organ heav')
+
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['answer'], 'The Liver')
+
+    def test_search_ranks_and_paginates(self):
+        self.seed_search()
+        first = self.search('question')
+        second = self.search('question', page=2)
+        third = self.search('question', page=3)
+
+        self.assertEqual(first['total_questions'], 25)
+        self.assertEqual(len(first['questions']), 10)
+        ids = [q['id'] for data in (first, second, third) for q in data['questions']]
+        self.assertEqual(len(set(ids)), 25)
+
+    def test_search_follows_writes(self):
+        self.assertEqual(self.search('heaviest')['total_questions'], 0)
+        self.seed_search()
+        self.assertEqual(self.search('heaviest')['total_questions'], 1)
+
+        question = Question.query.filter_by(answer='The Liver').one()
+        question.question = 'Which organ filters toxins?'
+        question.update()
+        self.assertEqual(self.search('heaviest')['total_questions'], 0)
+        self.assertEqual(self.search('toxin')['total_questions'], 1)
+
+        question.delete()
+        self.assertEqual(self.search('toxin')['total_questions'], 0)
+
+    def test_search_without_words(self):
+        data = self.search('?!')
+
+        self.assertEqual(data['total_questions'], 0)
+        self.assertEqual(data['questions'], [])
+
+    def test_422_search_without_term(self):
+        res = self.client().post('/questions/search', json={'page': 1})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_load_questions_from_csv(self):
+        bank = io.StringIO(
+            'question,answer,category,difficulty\n'
+            'Who painted the Mona Lisa?,Leonardo,art,2\n'
+            'What is H2O?,Water,1,1\n'
+            'Who painted the Mona Lisa?,Da Vinci,Art,3\n'
+            'Question 4?,Answer 4,Science,1\n'
+            'Where is Agra?,India,Cooking,2\n'
+            'What is 2 + 2?,Four,Science,easy\n')
+        totals = load_questions(bank, 'csv', batch_size=2)
+
+        self.assertEqual(totals['read'], 6)
+        self.assertEqual(totals['inserted'], 2)
+        # repeated in the file and already in the table
+        self.assertEqual(totals['duplicates'], 2)
+        self.assertEqual(totals['rejected'], 2)
+        self.assertEqual([error['row'] for error in totals['errors']], [5, 6])
+        mona_lisa = Question.query.filter_by(question='Who painted the Mona Lisa?').one()
+        self.assertEqual((mona_lisa.answer, mona_lisa.category), ('Leonardo', '2'))
+        self.assertEqual(json.loads(self.client().get('/questions').data)['total_questions'], 27)
+
+    def test_load_questions_from_jsonl_twice(self):
+        lines = [json.dumps({'question': 'Bank question {}?'.format(i), 'answer': 'A', 'category': 'Geography', 'difficulty': 3})
+                 for i in range(120)]
+        bank = '\n'.join(lines + ['not json']) + '\n'
+
+        first = load_questions(io.StringIO(bank), 'jsonl', batch_size=50)
+        second = load_questions(io.StringIO(bank), 'jsonl', batch_size=50)
+
+        self.assertEqual((first['inserted'], first['rejected']), (120, 1))
+        self.assertEqual((second['inserted'], second['duplicates']), (0, 120))
+        self.assertEqual(Question.query.filter_by(category='3').count(), 120 + 8)
+
+    def test_import_questions_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as bank:
+            bank.write('question,answer,category,difficulty\nWho discovered penicillin?,Fleming,Science,3\n')
+        try:
+            result = self.app.test_cli_runner().invoke(args=['import-questions', bank.name])
+        finally:
+            os.remove(bank.name)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 inserted', result.output)
+        self.assertEqual(Question.query.filter_by(answer='Fleming').count(), 1)
+
+    def test_get_category_questions(self):
+        res = self.client().get('/categories/2/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['current_category'], 'Art')
+        self.assertEqual(data['total_questions'], 8)
+        self.assertEqual(len(data['questions']), 8)
+        self.assertTrue(all(question['category'] == '2' for question in data['questions']))
+        self.assertIsNone(data['next_cursor'])
+
+    def test_404_questions_of_unknown_category(self):
+        res = self.client().get('/categories/1000/questions')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_category_stats_skip_questions_table(self):
+        with count_statements(db.engine) as statements:
+            res = self.client().get('/categories/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories']['1']['type'], 'Science')
+        self.assertEqual(data['categories']['1']['total_questions'], 9)
+        self.assertEqual(data['categories']['1']['difficulties'], {'1': 2, '2': 2, '3': 1, '4': 2, '5': 2})
+        self.assertFalse([statement for statement in statements if 'FROM questions' in statement])
+
+    def test_category_stats_follow_writes(self):
+        Question('New?', 'Yes', '1', 5).insert()
+        question = Question.query.filter_by(category='2').first()
+        question.category = '3'
+        question.difficulty = 2
+        question.update()
+        Question.query.filter_by(category='3').first().delete()
+        load_questions(io.StringIO('question,answer,category,difficulty\nLoaded?,Yes,Art,4\nNew?,Dup,Art,4\n'))
+
+        self.assertEqual(rebuild_category_stats(), [])
+        data = json.loads(self.client().get('/categories/stats').data)
+        self.assertEqual(sum(category['total_questions'] for category in data['categories'].values()), 26)
+
+    def test_reconcile_category_stats_command(self):
+        db.session.query(CategoryStats).filter_by(category='1', difficulty=1).update({'question_count': 50})
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['reconcile-category-stats'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("category '1' difficulty 1: stored 50, actual 2", result.output)
+        self.assertEqual(rebuild_category_stats(), [])
+
+    def test_category_stats_backfilled_when_created(self):
+        connection = db.session.connection()
+        CategoryStats.__table__.drop(connection)
+        db.Model.metadata.create_all(connection)
+
+        self.assertEqual(rebuild_category_stats(), [])
+        self.assertEqual(CategoryStats.query.count(), 15)
+
+    def test_endpoints_within_statement_budget(self):
+        # cold caches: table versions, page, count, categories and page anchors
+        with statement_budget(5):
+            self.client().get('/questions?page=2')
+            self.client().get('/categories/1/questions')
+        with statement_budget(3):
+            self.client().get('/categories')
+            self.client().get('/categories/stats')
+            # table versions, the search index and the page
+            self.search('question')
+        with statement_budget(2):
+            self.play(1)
+            self.client().get('/questions?page=2')
+
+    def test_not_modified_without_running_the_query(self):
+        res = self.client().get('/questions?page=2')
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        with statement_budget(1):
+            res = self.client().get('/questions?page=2', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_etag_changes_with_the_tables(self):
+        etag = self.client().get('/questions').headers['ETag']
+        self.assertNotEqual(self.client().get('/questions?page=2').headers['ETag'], etag)
+
+        Question('What is new?', 'This', '1', 1).insert()
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['total_questions'], 26)
+
+    def test_etag_sees_writes_of_other_processes(self):
+        self.client().get('/questions')
+        # as another worker would, without this process' commit hooks
+        db.session.execute(Question.__table__.insert(), {'question': 'Elsewhere?', 'answer': 'Yes', 'category': '1', 'difficulty': 1})
+        bump_table_versions(db.session.connection(), 'questions')
+        adjust_category_stats(db.session.connection(), {('1', 1): 1})
+        db.session.commit()
+
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], 26)
+
+    def test_search_sees_writes_of_other_processes(self):
+        self.search('question')
+        # as flask import-questions would from another process
+        db.session.execute(Question.__table__.insert(), {'question': 'Imported question?', 'answer': 'Yes', 'category': '1', 'difficulty': 1})
+        bump_table_versions(db.session.connection(), 'questions')
+        db.session.commit()
+
+        data = self.search('imported')
+        self.assertEqual([question['question'] for question in data['questions']], ['Imported question?'])
+
+    def test_compressed_response(self):
+        plain = self.client().get('/questions')
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+        # strong ETags need the same bytes every time
+        self.assertEqual(self.client().get('/questions', headers={'Accept-Encoding': 'gzip'}).data, res.data)
+
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_small_responses_not_compressed(self):
+        res = self.client().get('/categories', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    def test_jsonify_serializes_rows_and_dates(self):
+        question = Question.query.order_by(Question.id).first()
+        with self.app.test_request_context():
+            res = jsonify({'question': question, 'day': datetime.date(2020, 1, 2), 'ids': {3}, 'by_id': {2: 'two'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['question'], question.format())
+        self.assertEqual(data['day'], '2020-01-02')
+        self.assertEqual(data['ids'], [3])
+        self.assertEqual(data['by_id'], {'2': 'two'})
+
+    def test_stream_array(self):
+        with self.app.test_request_context():
+            res = stream_array(Question.query.order_by(Question.id), {'success': True, 'empty': []}, 'questions')
+            data = json.loads(b''.join(res.response))
+
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['empty'], [])
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [question.id for question in Question.query.order_by(Question.id)])
+
+    def test_sql_headers(self):
+        res = self.client().get('/questions')
 
-    """
-    TODO
-    Write at least one test for each test for successful operation and for expected errors.
-    """
+        self.assertIn('X-SQL-Count', res.headers)
+        self.assertIn('X-SQL-Time-Ms', res.headers)
 
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
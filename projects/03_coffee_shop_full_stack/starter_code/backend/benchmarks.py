@@ -0,0 +1,219 @@
+import base64
+import os
+import sys
+import tempfile
+import time
+
+from Crypto.PublicKey import RSA
+from flask import Flask, g, jsonify
+from jose import jwt
+
+from src.auth import auth
+from src.auth.auth import requires_auth
+from src.auth.jwks import JWKSKeyStore
+from src.auth.permissions import all_of, any_of, compile_permission, permission_set
+from src.auth.token_cache import VerifiedTokenCache
+from src.database.models import db, setup_db, Drink
+from src.http_cache import HTTPCache, conditional
+from src.json_provider import jsonify as fast_jsonify
+from src.menu import MENU_TABLES, MenuSnapshot
+
+'''
+Benchmarks
+    run from the backend folder, e.g.
+
+        python benchmarks.py auth
+        python benchmarks.py permissions
+        python benchmarks.py menu
+
+    Tokens are signed with RSA keys generated for the run, so nothing
+    talks to Auth0.
+'''
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def signing_key(kid):
+    private = RSA.generate(2048)
+    key = {'kty': 'RSA', 'alg': 'RS256', 'kid': kid, 'use': 'sig',
+           'n': base64url_uint(private.n), 'e': base64url_uint(private.e)}
+    return private.exportKey('PEM').decode('ascii'), key
+
+def auth_app():
+    app = Flask(__name__)
+
+    @app.route('/drinks-detail')
+    @requires_auth('get:drinks-detail')
+    def drinks_detail(payload):
+        return jsonify({'success': True})
+
+    return app
+
+'''
+bench_auth()
+    requests per second through requires_auth with and without the
+    verified token cache, num_tokens clients each sending its own token,
+    and the time verify_token alone takes per token
+'''
+def bench_auth(num_requests=5000, num_tokens=50):
+    pem, key = signing_key('bench')
+    auth.jwks = JWKSKeyStore('http://127.0.0.1:9/.well-known/jwks.json', background=False)
+    auth.jwks.load({'bench': key})
+    tokens = [jwt.encode({
+        'iss': 'https://{}/'.format(auth.AUTH0_DOMAIN),
+        'aud': auth.API_AUDIENCE,
+        'sub': 'client-{}'.format(i),
+        'exp': int(time.time()) + 3600,
+        'permissions': ['get:drinks-detail', 'post:drinks']
+    }, pem, algorithm='RS256', headers={'kid': 'bench'}) for i in range(num_tokens)]
+    client = auth_app().test_client()
+
+    print('{} requests with {} tokens'.format(num_requests, num_tokens))
+    for name, cache in (('uncached', VerifiedTokenCache(max_entries=0, permissions=permission_set)),
+                        ('cached', VerifiedTokenCache(permissions=permission_set))):
+        auth.token_cache = cache
+        started = time.perf_counter()
+        for i in range(num_requests):
+            res = client.get('/drinks-detail', headers={'Authorization': 'Bearer ' + tokens[i % num_tokens]})
+            assert res.status_code == 200, res.status_code
+        elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(num_requests):
+            auth.verify_token(tokens[i % num_tokens])
+        verify = time.perf_counter() - started
+        print('  {:<9} {:>8.0f} requests/s, {:.3f} ms per request, {:.1f} us in verify_token'.format(
+            name, num_requests / elapsed, 1000 * elapsed / num_requests, 1e6 * verify / num_requests))
+
+'''
+bench_permissions()
+    the cost of one permission check for an admin token with
+    num_permissions permissions: scanning the payload's list as
+    check_permissions used to, against the matcher compile_permission
+    builds once, and the overhead of a requires_auth wrapper per call
+    once the request's token is verified
+'''
+def bench_permissions(num_calls=200000, num_permissions=200):
+    permissions = ['{}:resource-{}'.format(action, i)
+                   for i in range(num_permissions // 4) for action in ('get', 'post', 'patch', 'delete')]
+    permissions.append('get:drinks-detail')
+    payload = {'sub': 'admin', 'permissions': permissions}
+    granted = permission_set(permissions)
+    checks = (
+        ('exact', 'get:drinks-detail'),
+        ('wildcard', '*:drinks-detail'),
+        ('any_of', any_of('post:drinks', 'patch:drinks', 'get:drinks-detail')),
+        ('all_of', all_of('get:*', '*:drinks-detail')),
+    )
+
+    print('{} checks against {} permissions'.format(num_calls, len(permissions)))
+    started = time.perf_counter()
+    for _ in range(num_calls):
+        assert 'get:drinks-detail' in payload['permissions']
+    print('  {:<9} {:>8.3f} us per check'.format('list scan', 1e6 * (time.perf_counter() - started) / num_calls))
+    for name, required in checks:
+        matcher = compile_permission(required)
+        started = time.perf_counter()
+        for _ in range(num_calls):
+            assert matcher(granted)
+        print('  {:<9} {:>8.3f} us per check'.format(name, 1e6 * (time.perf_counter() - started) / num_calls))
+
+    # requires_auth once the request's token is verified, against a bare call
+    def view(payload):
+        return payload
+
+    decorated = requires_auth(checks[2][1])(view)
+    app = Flask(__name__)
+    with app.test_request_context(headers={'Authorization': 'Bearer admin'}):
+        g.auth = ('admin', payload, granted)
+        timings = []
+        for f in (view, decorated):
+            started = time.perf_counter()
+            for _ in range(num_calls):
+                f(payload) if f is view else f()
+            timings.append(time.perf_counter() - started)
+    print('  requires_auth adds {:.3f} us per decorated call'.format(1e6 * (timings[1] - timings[0]) / num_calls))
+
+def menu_app(path):
+    app = Flask(__name__)
+    setup_db(app, 'sqlite:///' + path)
+    db.create_all()
+    HTTPCache(app, db)
+    menu = MenuSnapshot(app)
+
+    @app.route('/drinks/query')
+    def get_drinks_query():
+        # the view before the snapshot: a query and short() per request
+        drinks = Drink.query.order_by(Drink.id).all()
+        return fast_jsonify({
+            "success": True,
+            "drinks": [drink.short() for drink in drinks]
+        })
+
+    @app.route('/drinks')
+    @conditional(*MENU_TABLES)
+    def get_drinks():
+        return menu.response('short')
+
+    return app, menu
+
+'''
+bench_menu()
+    load test of GET /drinks with num_drinks drinks of num_ingredients
+    ingredients, requests per second when every request queries and
+    encodes the menu and when it is served from the snapshot, plain,
+    gzipped and revalidated with If-None-Match. The last run commits a
+    change every rebuild_every requests.
+'''
+def bench_menu(num_requests=5000, num_drinks=50, num_ingredients=4, rebuild_every=100):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        app, menu = menu_app(path)
+        with app.app_context():
+            for i in range(num_drinks):
+                Drink(title='drink {}'.format(i), recipe=[
+                    {'color': 'color-{}'.format(j), 'name': 'ingredient {}'.format(j), 'parts': j + 1}
+                    for j in range(num_ingredients)]).insert()
+        client = app.test_client()
+        etag = client.get('/drinks').headers['ETag']
+
+        def changed(i):
+            if i % rebuild_every == 0:
+                with app.app_context():
+                    drink = Drink.query.get(1)
+                    drink.recipe = drink.recipe[::-1]
+                    drink.update()
+            return {}
+
+        runs = (
+            ('query', '/drinks/query', lambda i: {}),
+            ('snapshot', '/drinks', lambda i: {}),
+            ('gzip', '/drinks', lambda i: {'Accept-Encoding': 'gzip'}),
+            ('304', '/drinks', lambda i: {'If-None-Match': etag}),
+            ('changing', '/drinks', changed),
+        )
+        print('{} requests, {} drinks of {} ingredients, {} bytes'.format(
+            num_requests, num_drinks, num_ingredients, len(client.get('/drinks').data)))
+        for name, url, headers in runs:
+            builds = menu.builds
+            started = time.perf_counter()
+            for i in range(num_requests):
+                res = client.get(url, headers=headers(i))
+                assert res.status_code in (200, 304), res.status_code
+            elapsed = time.perf_counter() - started
+            print('  {:<9} {:>8.0f} requests/s, {:.3f} ms per request, {} builds'.format(
+                name, num_requests / elapsed, 1000 * elapsed / num_requests, menu.builds - builds))
+    finally:
+        os.remove(path)
+
+BENCHMARKS = {
+    'auth': bench_auth,
+    'menu': bench_menu,
+    'permissions': bench_permissions,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
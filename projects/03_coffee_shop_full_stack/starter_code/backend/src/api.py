@@ -1,15 +1,24 @@
 import os
-from flask import Flask, request, jsonify, abort
+import click
+from flask import Flask, request, abort
 from sqlalchemy import exc
 import json
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db, db_drop_and_create_all, migrate_recipes, setup_db, Drink
 from .auth.auth import AuthError, requires_auth
+from .sql_stats import SQLStats
+from .http_cache import HTTPCache, conditional
+from .json_provider import JSONProvider, jsonify
+from .menu import MENU_TABLES, MenuSnapshot
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
+JSONProvider(app)
+SQLStats(app)
+HTTPCache(app, db)
+menu = MenuSnapshot(app)
 
 '''
 @TODO uncomment the following line to initialize the datbase
@@ -18,25 +27,45 @@ CORS(app)
 '''
 # db_drop_and_create_all()
 
+'''
+flask migrate-recipes
+    moves recipes stored as JSON blobs into drink_ingredient, run once
+    on databases created before DrinkIngredient
+'''
+@app.cli.command('migrate-recipes')
+def migrate_recipes_command():
+    skipped = migrate_recipes()
+    for drink_id, error in skipped:
+        click.echo('drink {}: {}, kept in drink_recipe_legacy'.format(drink_id, error), err=True)
+    click.echo('{} recipes skipped'.format(len(skipped)))
+
 ## ROUTES
 '''
-@TODO implement endpoint
-    GET /drinks
-        it should be a public endpoint
-        it should contain only the drink.short() data representation
+GET /drinks
+    public endpoint with the drink.short() data representation
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
-        or appropriate status code indicating reason for failure
+    sends an ETag and answers 304 to If-None-Match until a drink changes
+    the body is the menu snapshot, encoded once per change of the drinks
 '''
+@app.route('/drinks')
+@conditional(*MENU_TABLES)
+def get_drinks():
+    return menu.response('short')
 
 
 '''
-@TODO implement endpoint
-    GET /drinks-detail
-        it should require the 'get:drinks-detail' permission
-        it should contain the drink.long() data representation
+GET /drinks-detail
+    requires the 'get:drinks-detail' permission
+    contains the drink.long() data representation
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
+    served from the menu snapshot like GET /drinks
 '''
+@app.route('/drinks-detail')
+@requires_auth('get:drinks-detail')
+@conditional(*MENU_TABLES)
+def get_drinks_detail(payload):
+    return menu.response('long')
 
 
 '''
@@ -105,6 +134,10 @@ def unprocessable(error):
 
 
 '''
-@TODO implement error handler for AuthError
-    error handler should conform to general task above 
+error handler for AuthError
+    401 / 403 for missing, invalid or under-privileged tokens, 503 while
+    the signing keys can't be read
 '''
+@app.errorhandler(AuthError)
+def auth_error(error):
+    return jsonify(dict(error.error, success=False, error=error.status_code)), error.status_code
@@ -1,14 +1,22 @@
 import json
-from flask import request, _request_ctx_stack
+from flask import g, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from .jwks import JWKSError, JWKSKeyStore
+from .permissions import compile_permission, permission_set
+from .token_cache import VerifiedTokenCache
 
 
 AUTH0_DOMAIN = 'udacity-fsnd.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'dev'
 
+# signing keys of AUTH0_DOMAIN, fetched once and refreshed in the background
+jwks = JWKSKeyStore('https://{}/.well-known/jwks.json'.format(AUTH0_DOMAIN))
+# payloads of the tokens verified lately
+token_cache = VerifiedTokenCache(permissions=permission_set)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -23,63 +31,178 @@ class AuthError(Exception):
 ## Auth Header
 
 '''
-@TODO implement get_token_auth_header() method
-    it should attempt to get the header from the request
-        it should raise an AuthError if no header is present
-    it should attempt to split bearer and the token
-        it should raise an AuthError if the header is malformed
+get_token_auth_header() method
+    gets the header from the request and splits bearer and the token
+    raises an AuthError if no header is present or the header is malformed
     return the token part of the header
 '''
 def get_token_auth_header():
-   raise Exception('Not Implemented')
+    auth = request.headers.get('Authorization', None)
+    if not auth:
+        raise AuthError({
+            'code': 'authorization_header_missing',
+            'description': 'Authorization header is expected.'
+        }, 401)
+
+    parts = auth.split()
+    if parts[0].lower() != 'bearer':
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must start with "Bearer".'
+        }, 401)
+    elif len(parts) == 1:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Token not found.'
+        }, 401)
+    elif len(parts) > 2:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must be bearer token.'
+        }, 401)
+
+    return parts[1]
 
 '''
-@TODO implement check_permissions(permission, payload) method
+check_permissions(permission, payload, permissions=None) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink' or '*:drinks'), '' for none,
+            any_of() / all_of() of them or a matcher from compile_permission()
         payload: decoded jwt payload
+        permissions: permission_set() of the payload, when already known
 
-    it should raise an AuthError if permissions are not included in the payload
+    raises an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
-    it should raise an AuthError if the requested permission string is not in the payload permissions array
+    raises an AuthError if the payload permissions don't grant the requested permission
     return true otherwise
 '''
-def check_permissions(permission, payload):
-    raise Exception('Not Implemented')
+def check_permissions(permission, payload, permissions=None):
+    if 'permissions' not in payload:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+    if permissions is None:
+        permissions = permission_set(payload['permissions'])
+    if not compile_permission(permission)(permissions):
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
 
 '''
-@TODO implement verify_decode_jwt(token) method
+verify_decode_jwt(token) method
     @INPUTS
         token: a json web token (string)
 
-    it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
-    it should decode the payload from the token
-    it should validate the claims
-    return the decoded payload
+    verifies an Auth0 token with key id (kid) against the keys of
+    Auth0 /.well-known/jwks.json, read from the jwks key store rather than
+    fetched per request, validates the claims and returns the decoded payload
 
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    raise Exception('Not Implemented')
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 401)
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
 
+    try:
+        key = jwks.get(unverified_header['kid'])
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if key is None:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    rsa_key = {
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key.get('use', 'sig'),
+        'n': key['n'],
+        'e': key['e']
+    }
+    try:
+        return jwt.decode(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer='https://' + AUTH0_DOMAIN + '/'
+        )
+    except jwt.ExpiredSignatureError:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+    except jwt.JWTClaimsError:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+'''
+verify_token(token) method
+    verify_decode_jwt through token_cache, a token seen before is not
+    verified again until its entry expires
+    return the decoded payload and its permission set
 '''
-@TODO implement @requires_auth(permission) decorator method
+def verify_token(token):
+    cached = token_cache.get(token)
+    if cached is None:
+        cached = token_cache.put(token, verify_decode_jwt(token))
+    return cached
+
+'''
+current_auth(token) method
+    verify_token once per request, later calls in the same request reuse
+    the payload and permission set it returned
+'''
+def current_auth(token):
+    auth = g.get('auth')
+    if auth is None or auth[0] != token:
+        auth = g.auth = (token,) + verify_token(token)
+    return auth[1], auth[2]
+
+'''
+@requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), wildcards like '*:drinks'
+            or any_of() / all_of() of them, compiled once when the decorator is applied
 
-    it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
+    uses the get_token_auth_header method to get the token
+    uses current_auth to decode the jwt, verify_decode_jwt for tokens not cached
+    uses the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
+    matcher = compile_permission(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, permissions = current_auth(token)
+            check_permissions(matcher, payload, permissions)
             return f(payload, *args, **kwargs)
 
         return wrapper
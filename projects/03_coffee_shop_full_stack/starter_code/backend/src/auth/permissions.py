@@ -0,0 +1,65 @@
+## Permission matchers
+'''
+Permission checks compiled once, when @requires_auth is applied, instead
+of scanning the token's permissions array on every request.
+
+A token's permissions become a frozenset with one wildcard key per
+action and per resource next to every permission, so 'get:drinks' also
+grants '*:drinks', 'get:*' and '*:*'. A required permission is then a
+single set lookup whatever the wildcard, and any_of() / all_of() combine
+them.
+
+    EXAMPLE
+        matcher = compile_permission(any_of('get:drinks-detail', all_of('post:drinks', 'patch:drinks')))
+        matcher(permission_set(payload['permissions']))
+'''
+
+'''
+permission_set(permissions)
+    the frozenset of permissions and their wildcard keys
+'''
+def permission_set(permissions):
+    granted = set()
+    for permission in permissions:
+        granted.add(permission)
+        action, separator, resource = permission.partition(':')
+        if separator:
+            granted.update(('*:' + resource, action + ':*', '*:*'))
+    return frozenset(granted)
+
+def grants_anything(granted):
+    return True
+
+def permission_key(required):
+    if not isinstance(required, str):
+        raise TypeError('expected a permission string, got {!r}'.format(required))
+    return '*:*' if required == '*' else required
+
+'''
+compile_permission(required)
+    a function of a permission_set that tells whether it grants required,
+    a permission string, '' for none, or an any_of() / all_of() matcher
+'''
+def compile_permission(required):
+    if callable(required):
+        return required
+    if required == '':
+        return grants_anything
+    key = permission_key(required)
+    return lambda granted: key in granted
+
+def all_of(*required):
+    if all(isinstance(permission, str) for permission in required):
+        keys = frozenset(permission_key(permission) for permission in required if permission)
+        return keys.issubset
+    matchers = [compile_permission(permission) for permission in required]
+    return lambda granted: all(matcher(granted) for matcher in matchers)
+
+def any_of(*required):
+    if '' in required:
+        return grants_anything
+    if all(isinstance(permission, str) for permission in required):
+        keys = frozenset(permission_key(permission) for permission in required)
+        return lambda granted: not keys.isdisjoint(granted)
+    matchers = [compile_permission(permission) for permission in required]
+    return lambda granted: any(matcher(granted) for matcher in matchers)
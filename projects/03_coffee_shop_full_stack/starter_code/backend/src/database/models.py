@@ -1,19 +1,26 @@
 import os
-from sqlalchemy import Column, String, Integer
+import logging
+from sqlalchemy import Column, String, Integer, Text, ForeignKey, MetaData, Table, inspect, text
+from sqlalchemy.orm import relationship
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from ..http_cache import bump_table_versions
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
+# COFFEE_DATABASE_URL points the app at another database, e.g. in tests
+database_path = os.environ.get("COFFEE_DATABASE_URL", "sqlite:///{}".format(os.path.join(project_dir, database_filename)))
 
 db = SQLAlchemy()
 
+logger = logging.getLogger('recipes')
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 '''
-def setup_db(app):
+def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
@@ -29,6 +36,80 @@ def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+'''
+parse_recipe(recipe)
+    the list of ingredients of a recipe given as a list, a single
+    ingredient or the JSON of either
+    raises ValueError if an ingredient has no color, name or parts
+'''
+def parse_recipe(recipe):
+    if isinstance(recipe, (str, bytes)):
+        recipe = json.loads(recipe)
+    if isinstance(recipe, dict):
+        recipe = [recipe]
+    try:
+        return [{'color': str(r['color']), 'name': str(r['name']), 'parts': int(r['parts'])} for r in recipe]
+    except (KeyError, TypeError) as e:
+        raise ValueError('malformed recipe: {}'.format(e))
+
+'''
+migrate_recipes()
+    databases created before DrinkIngredient keep each recipe as a JSON
+    blob in drink.recipe. This moves the blobs into drink_ingredient rows
+    and drops the column, in one transaction. Does nothing once migrated.
+    A blob parse_recipe() rejects is logged and kept as it was in
+    drink_recipe_legacy, its drink is left without ingredients.
+    returns the [(drink id, error)] of the blobs kept
+    run by `flask migrate-recipes`
+'''
+def migrate_recipes():
+    engine = db.engine
+    inspector = inspect(engine)
+    if 'drink' not in inspector.get_table_names() or \
+            'recipe' not in [column['name'] for column in inspector.get_columns('drink')]:
+        db.create_all()
+        return []
+
+    with engine.begin() as connection:
+        ingredients = []
+        legacy = []
+        skipped = []
+        for drink_id, recipe in connection.execute(text('SELECT id, recipe FROM drink')).fetchall():
+            try:
+                recipe_ingredients = parse_recipe(recipe)
+            except ValueError as e:
+                logger.warning('drink %s: %s, kept in drink_recipe_legacy', drink_id, e)
+                legacy.append({'drink_id': drink_id, 'recipe': recipe})
+                skipped.append((drink_id, str(e)))
+                continue
+            for position, ingredient in enumerate(recipe_ingredients):
+                ingredients.append(dict(ingredient, drink_id=drink_id, position=position))
+
+        if engine.dialect.name == 'sqlite':
+            # no DROP COLUMN before SQLite 3.35, the table is copied instead.
+            # drink_ingredient is created afterwards so its foreign key
+            # isn't renamed along with the old table.
+            connection.execute(text('ALTER TABLE drink RENAME TO drink_recipe_blob'))
+            Drink.__table__.create(connection)
+            connection.execute(text('INSERT INTO drink (id, title) SELECT id, title FROM drink_recipe_blob'))
+            connection.execute(text('DROP TABLE drink_recipe_blob'))
+        else:
+            connection.execute(text('ALTER TABLE drink DROP COLUMN recipe'))
+        DrinkIngredient.__table__.create(connection, checkfirst=True)
+        if ingredients:
+            connection.execute(DrinkIngredient.__table__.insert(), ingredients)
+        if legacy:
+            # outside db.metadata, so create_all() doesn't make one
+            legacy_table = Table('drink_recipe_legacy', MetaData(),
+                                 Column('drink_id', Integer, primary_key=True),
+                                 Column('recipe', Text))
+            legacy_table.create(connection, checkfirst=True)
+            connection.execute(legacy_table.insert(), legacy)
+        if 'table_versions' in db.metadata.tables:
+            bump_table_versions(connection, 'drink', 'drink_ingredient')
+    db.create_all()
+    return skipped
+
 '''
 Drink
 a persistent drink entity, extends the base SQLAlchemy Model
@@ -38,21 +119,34 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
-    # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe =  Column(String(180), nullable=False)
+    # the recipe, loaded with the drink in the same joined query
+    ingredients = relationship('DrinkIngredient', order_by='DrinkIngredient.position', lazy='joined',
+                               cascade='all, delete-orphan', back_populates='drink')
+
+    '''
+    recipe
+        the ingredients as [{'color': string, 'name':string, 'parts':number}]
+        anything parse_recipe() reads can be assigned, it replaces the
+        ingredients
+    '''
+    @property
+    def recipe(self):
+        return [ingredient.long() for ingredient in self.ingredients]
+
+    @recipe.setter
+    def recipe(self, recipe):
+        self.ingredients = [DrinkIngredient(position=position, **ingredient)
+                            for position, ingredient in enumerate(parse_recipe(recipe))]
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': [ingredient.short() for ingredient in self.ingredients]
         }
 
     '''
@@ -63,7 +157,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     '''
@@ -104,4 +198,28 @@ class Drink(db.Model):
         db.session.commit()
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
+'''
+DrinkIngredient
+one ingredient of a drink's recipe, in the order it is poured
+'''
+class DrinkIngredient(db.Model):
+    __tablename__ = 'drink_ingredient'
+    id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
+    drink_id = Column(Integer, ForeignKey('drink.id', ondelete='CASCADE'), nullable=False, index=True)
+    # place in the recipe, from 0
+    position = Column(Integer, nullable=False)
+    color = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    parts = Column(Integer, nullable=False)
+
+    drink = relationship('Drink', back_populates='ingredients')
+
+    def short(self):
+        return {'color': self.color, 'parts': self.parts}
+
+    def long(self):
+        return {'color': self.color, 'name': self.name, 'parts': self.parts}
+
+    def __repr__(self):
+        return json.dumps(self.long())
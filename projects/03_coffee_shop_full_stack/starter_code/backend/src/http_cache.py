@@ -0,0 +1,227 @@
+import hashlib
+import json
+import random
+import zlib
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import Column, Integer, String, Table, event, select, text
+from sqlalchemy.orm import Session, object_mapper
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#----------------------------------------------------------------------------#
+# HTTP caching and compression.
+# Views decorated with @conditional('table', ...) get a strong ETag made
+# from the version counters of the tables they read, and answer a
+# matching If-None-Match with 304 before running the view. The counters
+# live in the table_versions table and are bumped in the transaction of
+# every flush that writes one of those tables, so all workers agree on
+# them. Responses over COMPRESS_MIN_SIZE bytes are sent with brotli, when
+# installed, or gzip.
+#----------------------------------------------------------------------------#
+
+COMPRESSIBLE = ('application/json', 'application/javascript', 'text/css', 'text/html', 'text/plain')
+
+# works on Postgres 9.5+ and SQLite 3.24+
+BUMP_TABLE_VERSION = text('''
+    INSERT INTO table_versions (name, version) VALUES (:name, :start)
+    ON CONFLICT (name) DO UPDATE SET version = table_versions.version + 1
+''')
+
+def random_version():
+    # counters of a recreated table_versions must not repeat old ETags
+    return random.randrange(1 << 30)
+
+def table_versions_table(metadata):
+    table = Table('table_versions', metadata,
+        Column('name', String, primary_key=True),
+        Column('version', Integer, nullable=False),
+        keep_existing=True)
+    if not event.contains(table, 'after_create', start_table_versions):
+        event.listen(table, 'after_create', start_table_versions)
+    return table
+
+def start_table_versions(table, connection, **kw):
+    names = [name for name in table.metadata.tables if name != table.name]
+    if names:
+        connection.execute(table.insert(), [{'name': name, 'version': random_version()} for name in names])
+
+def bump_table_versions(connection, *names):
+    '''
+    Bumps the counters of names on connection. Flushes do this on their
+    own, writes that bypass the ORM call it in their transaction.
+    '''
+    if names:
+        connection.execute(BUMP_TABLE_VERSION, [{'name': name, 'start': random_version()} for name in names])
+
+def bump_flushed_tables(session, flush_context):
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        for table in object_mapper(obj).tables:
+            if 'table_versions' in table.metadata.tables:
+                names.add(table.name)
+    bump_table_versions(session.connection(), *sorted(names))
+
+class HTTPCache(object):
+    '''
+    Flask extension, HTTPCache(app, db) or init_app(app, db) later. Settings:
+
+    COMPRESS_MIN_SIZE        smallest body in bytes worth compressing, 500 by default
+    COMPRESS_ALGORITHMS      encodings to offer in order of preference, ('br', 'gzip')
+    COMPRESS_LEVEL           gzip level, 6 by default
+    COMPRESS_BROTLI_QUALITY  brotli quality, 5 by default
+    ETAG_SALT                mixed into every ETag, '' by default so every worker
+                             hands out the same ETags. Set it to the release so a
+                             deploy that changes response bodies changes them too.
+
+    observers are called with the names of the tables whose version
+    changed since this process last read it, e.g. by another worker, so
+    values cached in the process can be dropped before the view runs.
+    '''
+    def __init__(self, app=None, db=None):
+        self.observers = []
+        self.seen = {}
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_ALGORITHMS', ('br', 'gzip'))
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+        app.config.setdefault('ETAG_SALT', '')
+        app.extensions['http_cache'] = self
+        app.after_request(self.compress)
+
+        self.db = db
+        self.table = table_versions_table(db.Model.metadata)
+        with app.app_context():
+            self.table.create(db.get_engine(app), checkfirst=True)
+        if not event.contains(Session, 'after_flush', bump_flushed_tables):
+            event.listen(Session, 'after_flush', bump_flushed_tables)
+
+    def versions(self, names):
+        rows = self.db.session.execute(
+            select([self.table.c.name, self.table.c.version]).where(self.table.c.name.in_(names)))
+        versions = dict(rows.fetchall())
+        versions = dict((name, versions.get(name)) for name in names)
+        if has_request_context():
+            # what the values this request caches are built from
+            g.table_versions = dict(g.get('table_versions') or {}, **versions)
+        changed = [name for name in names if self.seen.get(name) != versions[name]]
+        if changed:
+            # the observers drop the old values before seen lets other
+            # requests skip them
+            for observer in self.observers:
+                observer(changed)
+            self.seen.update((name, versions[name]) for name in changed)
+        return [versions[name] for name in names]
+
+    def etag(self, names):
+        key = json.dumps([current_app.config['ETAG_SALT'], request.full_path, self.versions(names)])
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+
+    def encoding(self):
+        '''
+        the encoding the client accepts with the highest quality, None if
+        it accepts none of COMPRESS_ALGORITHMS
+        '''
+        best, best_quality = None, 0
+        for name in current_app.config['COMPRESS_ALGORITHMS']:
+            if name == 'br' and brotli is None:
+                continue
+            quality = request.accept_encodings.quality(name)
+            if quality > best_quality:
+                best, best_quality = name, quality
+        return best
+
+    def encode(self, data, encoding):
+        '''
+        data compressed with encoding, 'br' or 'gzip'
+        '''
+        if encoding == 'br':
+            return brotli.compress(data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+        # gzip container with a zero mtime, so equal bodies compress to equal bytes
+        compressor = zlib.compressobj(current_app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress(self, response):
+        if response.mimetype not in COMPRESSIBLE or 'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+            return response
+        length = response.calculate_content_length()
+        if length is None or length < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        encoding = self.encoding()
+        if encoding is None:
+            return response
+
+        response.set_data(self.encode(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        # a strong ETag names exact bytes, so every encoding gets its own
+        tag, weak = response.get_etag()
+        if tag:
+            response.set_etag('{}-{}'.format(tag, encoding), weak)
+        return response
+
+def matching_etag(etag):
+    '''
+    the tag of If-None-Match that names etag in any encoding, None if
+    there is none
+    '''
+    if request.if_none_match.star_tag:
+        return etag
+    for tag in request.if_none_match.as_set(include_weak=True):
+        if tag.split('-')[0] == etag:
+            return tag
+    return None
+
+def request_versions(names):
+    '''
+    the versions of names as read by this request's version check, None
+    outside a request or when it did not read all of them
+    '''
+    known = g.get('table_versions') if has_request_context() else None
+    if known is None or any(name not in known for name in names):
+        return None
+    return tuple(known[name] for name in names)
+
+def conditional(*tables):
+    '''
+    Adds an ETag and Cache-Control: no-cache to the 200 responses of a GET
+    view reading tables, and answers 304 without calling the view while
+    none of them changed. Put it below @requires_auth so a 304 is only
+    sent to clients allowed to see the body.
+
+        @app.route('/categories')
+        @conditional('categories')
+        def get_categories():
+    '''
+    names = sorted(tables)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+            etag = current_app.extensions['http_cache'].etag(names)
+            tag = matching_etag(etag)
+            if tag is not None:
+                response = current_app.response_class(status=304)
+                response.set_etag(tag)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # views may send bodies they compressed themselves
+                encoding = response.headers.get('Content-Encoding')
+                response.set_etag('{}-{}'.format(etag, encoding) if encoding else etag)
+            response.headers['Cache-Control'] = 'private, no-cache' if 'Authorization' in request.headers else 'no-cache'
+            return response
+        return wrapper
+    return decorator
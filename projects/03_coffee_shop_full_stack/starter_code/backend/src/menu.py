@@ -0,0 +1,95 @@
+import threading
+from flask import current_app
+
+from .database.models import Drink
+from .http_cache import brotli, request_versions
+from .json_provider import dumps
+
+#----------------------------------------------------------------------------#
+# Menu snapshot.
+# GET /drinks and GET /drinks-detail send every client the same menu
+# until a drink changes. Their bodies are encoded once, and compressed
+# once per encoding, then served as bytes. Each snapshot keeps the
+# versions of the drink and drink_ingredient tables it was built from,
+# and a request that read other versions, i.e. after Drink.insert(),
+# update() or delete() committed in this or another worker, builds it
+# again.
+#----------------------------------------------------------------------------#
+
+MENU_TABLES = ('drink', 'drink_ingredient')
+
+# the projection of Drink behind each menu
+MENU_FORMS = ('short', 'long')
+
+class MenuSnapshot(object):
+    '''
+    Flask extension, MenuSnapshot(app) or init_app(app) later, after
+    HTTPCache. Serve a menu from a view under @conditional(*MENU_TABLES),
+    so the table versions are read once for the ETag and the snapshot:
+
+        @app.route('/drinks')
+        @conditional(*MENU_TABLES)
+        def get_drinks():
+            return menu.response('short')
+
+    builds counts the snapshots built, for tests and benchmarks.
+    '''
+    def __init__(self, app=None):
+        self.snapshots = {}  # form -> (table versions, encodings)
+        self.builds = 0
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['menu_snapshot'] = self
+
+    def get(self, form):
+        '''
+        the encodings of the form menu, {None: body, 'gzip': ..., 'br': ...},
+        as of the table versions this request read
+        '''
+        versions = request_versions(MENU_TABLES)
+        if versions is None:
+            versions = tuple(current_app.extensions['http_cache'].versions(list(MENU_TABLES)))
+        snapshot = self.snapshots.get(form)
+        if snapshot is not None and snapshot[0] == versions:
+            return snapshot[1]
+        with self.lock:
+            # one request builds, the others wait for its snapshot
+            snapshot = self.snapshots.get(form)
+            if snapshot is None or snapshot[0] != versions:
+                # read after the versions, so never older than they say
+                snapshot = self.snapshots[form] = (versions, self.build(form))
+        return snapshot[1]
+
+    def build(self, form):
+        if form not in MENU_FORMS:
+            raise ValueError('unknown menu {!r}'.format(form))
+        self.builds += 1
+        drinks = Drink.query.order_by(Drink.id).all()
+        body = dumps({
+            'success': True,
+            'drinks': [getattr(drink, form)() for drink in drinks]
+        }, current_app.config.get('JSON_SORT_KEYS', True)) + b'\n'
+
+        snapshot = {None: body}
+        http_cache = current_app.extensions['http_cache']
+        if len(body) >= current_app.config['COMPRESS_MIN_SIZE']:
+            for encoding in current_app.config['COMPRESS_ALGORITHMS']:
+                if encoding != 'br' or brotli is not None:
+                    snapshot[encoding] = http_cache.encode(body, encoding)
+        return snapshot
+
+    def response(self, form):
+        '''
+        the form menu in the encoding the client prefers
+        '''
+        snapshot = self.get(form)
+        http_cache = current_app.extensions['http_cache']
+        encoding = http_cache.encoding() if len(snapshot) > 1 else None
+        response = current_app.response_class(snapshot.get(encoding, snapshot[None]), mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if encoding is not None and encoding in snapshot:
+            response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+# src.api binds its database when imported, so it gets a scratch one
+handle, DATABASE = tempfile.mkstemp(suffix='.db')
+os.close(handle)
+os.environ['COFFEE_DATABASE_URL'] = 'sqlite:///' + DATABASE
+
+from src.api import app, db
+from src.auth import auth
+from src.auth.jwks import JWKSKeyStore
+from src.auth.permissions import permission_set
+from src.auth.token_cache import VerifiedTokenCache
+from test_auth import make_token, signing_key
+
+
+def setUpModule():
+    global PEM, KEY
+    PEM, KEY = signing_key('current')
+    # importing the app doesn't touch the schema, flask migrate-recipes does
+    db.create_all()
+
+
+def tearDownModule():
+    db.session.remove()
+    db.engine.dispose()
+    os.remove(DATABASE)
+
+
+class DrinksDetailTestCase(unittest.TestCase):
+    """GET /drinks-detail of the app in src/api.py"""
+
+    def setUp(self):
+        self.app_jwks = auth.jwks
+        self.app_token_cache = auth.token_cache
+        auth.jwks = JWKSKeyStore('http://127.0.0.1:9/.well-known/jwks.json', background=False)
+        auth.jwks.load({'current': KEY})
+        auth.token_cache = VerifiedTokenCache(permissions=permission_set)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        auth.jwks = self.app_jwks
+        auth.token_cache = self.app_token_cache
+
+    def get(self, authorization=None):
+        headers = {'Authorization': authorization} if authorization else {}
+        return self.client.get('/drinks-detail', headers=headers)
+
+    def test_drinks_detail(self):
+        res = self.get('Bearer ' + make_token(PEM, 'current', permissions=['get:drinks-detail']))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), {'success': True, 'drinks': []})
+
+    def test_missing_header(self):
+        res = self.get()
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json()['code'], 'authorization_header_missing')
+        self.assertEqual(res.get_json()['success'], False)
+
+    def test_malformed_header(self):
+        self.assertEqual(self.get('Token abc').status_code, 401)
+        self.assertEqual(self.get('Bearer').status_code, 401)
+
+    def test_missing_permission(self):
+        res = self.get('Bearer ' + make_token(PEM, 'current', permissions=['get:drinks']))
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(res.get_json()['error'], 403)
+
+    def test_keys_unavailable(self):
+        auth.jwks = JWKSKeyStore('http://127.0.0.1:9/.well-known/jwks.json', background=False, timeout=1)
+
+        res = self.get('Bearer ' + make_token(PEM, 'current', permissions=['get:drinks-detail']))
+        self.assertEqual(res.status_code, 503)
+
+
+class MigrateRecipesCommandTestCase(unittest.TestCase):
+    """flask migrate-recipes"""
+
+    def test_migrated_database(self):
+        res = app.test_cli_runner().invoke(args=['migrate-recipes'])
+
+        self.assertEqual(res.exit_code, 0)
+        self.assertIn('0 recipes skipped', res.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
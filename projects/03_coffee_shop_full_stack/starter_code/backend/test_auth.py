@@ -0,0 +1,349 @@
+import base64
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
+
+from Crypto.PublicKey import RSA
+from flask import Flask, jsonify
+from jose import jwt
+
+from src.auth import auth
+from src.auth.auth import AuthError, requires_auth, verify_decode_jwt
+from src.auth.jwks import JWKSKeyStore
+from src.auth.permissions import all_of, any_of, compile_permission, permission_set
+from src.auth.token_cache import VerifiedTokenCache
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def signing_key(kid):
+    """A private key in PEM and the JWK of its public half."""
+    private = RSA.generate(2048)
+    key = {'kty': 'RSA', 'alg': 'RS256', 'kid': kid, 'use': 'sig',
+           'n': base64url_uint(private.n), 'e': base64url_uint(private.e)}
+    return private.exportKey('PEM').decode('ascii'), key
+
+
+def make_token(pem, kid, **claims):
+    claims = dict({
+        'iss': 'https://{}/'.format(auth.AUTH0_DOMAIN),
+        'aud': auth.API_AUDIENCE,
+        'sub': 'barista',
+        'exp': int(time.time()) + 3600
+    }, **claims)
+    return jwt.encode(claims, pem, algorithm='RS256', headers={'kid': kid})
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubJWKSServer(object):
+    """Serves keys as jwks.json on a local port and counts the requests."""
+
+    def __init__(self, keys, max_age=600):
+        self.keys = keys
+        self.max_age = max_age
+        self.failing = False
+        self.delay = 0
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.delay)
+                if stub.failing:
+                    self.send_error(503)
+                    return
+                body = json.dumps({'keys': stub.keys}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'public, max-age={}'.format(stub.max_age))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def setUpModule():
+    global PEM, KEY, ROTATED_PEM, ROTATED_KEY
+    PEM, KEY = signing_key('current')
+    ROTATED_PEM, ROTATED_KEY = signing_key('rotated')
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """verify_decode_jwt() against a stub issuer"""
+
+    def setUp(self):
+        self.issuer = StubJWKSServer([KEY])
+        self.app_jwks = auth.jwks
+        self.use_store(min_refetch_interval=30)
+
+    def tearDown(self):
+        auth.jwks.stop()
+        auth.jwks = self.app_jwks
+        self.issuer.close()
+
+    def use_store(self, **kwargs):
+        kwargs.setdefault('background', False)
+        auth.jwks = JWKSKeyStore(self.issuer.url, **kwargs)
+        return auth.jwks
+
+    def test_warm_requests_make_no_network_calls(self):
+        token = make_token(PEM, 'current')
+        for _ in range(50):
+            payload = verify_decode_jwt(token)
+
+        self.assertEqual(payload['sub'], 'barista')
+        self.assertEqual(self.issuer.requests, 1)
+
+    def test_unknown_kid_refetches_once_for_concurrent_requests(self):
+        self.use_store(min_refetch_interval=0.1)
+        verify_decode_jwt(make_token(PEM, 'current'))
+        time.sleep(0.1)
+        self.issuer.keys = [KEY, ROTATED_KEY]
+        self.issuer.delay = 0.2
+
+        token = make_token(ROTATED_PEM, 'rotated')
+        payloads = []
+        threads = [threading.Thread(target=lambda: payloads.append(verify_decode_jwt(token))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(payloads), 10)
+        self.assertEqual(self.issuer.requests, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        verify_decode_jwt(make_token(PEM, 'current'))
+        for _ in range(5):
+            with self.assertRaises(AuthError) as raised:
+                verify_decode_jwt(make_token(ROTATED_PEM, 'rotated'))
+            self.assertEqual(raised.exception.status_code, 400)
+
+        self.assertEqual(self.issuer.requests, 1)
+
+    def test_last_good_keys_while_issuer_unreachable(self):
+        self.use_store(min_refetch_interval=0.1)
+        self.issuer.max_age = 0
+        token = make_token(PEM, 'current')
+        verify_decode_jwt(token)
+        self.issuer.failing = True
+        time.sleep(0.1)
+
+        self.assertEqual(verify_decode_jwt(token)['sub'], 'barista')
+        self.assertEqual(self.issuer.requests, 2)
+        self.issuer.close()
+        time.sleep(0.1)
+        self.assertEqual(verify_decode_jwt(token)['sub'], 'barista')
+
+    def test_unavailable_without_keys(self):
+        self.issuer.failing = True
+
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(make_token(PEM, 'current'))
+        self.assertEqual(raised.exception.status_code, 503)
+
+    def test_background_refresh_before_max_age(self):
+        store = self.use_store(min_refetch_interval=0.1, background=True)
+        self.issuer.max_age = 1
+        verify_decode_jwt(make_token(PEM, 'current'))
+        self.issuer.keys = [KEY, ROTATED_KEY]
+        time.sleep(1.2)
+
+        # refetched by the thread, so the rotated key needs no request
+        self.assertGreaterEqual(self.issuer.requests, 2)
+        requests = self.issuer.requests
+        self.assertEqual(verify_decode_jwt(make_token(ROTATED_PEM, 'rotated'))['sub'], 'barista')
+        self.assertEqual(self.issuer.requests, requests)
+        self.assertIn('rotated', store.keys)
+
+    def test_expired_token(self):
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(make_token(PEM, 'current', exp=int(time.time()) - 60))
+        self.assertEqual(raised.exception.error['code'], 'token_expired')
+
+
+class RequiresAuthTestCase(unittest.TestCase):
+    """requires_auth with local keys and the verified token cache"""
+
+    def setUp(self):
+        self.app_jwks = auth.jwks
+        self.app_token_cache = auth.token_cache
+        auth.jwks = JWKSKeyStore('http://127.0.0.1:9/.well-known/jwks.json', background=False)
+        auth.jwks.load({'current': KEY})
+        auth.token_cache = VerifiedTokenCache(permissions=permission_set)
+
+        app = Flask(__name__)
+
+        @app.route('/drinks-detail')
+        @requires_auth('get:drinks-detail')
+        def drinks_detail(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @app.errorhandler(AuthError)
+        def auth_error(error):
+            return jsonify(error.error), error.status_code
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        auth.jwks = self.app_jwks
+        auth.token_cache = self.app_token_cache
+
+    def get(self, token):
+        return self.client.get('/drinks-detail', headers={'Authorization': 'Bearer ' + token})
+
+    def test_requires_permission(self):
+        self.assertEqual(self.get(make_token(PEM, 'current', permissions=['get:drinks-detail'])).status_code, 200)
+        self.assertEqual(self.get(make_token(PEM, 'current', permissions=['post:drinks'])).status_code, 403)
+        self.assertEqual(self.get(make_token(PEM, 'current')).status_code, 400)
+        self.assertEqual(self.client.get('/drinks-detail').status_code, 401)
+
+    def test_repeated_token_is_verified_once(self):
+        token = make_token(PEM, 'current', permissions=['get:drinks-detail'])
+        with mock.patch.object(auth, 'verify_decode_jwt', wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(20):
+                self.assertEqual(self.get(token).status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(auth.token_cache.hits, 19)
+
+    def test_cached_token_not_served_past_exp(self):
+        exp = int(time.time()) + 1
+        token = make_token(PEM, 'current', permissions=['get:drinks-detail'], exp=exp)
+        self.assertEqual(self.get(token).status_code, 200)
+        # jose compares exp with whole seconds
+        time.sleep(max(exp + 1 - time.time(), 0) + 0.1)
+
+        res = self.get(token)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json()['code'], 'token_expired')
+
+    def test_cache_entry_expires_at_exp(self):
+        cache = VerifiedTokenCache(ttl=60)
+        cache.put('token', {'sub': 'barista', 'exp': time.time() + 0.1, 'permissions': ['get:drinks-detail']})
+
+        self.assertEqual(cache.get('token')[1], frozenset(['get:drinks-detail']))
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('token'))
+
+    def test_cached_token_verified_again_after_ttl(self):
+        auth.token_cache = VerifiedTokenCache(ttl=0.1, permissions=permission_set)
+        token = make_token(PEM, 'current', permissions=['get:drinks-detail'])
+        with mock.patch.object(auth, 'verify_decode_jwt', wraps=auth.verify_decode_jwt) as verify:
+            self.get(token)
+            self.get(token)
+            time.sleep(0.15)
+            self.get(token)
+
+        self.assertEqual(verify.call_count, 2)
+
+    def test_cache_is_bounded(self):
+        auth.token_cache = VerifiedTokenCache(max_entries=2, permissions=permission_set)
+        for sub in ('barista', 'manager', 'owner'):
+            self.get(make_token(PEM, 'current', sub=sub, permissions=['get:drinks-detail']))
+
+        self.assertEqual(len(auth.token_cache), 2)
+
+    def test_invalid_tokens_not_cached(self):
+        forged = make_token(ROTATED_PEM, 'current', permissions=['get:drinks-detail'])
+
+        self.assertEqual(self.get(forged).status_code, 400)
+        self.assertEqual(self.get(forged).status_code, 400)
+        self.assertEqual(len(auth.token_cache), 0)
+
+
+class PermissionMatcherTestCase(unittest.TestCase):
+    """compiled permissions and requires_auth with several of them"""
+
+    def granted(self, required, *permissions):
+        return compile_permission(required)(permission_set(permissions))
+
+    def test_exact_and_wildcards(self):
+        self.assertTrue(self.granted('get:drinks', 'get:drinks'))
+        self.assertFalse(self.granted('get:drinks', 'get:drinks-detail'))
+        self.assertTrue(self.granted('*:drinks', 'patch:drinks'))
+        self.assertFalse(self.granted('*:drinks', 'patch:ingredients'))
+        self.assertTrue(self.granted('post:*', 'post:ingredients'))
+        self.assertTrue(self.granted('*', 'delete:drinks'))
+        self.assertFalse(self.granted('*'))
+        self.assertTrue(self.granted(''))
+
+    def test_any_of_all_of(self):
+        self.assertTrue(self.granted(any_of('post:drinks', 'patch:drinks'), 'patch:drinks'))
+        self.assertFalse(self.granted(any_of('post:drinks', 'patch:drinks'), 'get:drinks'))
+        self.assertTrue(self.granted(all_of('post:drinks', 'patch:drinks'), 'post:drinks', 'patch:drinks'))
+        self.assertFalse(self.granted(all_of('post:drinks', 'patch:drinks'), 'post:drinks'))
+        self.assertTrue(self.granted(all_of('get:*', '*:drinks'), 'get:menu', 'delete:drinks'))
+
+        nested = any_of('get:drinks-detail', all_of('post:drinks', any_of('patch:drinks', 'delete:drinks')))
+        self.assertTrue(self.granted(nested, 'get:drinks-detail'))
+        self.assertTrue(self.granted(nested, 'post:drinks', 'delete:drinks'))
+        self.assertFalse(self.granted(nested, 'post:drinks'))
+
+    def test_not_a_permission(self):
+        with self.assertRaises(TypeError):
+            compile_permission(['get:drinks'])
+
+    def test_nested_decorators_verify_once_per_request(self):
+        app_jwks, app_token_cache = auth.jwks, auth.token_cache
+        auth.jwks = JWKSKeyStore('http://127.0.0.1:9/.well-known/jwks.json', background=False)
+        auth.jwks.load({'current': KEY})
+        auth.token_cache = VerifiedTokenCache(max_entries=0, permissions=permission_set)
+        self.addCleanup(setattr, auth, 'jwks', app_jwks)
+        self.addCleanup(setattr, auth, 'token_cache', app_token_cache)
+
+        app = Flask(__name__)
+
+        @requires_auth('*:drinks')
+        def any_drink(payload):
+            return payload['sub']
+
+        @app.route('/drinks/edit')
+        @requires_auth(all_of('patch:drinks', any_of('get:drinks-detail', 'get:menu')))
+        def edit_drink(payload):
+            return jsonify({'sub': any_drink()})
+
+        @app.errorhandler(AuthError)
+        def auth_error(error):
+            return jsonify(error.error), error.status_code
+
+        client = app.test_client()
+        token = make_token(PEM, 'current', permissions=['patch:drinks', 'get:menu'])
+        with mock.patch.object(auth, 'verify_decode_jwt', wraps=auth.verify_decode_jwt) as verify:
+            res = client.get('/drinks/edit', headers={'Authorization': 'Bearer ' + token})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json()['sub'], 'barista')
+            self.assertEqual(verify.call_count, 1)
+
+            # the cached payload belongs to the request, not the token
+            res = client.get('/drinks/edit', headers={'Authorization': 'Bearer ' + token})
+            self.assertEqual(verify.call_count, 2)
+
+        token = make_token(PEM, 'current', permissions=['patch:drinks'])
+        res = client.get('/drinks/edit', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(res.status_code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main()
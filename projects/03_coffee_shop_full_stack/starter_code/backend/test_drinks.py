@@ -0,0 +1,238 @@
+import contextlib
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from flask import Flask
+from sqlalchemy import event
+
+from src.database.models import db, setup_db, migrate_recipes, Drink, DrinkIngredient
+from src.http_cache import HTTPCache, bump_table_versions, conditional
+from src.menu import MENU_TABLES, MenuSnapshot
+
+MATCHA = [{'color': 'grey', 'name': 'milk', 'parts': 1}, {'color': 'green', 'name': 'matcha', 'parts': 3}]
+FLATWHITE = [{'color': 'grey', 'name': 'milk', 'parts': 3}, {'color': 'brown', 'name': 'coffee', 'parts': 1}]
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """a database file with the drinks in the JSON blob format"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.create_blob_database()
+
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' + self.path)
+        HTTPCache(self.app, db)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        os.remove(self.path)
+
+    def create_blob_database(self):
+        # the schema of databases created before DrinkIngredient
+        connection = sqlite3.connect(self.path)
+        connection.execute('''
+            CREATE TABLE drink (
+                id INTEGER NOT NULL,
+                title VARCHAR(80),
+                recipe VARCHAR(180) NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (title)
+            )''')
+        connection.executemany('INSERT INTO drink VALUES (?, ?, ?)', [
+            (1, 'matcha shake', json.dumps(MATCHA)),
+            (2, 'flatwhite', json.dumps(FLATWHITE)),
+        ])
+        connection.commit()
+        connection.close()
+
+    def count_statements(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', listener)
+        return statements
+
+
+class DrinkTestCase(DatabaseTestCase):
+    """Drink recipes stored as drink_ingredient rows"""
+
+    def test_migrate_recipes(self):
+        migrate_recipes()
+        migrate_recipes()
+
+        drinks = Drink.query.order_by(Drink.id).all()
+        self.assertEqual([drink.long()['recipe'] for drink in drinks], [MATCHA, FLATWHITE])
+        self.assertEqual(DrinkIngredient.query.count(), 4)
+        columns = [row[1] for row in db.session.execute('PRAGMA table_info(drink)')]
+        self.assertEqual(columns, ['id', 'title'])
+
+    def test_migrate_malformed_recipe(self):
+        db.session.execute("UPDATE drink SET recipe = '[{\"color\": \"grey\"}]' WHERE id = 2")
+        db.session.commit()
+
+        with self.assertLogs('recipes', 'WARNING'):
+            skipped = migrate_recipes()
+
+        self.assertEqual([drink_id for drink_id, error in skipped], [2])
+        self.assertEqual(Drink.query.get(1).recipe, MATCHA)
+        self.assertEqual(Drink.query.get(2).recipe, [])
+        legacy = db.session.execute('SELECT drink_id, recipe FROM drink_recipe_legacy').fetchall()
+        self.assertEqual([tuple(row) for row in legacy], [(2, '[{"color": "grey"}]')])
+
+    def test_short_and_long(self):
+        migrate_recipes()
+        drink = Drink.query.get(2)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            short = drink.short()
+
+        self.assertEqual(short, {'id': 2, 'title': 'flatwhite', 'recipe': [
+            {'color': 'grey', 'parts': 3}, {'color': 'brown', 'parts': 1}]})
+        self.assertEqual(drink.long(), {'id': 2, 'title': 'flatwhite', 'recipe': FLATWHITE})
+        self.assertEqual(output.getvalue(), '')
+
+    def test_menu_is_one_query(self):
+        migrate_recipes()
+        db.session.remove()
+        statements = self.count_statements()
+
+        menu = [drink.short() for drink in Drink.query.order_by(Drink.id).all()]
+
+        self.assertEqual(len(menu), 2)
+        self.assertEqual(len([s for s in statements if 'table_versions' not in s]), 1)
+
+    def test_recipe_is_not_truncated(self):
+        migrate_recipes()
+        recipe = [{'color': 'color-{}'.format(i), 'name': 'ingredient {}'.format(i) * 10, 'parts': i}
+                  for i in range(1, 21)]
+        Drink(title='everything', recipe=recipe).insert()
+        db.session.remove()
+
+        self.assertEqual(Drink.query.filter_by(title='everything').one().long()['recipe'], recipe)
+
+    def test_update_and_delete_recipe(self):
+        migrate_recipes()
+        drink = Drink.query.get(1)
+        drink.recipe = {'color': 'blue', 'name': 'water', 'parts': 1}
+        drink.update()
+        db.session.remove()
+
+        self.assertEqual(Drink.query.get(1).recipe, [{'color': 'blue', 'name': 'water', 'parts': 1}])
+        self.assertEqual(DrinkIngredient.query.filter_by(drink_id=1).count(), 1)
+
+        Drink.query.get(1).delete()
+        self.assertEqual(DrinkIngredient.query.filter_by(drink_id=1).count(), 0)
+
+    def test_malformed_recipe(self):
+        with self.assertRaises(ValueError):
+            Drink(title='water', recipe=[{'color': 'blue', 'parts': 1}])
+
+
+class MenuSnapshotTestCase(DatabaseTestCase):
+    """GET /drinks and /drinks-detail served from the menu snapshot"""
+
+    def setUp(self):
+        super(MenuSnapshotTestCase, self).setUp()
+        migrate_recipes()
+        self.menu = MenuSnapshot(self.app)
+
+        @self.app.route('/drinks')
+        @conditional(*MENU_TABLES)
+        def get_drinks():
+            return self.menu.response('short')
+
+        @self.app.route('/drinks-detail')
+        @conditional(*MENU_TABLES)
+        def get_drinks_detail():
+            return self.menu.response('long')
+
+        self.client = self.app.test_client()
+
+    def titles(self, res):
+        return [drink['title'] for drink in res.get_json()['drinks']]
+
+    def test_built_once(self):
+        statements = self.count_statements()
+        for _ in range(20):
+            res = self.client.get('/drinks')
+            self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.titles(res), ['matcha shake', 'flatwhite'])
+        self.assertEqual(res.get_json()['drinks'][0]['recipe'], [
+            {'color': 'grey', 'parts': 1}, {'color': 'green', 'parts': 3}])
+        self.assertEqual(self.client.get('/drinks-detail').get_json()['drinks'][1]['recipe'], FLATWHITE)
+        self.assertEqual(self.menu.builds, 2)
+        # one query per build, besides the version check of each request
+        self.assertEqual(len([s for s in statements if 'table_versions' not in s]), 2)
+
+    def test_rebuilt_after_commit(self):
+        etag = self.client.get('/drinks').headers['ETag']
+
+        Drink(title='water', recipe=[{'color': 'blue', 'name': 'water', 'parts': 1}]).insert()
+        res = self.client.get('/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.titles(res), ['matcha shake', 'flatwhite', 'water'])
+
+        drink = Drink.query.filter_by(title='water').one()
+        drink.recipe = [{'color': 'white', 'name': 'foam', 'parts': 2}]
+        drink.update()
+        self.assertEqual(self.client.get('/drinks').get_json()['drinks'][2]['recipe'], [{'color': 'white', 'parts': 2}])
+
+        drink.delete()
+        self.assertEqual(self.titles(self.client.get('/drinks')), ['matcha shake', 'flatwhite'])
+        self.assertEqual(self.menu.builds, 4)
+
+    def test_rebuilt_after_change_in_another_worker(self):
+        self.client.get('/drinks')
+        db.session.execute("UPDATE drink SET title = 'matcha latte' WHERE id = 1")
+        bump_table_versions(db.session.connection(), 'drink')
+        db.session.commit()
+
+        self.assertEqual(self.titles(self.client.get('/drinks')), ['matcha latte', 'flatwhite'])
+
+    def test_rebuilt_when_built_from_other_versions(self):
+        self.client.get('/drinks')
+        versions, snapshot = self.menu.snapshots['short']
+        # as stored by a build that read the menu before a commit and
+        # finished after other requests had seen the new versions
+        self.menu.snapshots['short'] = (('older', 'older'), {None: b'{"success": true, "drinks": []}\n'})
+
+        self.assertEqual(self.titles(self.client.get('/drinks')), ['matcha shake', 'flatwhite'])
+        self.assertEqual(self.menu.snapshots['short'][0], versions)
+
+    def test_not_modified(self):
+        etag = self.client.get('/drinks').headers['ETag']
+        res = self.client.get('/drinks', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.menu.builds, 1)
+
+    def test_precompressed(self):
+        recipe = [{'color': 'color-{}'.format(i), 'name': 'ingredient {}'.format(i), 'parts': i} for i in range(1, 21)]
+        Drink(title='everything', recipe=recipe).insert()
+        plain = self.client.get('/drinks-detail')
+
+        res = self.client.get('/drinks-detail', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['ETag'], '"{}-gzip"'.format(plain.headers['ETag'].strip('"')))
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(self.menu.builds, 1)
+
+        res = self.client.get('/drinks-detail', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+
+if __name__ == "__main__":
+    unittest.main()